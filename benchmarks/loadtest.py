@@ -0,0 +1,404 @@
+"""
+End-to-end load test: runs the real Director in this process against local
+stand-ins (see standins.py) running in a child process, and reports
+throughput, director-added latency and resource usage.
+
+    python -m benchmarks.loadtest --predictions 200 --latency 0.05 > before.json
+    python -m benchmarks.loadtest --predictions 200 --latency 0.05 \
+        --baseline before.json
+
+The JSON report goes to stdout and logs to stderr. Given a baseline report,
+the run is compared against it and fails if it got worse by more than the
+threshold. Everything runs offline. The director's ports are fixed, so 4900 and 5000
+must be free. By default messages go through kombu's in-memory transport;
+pass --redis-url to use a real Redis instead.
+"""
+
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import threading
+import time
+import uuid
+import structlog
+import uvicorn
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from kombu import Connection, Producer, Queue
+from typing import Any, Dict, List, Optional
+
+from director.background_tasks import BackgroundTasks
+from director.compression import ENCODINGS, CompressionParams
+from director.director import Director
+from director.health_checker import Healthchecker, http_fetcher
+from director.http import Server, create_app
+from director.memory import MemoryTracker
+from director.monitor import Monitor
+from director.retry import RetryScheduler
+from director.spill import Spill
+from director.worker import Worker
+
+from .standins import ModelProfile, run_standins
+
+log = structlog.get_logger("benchmarks.loadtest")
+
+QUEUE = "loadtest"
+
+# Report fields compared against a baseline, and whether higher is better.
+COMPARED = {
+    "throughput": True,
+    "director_latency.p50": False,
+    "director_latency.p99": False,
+    "cpu_per_prediction": False,
+    "max_rss_bytes": False,
+}
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(p: float) -> float:
+        return values[min(int(p * len(values)), len(values) - 1)]
+
+    return {
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": values[-1],
+    }
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def publish(
+    redis_url: str,
+    count: int,
+    rate: float,
+    webhook_url: str,
+    upload: Dict[str, Any],
+    ttl: Optional[float] = None,
+) -> None:
+    with Connection(redis_url) as conn:
+        producer = Producer(conn.default_channel)
+        q = Queue(QUEUE, routing_key=QUEUE)
+
+        for i in range(count):
+            message: Dict[str, Any] = {
+                "id": uuid.uuid4().hex,
+                "input": {"i": i},
+                "created_at": datetime.now(tz=timezone.utc).isoformat(),
+                "webhook": {"url": webhook_url},
+            }
+            if upload:
+                message["upload"] = upload
+            if ttl:
+                message["ttl"] = ttl
+            producer.publish(message, routing_key=QUEUE, declare=[q])
+
+            if rate:
+                time.sleep(1 / rate)
+
+
+def compare(base: Dict[str, Any], head: Dict[str, Any], threshold: float) -> bool:
+    """
+    Print a before/after table of the compared fields. Returns False if any
+    got worse by more than `threshold` (a fraction).
+    """
+    ok = True
+    print(f"{'metric':24} {'before':>12} {'after':>12} {'change':>9}")
+    for name, higher_is_better in COMPARED.items():
+        before, after = _field(base, name), _field(head, name)
+        if not before or after is None:
+            print(f"{name:24} {_format(before):>12} {_format(after):>12} {'n/a':>9}")
+            continue
+
+        change = after / before - 1
+        flag = ""
+        if (-change if higher_is_better else change) > threshold:
+            flag = "  REGRESSION"
+            ok = False
+        print(
+            f"{name:24} {_format(before):>12} {_format(after):>12} "
+            f"{change:>+8.1%}{flag}"
+        )
+
+    return ok
+
+
+def _field(report: Dict[str, Any], name: str) -> Optional[float]:
+    value: Any = report
+    for part in name.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _format(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.4g}"
+
+
+def main() -> int:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--predictions", type=int, default=100)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Publish rate in messages/s (0 publishes everything up front)",
+    )
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--outputs", type=int, default=1)
+    parser.add_argument("--output-size", type=int, default=64 * 1024)
+    parser.add_argument("--log-rate", type=float, default=20.0)
+    parser.add_argument("--webhook-rate", type=float, default=10.0)
+    parser.add_argument("--upload", action="store_true", help="Upload to the S3 stub")
+    parser.add_argument(
+        "--spill-threshold",
+        type=int,
+        default=0,
+        help="Spill output values above this size to disk, in bytes (0 disables)",
+    )
+    parser.add_argument(
+        "--webhook-compression",
+        choices=["none", *ENCODINGS],
+        default="none",
+        help="Compress webhook bodies above 64KiB with this encoding",
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="Report per-prediction memory from tracemalloc (slows things down)",
+    )
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        help="Give messages this TTL, in seconds, so a backlog expires",
+    )
+    parser.add_argument("--redis-url", type=str, default="memory://")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--output", type=str, help="Write the JSON report here")
+    parser.add_argument(
+        "--baseline", type=str, help="Compare against the JSON report in this file"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Fail if any compared metric gets worse by more than this fraction",
+    )
+    args = parser.parse_args()
+
+    # Keep stdout for the report, so that it can be piped.
+    structlog.configure(logger_factory=structlog.PrintLoggerFactory(sys.stderr))
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    profile = ModelProfile(
+        latency=args.latency,
+        outputs=args.outputs,
+        output_size=args.output_size,
+        log_rate=args.log_rate,
+        webhook_rate=args.webhook_rate,
+    )
+
+    results: multiprocessing.Queue = multiprocessing.Queue()
+    ports: multiprocessing.Queue = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    standins = multiprocessing.Process(
+        target=run_standins, args=(profile, results, ports, stop), daemon=True
+    )
+    standins.start()
+    receiver_port, store_port = ports.get(timeout=30)
+
+    upload = {}
+    if args.upload:
+        upload = {
+            "url": f"http://127.0.0.1:{store_port}",
+            "bucket": "loadtest",
+            "access_key": "loadtest",
+            "secret_key": "loadtest",
+            "url_prefix": "http://objects.invalid",
+        }
+
+    spill = Spill(threshold=args.spill_threshold) if args.spill_threshold else None
+    memory_tracker = None
+    if args.tracemalloc:
+        memory_tracker = MemoryTracker()
+        memory_tracker.start()
+
+    # Wire up the director the same way __main__ does.
+    events: queue.Queue = queue.Queue(maxsize=128)
+    server = Server(
+        uvicorn.Config(
+            create_app(events=events, spill=spill), port=4900, log_config=None
+        )
+    )
+    server.start()
+    background_tasks = BackgroundTasks()
+    background_tasks.start()
+    retry_scheduler = RetryScheduler()
+    retry_scheduler.start()
+    healthchecker = Healthchecker(
+        events=events, fetcher=http_fetcher("http://localhost:5000/health-check")
+    )
+    healthchecker.start()
+    monitor = Monitor()
+    monitor.start()
+    worker = Worker(queue=QUEUE, background_tasks=background_tasks)
+    worker.start()
+
+    director = Director(
+        events=events,
+        healthchecker=healthchecker,
+        monitor=monitor,
+        worker=worker,
+        redis_url=args.redis_url,
+        consume_timeout=0,
+        predict_timeout=int(args.latency * 10 + 60),
+        max_failure_count=None,
+        background_tasks=background_tasks,
+        retry_scheduler=retry_scheduler,
+        spill=spill,
+        memory_tracker=memory_tracker,
+        webhook_compression=(
+            CompressionParams(encoding=args.webhook_compression)
+            if args.webhook_compression != "none"
+            else None
+        ),
+    )
+    for component in (server, healthchecker, monitor, worker, background_tasks):
+        director.register_shutdown_hook(component.stop)
+
+    collected: List[Dict[str, Any]] = []
+
+    def collect() -> None:
+        deadline = time.monotonic() + args.timeout
+        while len(collected) < args.predictions and time.monotonic() < deadline:
+            try:
+                collected.append(results.get(timeout=0.5))
+            except queue.Empty:
+                continue
+
+        marks["finished"] = time.time()
+        marks["end_usage"] = resource.getrusage(resource.RUSAGE_SELF)
+        director._should_exit = True
+
+    # Start measuring once the model has finished setup, so that the numbers
+    # reflect steady state rather than startup.
+    def start_load() -> None:
+        while not healthchecker._state.health.name == "READY":
+            time.sleep(0.05)
+
+        marks["started"] = time.time()
+        marks["usage"] = resource.getrusage(resource.RUSAGE_SELF)
+        threading.Thread(
+            target=publish,
+            args=(
+                args.redis_url,
+                args.predictions,
+                args.rate,
+                f"http://127.0.0.1:{receiver_port}/hook",
+                upload,
+                args.ttl,
+            ),
+            daemon=True,
+        ).start()
+        collect()
+
+    marks: Dict[str, Any] = {}
+    loader = threading.Thread(target=start_load, daemon=True)
+    loader.start()
+
+    director.start()
+    loader.join()
+
+    stop.set()
+    retry_scheduler.stop()
+    retry_scheduler.join()
+    standins.join(timeout=5)
+
+    if memory_tracker is not None:
+        marks["memory"] = memory_tracker.summary()
+    if spill is not None:
+        spill.close()
+
+    output = report(args, collected, marks)
+    print(json.dumps(output, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        sys.stdout.flush()
+        with contextlib.redirect_stdout(sys.stderr):
+            if not compare(baseline, output, args.threshold):
+                return 1
+    return 0
+
+
+def report(
+    args: Any,
+    collected: List[Dict[str, Any]],
+    marks: Dict[str, Any],
+) -> Dict[str, Any]:
+    elapsed = marks["finished"] - marks["started"]
+    usage = marks["end_usage"]
+    cpu = (usage.ru_utime - marks["usage"].ru_utime) + (
+        usage.ru_stime - marks["usage"].ru_stime
+    )
+
+    # Director-added latency: everything between dequeuing the message and
+    # the model accepting it, plus everything between the model finishing
+    # and the receiver getting the terminal webhook.
+    overhead = []
+    queue_times = []
+    for result in collected:
+        timestamps = result["metrics"].get("timestamps", {})
+        if "dequeued" in timestamps and "create_accepted" in timestamps:
+            before = timestamps["create_accepted"] - timestamps["dequeued"]
+            if "output_complete" in timestamps:
+                after = result["received_at"] - timestamps["output_complete"]
+                overhead.append(before + after)
+        if "queue_time" in result["metrics"]:
+            queue_times.append(result["metrics"]["queue_time"])
+
+    output = {
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in {"output", "timeout", "baseline", "threshold"}
+        },
+        "completed": len(collected),
+        "failed": sum(1 for r in collected if r["status"] != "succeeded"),
+        "expired": sum(1 for r in collected if r["metrics"].get("expired")),
+        "elapsed": elapsed,
+        "throughput": len(collected) / elapsed if elapsed else 0.0,
+        "director_latency": percentiles(overhead),
+        "queue_time": percentiles(queue_times),
+        "cpu_seconds": cpu,
+        "cpu_per_prediction": cpu / len(collected) if collected else None,
+        "max_rss_bytes": usage.ru_maxrss * 1024,
+        "rss_bytes": rss_bytes(),
+    }
+    if "memory" in marks:
+        output["memory"] = marks["memory"]
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    return output
+
+
+if __name__ == "__main__":
+    sys.exit(main())
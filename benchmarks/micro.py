@@ -0,0 +1,305 @@
+"""
+Micro-benchmarks for the code the director runs for every event.
+
+    python -m benchmarks.micro run --output before.json
+    python -m benchmarks.micro run --output after.json
+    python -m benchmarks.micro compare before.json after.json
+
+Each benchmark is timed with timeit in several repeats; results are stored as
+JSON (seconds per call) so that runs can be compared across commits.
+"""
+
+import base64
+import json
+import os
+import platform
+import queue
+import subprocess
+import sys
+import timeit
+import requests
+
+from argparse import ArgumentParser
+from cog import schema
+from typing import Any, Callable, Dict, List, Optional
+
+from director.health_checker import _state_from_response
+from director.http import create_app
+from director.prediction_tracker import PredictionTracker, allowed_fields
+from director.s3 import UploadParams, decode_data_url, make_object_key
+from director.webhook import webhook_caller
+
+BENCHMARKS: Dict[str, Callable[[], Callable[[], Any]]] = {}
+
+
+def benchmark(name: str) -> Callable:
+    """
+    Register a benchmark. The decorated function does any setup and returns
+    the callable to time.
+    """
+
+    def register(setup: Callable[[], Callable[[], Any]]) -> Callable:
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def _response(logs: str = "", output: Any = None, status: str = "processing"):
+    return schema.PredictionResponse(
+        id="bench",
+        input={"prompt": "a photo of an astronaut riding a horse"},
+        version="v1",
+        logs=logs,
+        output=output,
+        status=status,
+    )
+
+
+def _data_url(size: int) -> str:
+    payload = base64.b64encode(os.urandom(size)).decode()
+    return f"data:image/png;base64,{payload}"
+
+
+class _DiscardScheduler:
+    """
+    Stands in for the retry scheduler so that the webhook path is measured up
+    to the point where the payload would hit the network.
+    """
+
+    def submit(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def breaker(self, destination: str) -> Any:
+        return _OpenBreaker()
+
+
+class _OpenBreaker:
+    def allow(self) -> bool:
+        return False
+
+
+def _tracker_update(log_size: int) -> Callable[[], Any]:
+    line = "step 1/50 | loss 0.1234 | 3.2 it/s\n"
+    logs = line * (log_size // len(line))
+    # The tracker only builds the state for a webhook caller; this one just
+    # encodes it, as sending it would, since that's what grows with the logs.
+    tracker = PredictionTracker(response=_response(), webhook_caller=json.dumps)
+    tracker.start()
+    payload = _response(logs=logs)
+    return lambda: tracker.update_from_webhook_payload(payload)
+
+
+@benchmark("tracker_update/logs_1k")
+def _() -> Callable[[], Any]:
+    return _tracker_update(1_000)
+
+
+@benchmark("tracker_update/logs_100k")
+def _() -> Callable[[], Any]:
+    return _tracker_update(100_000)
+
+
+@benchmark("tracker_update/logs_1m")
+def _() -> Callable[[], Any]:
+    return _tracker_update(1_000_000)
+
+
+@benchmark("webhook/terminal_serialization")
+def _() -> Callable[[], Any]:
+    caller = webhook_caller(
+        url="http://localhost:9/webhook",
+        retry_scheduler=_DiscardScheduler(),  # type: ignore
+    )
+    tracker = PredictionTracker(response=_response(), webhook_caller=caller)
+    tracker.start()
+
+    response = _response(
+        logs="step\n" * 2000, output=[_data_url(256 * 1024)], status="succeeded"
+    )
+    response.metrics = {"exec_time": 1.0}
+
+    def run() -> None:
+        tracker._response = response.copy()
+        tracker._send_webhook()
+
+    return run
+
+
+@benchmark("allowed_fields")
+def _() -> Callable[[], Any]:
+    payload = _response(logs="step\n" * 2000, output=[_data_url(64 * 1024)]).dict()
+    return lambda: allowed_fields(payload)
+
+
+@benchmark("upload/decode_and_key_1m")
+def _() -> Callable[[], Any]:
+    params = UploadParams(
+        url="http://localhost:9",
+        bucket="bench",
+        access_key="bench",
+        secret_key="bench",
+        url_prefix="http://localhost:9",
+        path_prefix="outputs",
+    )
+    url = _data_url(1024 * 1024)
+
+    def run() -> str:
+        content_type, data = decode_data_url(url)
+        return make_object_key(params, data, content_type)
+
+    return run
+
+
+@benchmark("healthcheck/state_from_response")
+def _() -> Callable[[], Any]:
+    resp = requests.Response()
+    resp.status_code = 200
+    resp._content = json.dumps(
+        {"status": "READY", "setup": {"status": "succeeded", "logs": "x" * 1000}}
+    ).encode()
+    return lambda: _state_from_response(resp)
+
+
+@benchmark("http/webhook_receive")
+def _() -> Callable[[], Any]:
+    events: queue.Queue = queue.Queue()
+    app = create_app(events=events)
+    (endpoint,) = [
+        route.endpoint  # type: ignore
+        for route in app.routes
+        if getattr(route, "path", None) == "/webhook"
+    ]
+    body = _response(logs="step\n" * 2000, output=[_data_url(64 * 1024)]).json()
+
+    def run() -> None:
+        endpoint(schema.PredictionResponse.parse_raw(body))
+        events.get_nowait()
+
+    return run
+
+
+def run(names: Optional[List[str]], repeat: int, min_time: float) -> Dict[str, Any]:
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if names and not any(name.startswith(n) for n in names):
+            continue
+
+        func = setup()
+        timer = timeit.Timer(func)
+
+        # Pick a loop count that makes one repeat take at least min_time.
+        number, elapsed = timer.autorange()
+        number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+
+        times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+        times.sort()
+        results[name] = {
+            "median": times[len(times) // 2],
+            "min": times[0],
+            "max": times[-1],
+            "number": number,
+            "repeat": repeat,
+        }
+        print(f"{name:40} {_format(results[name]['median'])}", file=sys.stderr)
+
+    return {"meta": _meta(), "results": results}
+
+
+def compare(base: Dict[str, Any], head: Dict[str, Any], threshold: float) -> bool:
+    """
+    Print a before/after table. Returns False if any benchmark got slower by
+    more than `threshold` (a fraction).
+    """
+    ok = True
+    print(f"{'benchmark':40} {'before':>12} {'after':>12} {'change':>9}")
+    for name in sorted(set(base["results"]) | set(head["results"])):
+        before = base["results"].get(name, {}).get("median")
+        after = head["results"].get(name, {}).get("median")
+        if before is None or after is None:
+            print(f"{name:40} {_format(before):>12} {_format(after):>12} {'n/a':>9}")
+            continue
+
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            ok = False
+        print(
+            f"{name:40} {_format(before):>12} {_format(after):>12} "
+            f"{change:>+8.1%}{flag}"
+        )
+
+    return ok
+
+
+def _format(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def _meta() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def main() -> int:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument(
+        "names", nargs="*", help="Only run benchmarks with these prefixes"
+    )
+    run_parser.add_argument("--repeat", type=int, default=7)
+    run_parser.add_argument("--min-time", type=float, default=0.2)
+    run_parser.add_argument("--output", type=str, help="Write results as JSON here")
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("before", type=str)
+    compare_parser.add_argument("after", type=str)
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Fail if any benchmark slows down by more than this fraction",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run(args.names, args.repeat, args.min_time)
+        output = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output)
+        else:
+            print(output)
+        return 0
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    return 0 if compare(before, after, args.threshold) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+Local stand-ins for everything the director talks to: a fake cog model
+container, a webhook receiver, an S3-compatible object store and the control
+plane's worker API. They are deliberately dumb and cheap so that the director
+dominates the measurements.
+"""
+
+import base64
+import gzip
+import json
+import os
+import threading
+import time
+import requests
+
+from attrs import define
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Queue
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+# The director hardcodes where it finds the model container.
+COG_ADDRESS = ("127.0.0.1", 5000)
+
+
+@define
+class ModelProfile:
+    # Time the fake model spends "predicting", in seconds.
+    latency: float = 0.05
+    # Number of output files and the size of each, in bytes.
+    outputs: int = 1
+    output_size: int = 64 * 1024
+    # Log lines emitted per second while predicting.
+    log_rate: float = 20.0
+    # Processing webhooks sent per second while predicting.
+    webhook_rate: float = 10.0
+    # Time the fake model spends in setup, in seconds.
+    setup_time: float = 0.5
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("content-length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _reply(self, status: int, body: Any = None, headers: Dict = None) -> None:
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeModel:
+    """
+    Speaks enough of the cog HTTP API for the director: health checks,
+    asynchronous prediction creation with webhooks, cancelation and shutdown.
+    """
+
+    def __init__(self, profile: ModelProfile):
+        self.profile = profile
+        self.started_at = time.monotonic()
+        self.busy = False
+        self.canceled: set = set()
+        self.session = requests.Session()
+
+    def health(self) -> Dict[str, Any]:
+        if time.monotonic() - self.started_at < self.profile.setup_time:
+            status = "STARTING"
+        else:
+            status = "BUSY" if self.busy else "READY"
+        return {"status": status, "setup": {"status": "succeeded"}}
+
+    def predict(self, request: Dict[str, Any]) -> None:
+        self.busy = True
+        threading.Thread(target=self._run, args=(request,), daemon=True).start()
+
+    def _run(self, request: Dict[str, Any]) -> None:
+        profile = self.profile
+        url = request["webhook"]
+        response = {
+            "id": request["id"],
+            "input": request.get("input", {}),
+            "status": "processing",
+            "logs": "",
+            "output": None,
+        }
+
+        started = time.monotonic()
+        next_log = started
+        next_webhook = started
+        while time.monotonic() - started < profile.latency:
+            if request["id"] in self.canceled:
+                response["status"] = "canceled"
+                break
+
+            now = time.monotonic()
+            if profile.log_rate and now >= next_log:
+                response["logs"] += f"step at {now - started:.3f}s\n"
+                next_log += 1 / profile.log_rate
+            if profile.webhook_rate and now >= next_webhook:
+                self._send(url, response)
+                next_webhook += 1 / profile.webhook_rate
+            time.sleep(0.005)
+        else:
+            payload = base64.b64encode(os.urandom(profile.output_size)).decode()
+            response["output"] = [
+                f"data:application/octet-stream;base64,{payload}"
+                for _ in range(profile.outputs)
+            ]
+            response["status"] = "succeeded"
+
+        # Like cog, become ready before announcing the result.
+        self.busy = False
+        self._send(url, response)
+
+    def _send(self, url: str, response: Dict[str, Any]) -> None:
+        try:
+            self.session.post(url, json=response, timeout=5)
+        except requests.exceptions.RequestException:
+            pass
+
+
+def _model_handler(model: FakeModel) -> type:
+    class Handler(_Handler):
+        def do_GET(self) -> None:
+            if self.path == "/health-check":
+                self._reply(200, model.health())
+            else:
+                self._reply(404)
+
+        def do_PUT(self) -> None:
+            request = json.loads(self._body())
+            model.predict(request)
+            self._reply(202, {"id": request["id"], "status": "processing"})
+
+        def do_POST(self) -> None:
+            self._body()
+            if self.path.endswith("/cancel"):
+                model.canceled.add(self.path.split("/")[-2])
+            self._reply(200, {})
+
+    return Handler
+
+
+def _receiver_handler(results: "Queue[Dict[str, Any]]") -> type:
+    class Handler(_Handler):
+        def do_POST(self) -> None:
+            received_at = time.time()
+            body = self._body()
+            if self.headers.get("content-encoding") == "gzip":
+                body = gzip.decompress(body)
+            elif self.headers.get("content-encoding") == "zstd":
+                import zstandard
+
+                body = zstandard.ZstdDecompressor().decompress(body)
+            payload = json.loads(body)
+            if payload.get("status") in {"succeeded", "failed", "canceled"}:
+                results.put(
+                    {
+                        "id": payload.get("id"),
+                        "status": payload.get("status"),
+                        "metrics": payload.get("metrics") or {},
+                        "received_at": received_at,
+                    }
+                )
+            self._reply(200, {})
+
+    return Handler
+
+
+class _ObjectStoreHandler(_Handler):
+    def do_PUT(self) -> None:
+        self._body()
+        self._reply(200, headers={"ETag": '"0"'})
+
+    def do_POST(self) -> None:
+        self._body()
+        self._reply(204)
+
+
+class FakeControlPlane:
+    """
+    Speaks the control plane's worker API: queue assignments, held for up to
+    `wait` seconds while they match the worker's current queue (long-poll),
+    and status reports.
+    """
+
+    def __init__(self, queue: Optional[str] = None):
+        self.queue = queue
+        # (worker ID, status) for every status report received.
+        self.statuses: List[Tuple[str, str]] = []
+        self._cond = threading.Condition()
+
+    def assign(self, queue: Optional[str]) -> None:
+        with self._cond:
+            self.queue = queue
+            self._cond.notify_all()
+
+    def next_queue(self, wait: Optional[float], current: Optional[str]) -> Any:
+        with self._cond:
+            if wait:
+                self._cond.wait_for(lambda: self.queue != current, timeout=wait)
+            return self.queue
+
+
+def _control_plane_handler(control_plane: FakeControlPlane) -> type:
+    class Handler(_Handler):
+        def do_GET(self) -> None:
+            url = urlsplit(self.path)
+            if not url.path.startswith("/worker/next_queue/"):
+                self._reply(404)
+                return
+
+            params = parse_qs(url.query)
+            wait = float(params["wait"][0]) if "wait" in params else None
+            current = params["queue"][0] if "queue" in params else None
+            self._reply(200, {"queue": control_plane.next_queue(wait, current)})
+
+        def do_PUT(self) -> None:
+            self._body()
+            url = urlsplit(self.path)
+            if not url.path.startswith("/worker/status/"):
+                self._reply(404)
+                return
+
+            worker_id = url.path.rsplit("/", 1)[-1]
+            status = parse_qs(url.query)["status"][0]
+            control_plane.statuses.append((worker_id, status))
+            self._reply(200, {})
+
+    return Handler
+
+
+def serve_control_plane(
+    control_plane: FakeControlPlane, address: Tuple[str, int] = ("127.0.0.1", 0)
+) -> ThreadingHTTPServer:
+    """
+    Serve `control_plane` in the background. The worker's report URL is the
+    server's base URL.
+    """
+    return _serve(address, _control_plane_handler(control_plane))
+
+
+def _serve(address: Tuple[str, int], handler: type) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(address, handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_standins(
+    profile: ModelProfile,
+    results: "Queue[Dict[str, Any]]",
+    ports: "Queue[Tuple[int, int]]",
+    stop: Any,
+    cog_address: Optional[Tuple[str, int]] = None,
+) -> None:
+    """
+    Entry point for the stand-ins process. Reports the receiver and object
+    store ports on `ports`, then serves until `stop` is set.
+    """
+    model = FakeModel(profile)
+    _serve(cog_address or COG_ADDRESS, _model_handler(model))
+    receiver = _serve(("127.0.0.1", 0), _receiver_handler(results))
+    store = _serve(("127.0.0.1", 0), _ObjectStoreHandler)
+
+    ports.put((receiver.server_address[1], store.server_address[1]))
+    stop.wait()
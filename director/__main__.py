@@ -1,36 +1,85 @@
+import time
+
+# Taken before anything else is imported, so that the startup timing
+# breakdown includes imports.
+_started = time.perf_counter()
+
 import logging
 import os
 import queue
 import signal
 import sys
+import tracemalloc
 import structlog
 import uvicorn
 
 from argparse import ArgumentParser
-from cog.logging import setup_logging
-from typing import Any
-from opentelemetry import trace
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator
+from opentelemetry import metrics, trace
 
 from director.background_tasks import BackgroundTasks
 
+from .backlog import BacklogSampler
+from .cancellation import DEFAULT_CHANNEL as DEFAULT_CANCEL_CHANNEL
+from .cancellation import Cancellations
+from .compression import ENCODINGS, CompressionParams
+from .compression import DEFAULT_THRESHOLD as DEFAULT_COMPRESSION_THRESHOLD
 from .director import Director
 from .health_checker import Healthchecker, http_fetcher
 from .http import Server, create_app
+from .input_cache import DEFAULT_MAX_BYTES, InputCache, InputPrefetcher
+from .input_cache import DEFAULT_WAIT_TIMEOUT as DEFAULT_INPUT_CACHE_WAIT
+from .ledger import CompletionLedger
+from .logs import setup_logging
+from .memory import MemoryTracker
 from .monitor import Monitor
+from .profiler import SamplingProfiler
+from .result_cache import DEFAULT_TTL, ResultCache
+from .retry import RetryScheduler
+from .spill import DEFAULT_THRESHOLD, Spill
+from . import s3, webhook
+from .spool import FSYNC_POLICIES, WebhookSpool
+from .webhook import requests_session
 from .worker import Worker
 
-setup_logging(log_level=logging.INFO)
+# Log records are written out by a separate thread, see director.logs.
+log_listener = setup_logging(log_level=logging.INFO)
 log = structlog.get_logger("cog.director")
 
+# Seconds spent in each startup step, logged once everything is running.
+startup_timing: Dict[str, float] = {"imports": time.perf_counter() - _started}
+
+
+@contextmanager
+def _timed(step: str) -> Iterator[None]:
+    mark = time.perf_counter()
+    yield
+    startup_timing[step] = time.perf_counter() - mark
+
+
 # Enable OpenTelemetry if the env vars are present. If this block isn't
-# run, all the opentelemetry calls are no-ops.
-if "OTEL_SERVICE_NAME" in os.environ:
-    trace.set_tracer_provider(TracerProvider())
-    span_processor = BatchSpanProcessor(OTLPSpanExporter())
-    trace.get_tracer_provider().add_span_processor(span_processor)  # type: ignore
+# run, all the opentelemetry calls are no-ops, and the (slow to import) SDK
+# and exporters are never loaded.
+with _timed("telemetry"):
+    if "OTEL_SERVICE_NAME" in os.environ:
+        from opentelemetry.exporter.otlp.proto.http.metric_exporter import (
+            OTLPMetricExporter,
+        )
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+
+        from .tracing import tracer_provider_from_env
+
+        # Sampling is configured through DIRECTOR_TRACE_* variables, see
+        # director.tracing.
+        trace.set_tracer_provider(tracer_provider_from_env(OTLPSpanExporter()))
+
+        metric_reader = PeriodicExportingMetricReader(OTLPMetricExporter())
+        metrics.set_meter_provider(MeterProvider(metric_readers=[metric_reader]))
 
 
 def _die(signum: Any, frame: Any) -> None:
@@ -58,18 +107,212 @@ parser.add_argument(
 parser.add_argument("--redis-url", type=str, required=True)
 parser.add_argument("--report-url", type=str, required=False)
 parser.add_argument("--report-key", type=str, required=False)
+parser.add_argument(
+    "--backlog-interval",
+    type=float,
+    default=5.0,
+    help="How often to sample the consumed queue's backlog, in seconds (0 disables)",
+)
+parser.add_argument(
+    "--next-queue-mode",
+    type=str,
+    choices=["poll", "long-poll", "pubsub"],
+    default="poll",
+    help="How to learn about queue assignment changes from the control plane",
+)
+parser.add_argument(
+    "--spool-dir",
+    type=str,
+    default=None,
+    help="Directory for the durable spool of undelivered terminal webhooks",
+)
+parser.add_argument(
+    "--spool-fsync",
+    type=str,
+    choices=FSYNC_POLICIES,
+    default="interval",
+    help="When to fsync the webhook spool: every write, once a second or never",
+)
+parser.add_argument(
+    "--input-cache-dir",
+    type=str,
+    default=None,
+    help=(
+        "Directory to cache URL inputs in. The model container is then given"
+        " URLs of the cached copies, so only enable this for models whose URL"
+        " inputs are files"
+    ),
+)
+parser.add_argument(
+    "--input-cache-size",
+    type=int,
+    default=DEFAULT_MAX_BYTES,
+    help="Maximum total size of cached inputs, in bytes",
+)
+parser.add_argument(
+    "--input-cache-wait",
+    type=float,
+    default=DEFAULT_INPUT_CACHE_WAIT,
+    help=(
+        "How long a prediction waits for its inputs to be cached, in seconds;"
+        " inputs not cached by then are passed on as they are"
+    ),
+)
+parser.add_argument(
+    "--result-cache-size",
+    type=int,
+    default=0,
+    help=(
+        "Number of prediction results to cache locally and replay for repeated"
+        " inputs (0 disables). Only enable this for deterministic models"
+    ),
+)
+parser.add_argument(
+    "--result-cache-ttl",
+    type=float,
+    default=DEFAULT_TTL,
+    help="How long to keep cached prediction results, in seconds",
+)
+parser.add_argument(
+    "--result-cache-shared",
+    action="store_true",
+    help="Also share cached prediction results between workers through Redis",
+)
+parser.add_argument(
+    "--completion-ledger-ttl",
+    type=float,
+    default=0,
+    help=(
+        "Remember completed predictions in Redis for this long, in seconds, so"
+        " that redelivered messages re-send their result instead of running"
+        " again (0 disables)"
+    ),
+)
+parser.add_argument(
+    "--spill-threshold",
+    type=int,
+    default=DEFAULT_THRESHOLD,
+    help=(
+        "Size above which output values are kept on disk rather than in"
+        " memory, in bytes (0 disables)"
+    ),
+)
+parser.add_argument(
+    "--webhook-compression",
+    choices=["none", *ENCODINGS],
+    default="none",
+    help=(
+        "Compress webhook request bodies with this encoding, unless the"
+        " webhook in the message says otherwise"
+    ),
+)
+parser.add_argument(
+    "--webhook-compression-threshold",
+    type=int,
+    default=DEFAULT_COMPRESSION_THRESHOLD,
+    help="Size above which webhook request bodies are compressed, in bytes",
+)
+parser.add_argument(
+    "--no-s3-warmup",
+    action="store_true",
+    help=(
+        "Don't load boto3 at startup, for workers whose messages only carry"
+        " presigned upload URLs"
+    ),
+)
+parser.add_argument(
+    "--warmup-webhook-url",
+    type=str,
+    default=None,
+    help="Connect to the origin of this webhook URL at startup",
+)
+parser.add_argument(
+    "--warmup-upload-url",
+    type=str,
+    default=None,
+    help=(
+        "Connect to the origin of this bucket or endpoint URL at startup, for"
+        " presigned uploads"
+    ),
+)
+parser.add_argument(
+    "--cancel-channel",
+    type=str,
+    nargs="?",
+    const=DEFAULT_CANCEL_CHANNEL,
+    help=(
+        "Cancel predictions whose IDs are published on this Redis channel"
+        f" (default when given without a value: {DEFAULT_CANCEL_CHANNEL})"
+    ),
+)
 
 args = parser.parse_args()
 
 events: queue.Queue = queue.Queue(maxsize=128)
 
-config = uvicorn.Config(create_app(events=events), port=4900, log_config=None)
-server = Server(config)
-server.start()
+# The sampling profiler is opt-in: DIRECTOR_PROFILE=1 starts it right away,
+# SIGUSR1 toggles it (writing the profile out on stop), and the HTTP app
+# exposes it under /debug/profile.
+profiler = SamplingProfiler.from_env()
+if os.environ.get("DIRECTOR_PROFILE") == "1":
+    profiler.start()
+profiler.watch()
+signal.signal(signal.SIGUSR1, profiler.request_toggle)
+
+spill = None
+if args.spill_threshold > 0:
+    spill = Spill(threshold=args.spill_threshold)
+
+# Per-prediction memory accounting for soak runs, when started with
+# PYTHONTRACEMALLOC set.
+memory_tracker = None
+if tracemalloc.is_tracing():
+    memory_tracker = MemoryTracker(frames=tracemalloc.get_traceback_limit())
+    memory_tracker.start()
+
+webhook_compression = None
+if args.webhook_compression != "none":
+    webhook_compression = CompressionParams(
+        encoding=args.webhook_compression,
+        threshold=args.webhook_compression_threshold,
+    )
+
+input_cache = None
+if args.input_cache_dir:
+    input_cache = InputCache(
+        args.input_cache_dir,
+        max_bytes=args.input_cache_size,
+        wait_timeout=args.input_cache_wait,
+    )
+
+with _timed("server"):
+    config = uvicorn.Config(
+        create_app(
+            events=events, profiler=profiler, input_cache=input_cache, spill=spill
+        ),
+        port=4900,
+        log_config=None,
+    )
+    server = Server(config)
+    server.start()
 
 background_tasks = BackgroundTasks()
 background_tasks.start()
 
+retry_scheduler = RetryScheduler()
+retry_scheduler.start()
+
+with _timed("spool"):
+    # Replay anything left over from a previous run straight away.
+    spool = None
+    if args.spool_dir:
+        spool = WebhookSpool(
+            args.spool_dir,
+            fsync=args.spool_fsync,
+            session=requests_session(),
+        )
+        spool.start()
+
 healthchecker = Healthchecker(
     events=events,
     fetcher=http_fetcher("http://localhost:5000/health-check"),
@@ -79,14 +322,75 @@ healthchecker.start()
 monitor = Monitor()
 monitor.start()
 
-worker = Worker(
-    id=args.worker_id,
-    background_tasks=background_tasks,
-    queue=args.queue,
-    report_url=args.report_url,
-    report_key=args.report_key,
+with _timed("worker"):
+    worker = Worker(
+        id=args.worker_id,
+        background_tasks=background_tasks,
+        queue=args.queue,
+        report_url=args.report_url,
+        report_key=args.report_key,
+        next_queue_mode=args.next_queue_mode,
+        redis_url=args.redis_url,
+        retry_scheduler=retry_scheduler,
+    )
+    worker.start()
+
+backlog_sampler = None
+if args.backlog_interval > 0:
+    backlog_sampler = BacklogSampler(
+        redis_url=args.redis_url,
+        queue=lambda: worker.queue,
+        service_rate=worker.stats.service_rate,
+        on_sample=worker.set_backlog,
+        interval=args.backlog_interval,
+    )
+    backlog_sampler.start()
+
+result_cache = None
+if args.result_cache_size > 0:
+    result_cache = ResultCache(
+        max_entries=args.result_cache_size,
+        ttl=args.result_cache_ttl,
+        redis_url=args.redis_url if args.result_cache_shared else None,
+    )
+
+ledger = None
+if args.completion_ledger_ttl > 0:
+    ledger = CompletionLedger(args.redis_url, ttl=args.completion_ledger_ttl)
+
+cancellations = None
+if args.cancel_channel:
+    cancellations = Cancellations(args.redis_url, channel=args.cancel_channel)
+    cancellations.start()
+
+input_prefetcher = None
+if input_cache is not None:
+    input_prefetcher = InputPrefetcher(
+        cache=input_cache,
+        redis_url=args.redis_url,
+        queue=lambda: worker.queue,
+    )
+    input_prefetcher.start()
+
+log.info(
+    "startup timing",
+    total=time.perf_counter() - _started,
+    **startup_timing,
 )
-worker.start()
+
+# Besides loading what's slow to load, warmups open the connections the first
+# prediction would otherwise wait for. Webhook and upload destinations come
+# with messages, so they're only connected to when known up front.
+warmups: Dict[str, Callable[[], Any]] = {
+    "webhook": lambda: webhook.warm(args.warmup_webhook_url),
+    "presigned": lambda: s3.warm_presigned(args.warmup_upload_url),
+}
+if not args.no_s3_warmup:
+    warmups["s3"] = s3.warm
+if result_cache is not None:
+    warmups["result_cache"] = result_cache.warm
+if ledger is not None:
+    warmups["ledger"] = ledger.warm
 
 director = Director(
     events=events,
@@ -98,6 +402,18 @@ director = Director(
     predict_timeout=args.predict_timeout,
     max_failure_count=args.max_failure_count,
     background_tasks=background_tasks,
+    spool=spool,
+    retry_scheduler=retry_scheduler,
+    profiler=profiler,
+    warmups=warmups,
+    input_cache=input_cache,
+    input_prefetcher=input_prefetcher,
+    result_cache=result_cache,
+    ledger=ledger,
+    spill=spill,
+    memory_tracker=memory_tracker,
+    webhook_compression=webhook_compression,
+    cancellations=cancellations,
 )
 
 director.register_shutdown_hook(server.stop)
@@ -105,10 +421,45 @@ director.register_shutdown_hook(healthchecker.stop)
 director.register_shutdown_hook(monitor.stop)
 director.register_shutdown_hook(worker.stop)
 director.register_shutdown_hook(background_tasks.stop)
-director.start()
+if backlog_sampler:
+    director.register_shutdown_hook(backlog_sampler.stop)
+if spool:
+    director.register_shutdown_hook(spool.stop)
+if input_prefetcher:
+    director.register_shutdown_hook(input_prefetcher.stop)
+if cancellations:
+    director.register_shutdown_hook(cancellations.stop)
+
+# The director runs its shutdown hooks even if it fails to start (e.g. the
+# model fails setup), but what's joined here, and the retry scheduler, have to
+# be taken down either way, or their threads keep the process alive.
+try:
+    director.start()
+finally:
+    monitor.join()
+    healthchecker.join()
+    server.join()
+    worker.join()
+    background_tasks.join()
+
+    # Only stop the scheduler once background tasks can no longer hand it work.
+    retry_scheduler.stop()
+    retry_scheduler.join()
+    if backlog_sampler:
+        backlog_sampler.join()
+    if spool:
+        spool.join()
+    if input_prefetcher:
+        input_prefetcher.join()
+    if cancellations:
+        cancellations.join()
+
+    if profiler.running:
+        profiler.stop()
+        profiler.write()
+
+    if spill is not None:
+        spill.close()
 
-monitor.join()
-healthchecker.join()
-server.join()
-worker.join()
-background_tasks.join()
+    # Last, so that everything logged during shutdown is written out.
+    log_listener.stop()
@@ -10,6 +10,9 @@ log = structlog.get_logger(__name__)
 
 P = t.ParamSpec("P")
 
+# Background tasks taking longer than this, in seconds, are logged as slow.
+SLOW_TASK_TIME = 1.0
+
 
 class BackgroundTasks:
     def __init__(self):
@@ -84,7 +87,12 @@ class _BackgroundTask:
 
         self.func(*self.args, **self.kwargs)
 
+        # Every webhook is a background task, so only slow ones are logged
+        # at info level.
         elapsed_time = time.perf_counter() - start_time
-        log.info(
-            f"[Background task]{self.func.__name__} executed in {elapsed_time:.2f}s"
+        log_method = log.info if elapsed_time >= SLOW_TASK_TIME else log.debug
+        log_method(
+            "background task executed",
+            task=self.func.__name__,
+            elapsed_time=elapsed_time,
         )
@@ -0,0 +1,230 @@
+import json
+import threading
+import time
+import structlog
+
+from attrs import define
+from datetime import datetime, timezone
+from kombu import Connection
+from kombu.exceptions import ChannelError
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+log = structlog.get_logger(__name__)
+
+# How often to sample the backlog by default, in seconds.
+DEFAULT_SAMPLE_INTERVAL = 5.0
+
+
+@define
+class Backlog:
+    queue: str
+    length: int
+    oldest_age: Optional[float]
+    arrival_rate: Optional[float]
+    service_rate: Optional[float]
+    sampled_at: float
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "queue": self.queue,
+            "length": self.length,
+            "oldest_age": self.oldest_age,
+            "arrival_rate": self.arrival_rate,
+            "service_rate": self.service_rate,
+            "sampled_at": self.sampled_at,
+        }
+
+
+class BacklogSampler:
+    """
+    Periodically samples the depth of the queue the worker is consuming and the
+    age of the message at its head, and estimates the arrival rate from the
+    change in depth plus the worker's observed service rate.
+    """
+
+    def __init__(
+        self,
+        *,
+        redis_url: str,
+        queue: Callable[[], Optional[str]],
+        service_rate: Optional[Callable[[], float]] = None,
+        on_sample: Optional[Callable[[Backlog], None]] = None,
+        interval: float = DEFAULT_SAMPLE_INTERVAL,
+    ):
+        self._redis_url = redis_url
+        self._queue = queue
+        self._service_rate = service_rate
+        self._on_sample = on_sample
+        self._interval = interval
+
+        self._thread: Optional[threading.Thread] = None
+        self._should_exit = threading.Event()
+        self._latest: Optional[Backlog] = None
+
+        meter = metrics.get_meter("cog-director")
+        meter.create_observable_gauge(
+            "director.queue.length",
+            callbacks=[self._observe("length")],
+            description="Messages waiting in the consumed queue",
+        )
+        meter.create_observable_gauge(
+            "director.queue.oldest_age",
+            callbacks=[self._observe("oldest_age")],
+            unit="s",
+            description="Age of the message at the head of the consumed queue",
+        )
+        meter.create_observable_gauge(
+            "director.queue.arrival_rate",
+            callbacks=[self._observe("arrival_rate")],
+            unit="1/s",
+            description="Estimated rate of messages arriving on the consumed queue",
+        )
+        meter.create_observable_gauge(
+            "director.service_rate",
+            callbacks=[self._observe("service_rate")],
+            unit="1/s",
+            description="Predictions completed by this worker per second",
+        )
+
+    @property
+    def latest(self) -> Optional[Backlog]:
+        return self._latest
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._should_exit.set()
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._should_exit.is_set():
+            try:
+                with Connection(self._redis_url) as conn:
+                    while not self._should_exit.is_set():
+                        self._sample(conn)
+                        self._should_exit.wait(self._interval)
+
+            except Exception:
+                log.error("failed to sample queue backlog", exc_info=True)
+                self._should_exit.wait(self._interval)
+
+        log.info("shutting down backlog sampler")
+
+    def _sample(self, conn: Connection) -> None:
+        queue = self._queue()
+        if not queue:
+            self._latest = None
+            return
+
+        channel = conn.default_channel
+        length = queue_length(channel, queue)
+
+        oldest_age = None
+        head = peek_messages(channel, queue, count=1)
+        if head:
+            created_at = _parse_created_at(head[0].get("created_at"))
+            if created_at is not None:
+                oldest_age = (
+                    datetime.now(tz=timezone.utc) - created_at
+                ).total_seconds()
+
+        now = time.time()
+        service_rate = self._service_rate() if self._service_rate else None
+
+        # Whatever we didn't serve and didn't see queue up must have arrived.
+        arrival_rate = None
+        previous = self._latest
+        if (
+            previous is not None
+            and previous.queue == queue
+            and now > previous.sampled_at
+        ):
+            growth = (length - previous.length) / (now - previous.sampled_at)
+            arrival_rate = max(growth + (service_rate or 0.0), 0.0)
+
+        self._latest = Backlog(
+            queue=queue,
+            length=length,
+            oldest_age=oldest_age,
+            arrival_rate=arrival_rate,
+            service_rate=service_rate,
+            sampled_at=now,
+        )
+
+        if self._on_sample is not None:
+            self._on_sample(self._latest)
+
+    def _observe(
+        self, field: str
+    ) -> Callable[[CallbackOptions], Iterable[Observation]]:
+        def callback(options: CallbackOptions) -> Iterable[Observation]:
+            latest = self._latest
+            if latest is None or getattr(latest, field) is None:
+                return []
+            return [Observation(getattr(latest, field), {"queue": latest.queue})]
+
+        return callback
+
+
+def queue_length(channel: Any, queue: str) -> int:
+    """
+    Number of messages waiting in `queue`, across all priorities. A queue
+    that doesn't exist (on Redis: one that has been drained) is empty.
+    """
+    # On Redis, a passive declare fails for a missing list key, so the
+    # priority lists are counted directly.
+    if hasattr(channel, "_size") and hasattr(channel, "priority_steps"):
+        return channel._size(queue)
+
+    try:
+        return channel.queue_declare(queue=queue, passive=True).message_count
+    except ChannelError:
+        return 0
+
+
+def peek_messages(channel: Any, queue: str, count: int = 1) -> List[Dict]:
+    """
+    Decoded bodies of the next `count` messages to be delivered from `queue`,
+    without consuming them. Only supported on the Redis transport; other
+    transports return an empty list.
+    """
+    client = getattr(channel, "client", None)
+    if client is None or not hasattr(channel, "_q_for_pri"):
+        return []
+
+    # Kombu pushes on the left and pops from the right, serving priorities in
+    # ascending order, so the next messages are at the right end of the
+    # lowest non-empty priority list.
+    bodies: List[Dict] = []
+    for pri in channel.priority_steps:
+        if len(bodies) >= count:
+            break
+
+        key = channel._q_for_pri(queue, pri)
+        for raw in reversed(client.lrange(key, -(count - len(bodies)), -1)):
+            try:
+                message = channel.Message(json.loads(raw), channel=channel)
+                bodies.append(message.decode())
+            except Exception:
+                log.warn("failed to decode queued message", exc_info=True)
+
+    return bodies
+
+
+def _parse_created_at(value: Any) -> Optional[datetime]:
+    if not isinstance(value, str):
+        return None
+    try:
+        created_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at
@@ -0,0 +1,115 @@
+import threading
+import time
+import redis
+import structlog
+
+from collections import OrderedDict
+from typing import Optional
+
+log = structlog.get_logger(__name__)
+
+# Channel on which the IDs of canceled predictions are published by default.
+DEFAULT_CHANNEL = "director:cancel"
+
+# Prefix of per-prediction keys that mark a prediction as canceled, for
+# cancelations published while no director was listening. Publishers should
+# set them with a TTL.
+KEY_PREFIX = "director:cancel:"
+
+# How many canceled prediction IDs to remember, and for how long, in seconds.
+# A cancelation may arrive before its message is dequeued.
+MAX_REMEMBERED = 10000
+REMEMBER_FOR = 60 * 60
+
+# How long to wait before resubscribing after losing the subscription, in
+# seconds.
+RESUBSCRIBE_INTERVAL = 1.0
+
+
+class Cancellations:
+    """
+    Listens for prediction cancelations published on a Redis channel (the
+    message is the prediction ID) and remembers them, so that the director
+    can cancel the running prediction, or skip a canceled one when it's
+    dequeued.
+    """
+
+    def __init__(self, redis_url: str, channel: str = DEFAULT_CHANNEL):
+        self.redis_url = redis_url
+        self.channel = channel
+
+        self._thread: Optional[threading.Thread] = None
+        self._should_exit = threading.Event()
+        self._lock = threading.Lock()
+        # prediction ID -> when the cancelation arrived
+        self._canceled: "OrderedDict[str, float]" = OrderedDict()
+        self._redis = redis.Redis.from_url(redis_url)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._should_exit.set()
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def cancel(self, prediction_id: str) -> None:
+        with self._lock:
+            self._canceled[prediction_id] = time.monotonic()
+            self._canceled.move_to_end(prediction_id)
+            while len(self._canceled) > MAX_REMEMBERED:
+                self._canceled.popitem(last=False)
+
+    def is_canceled(self, prediction_id: str, check_redis: bool = False) -> bool:
+        """
+        Whether the prediction has been canceled. This is cheap enough to call
+        in a polling loop, unless `check_redis` is set to also look for a
+        cancelation key in Redis.
+        """
+        with self._lock:
+            canceled_at = self._canceled.get(prediction_id)
+            if canceled_at is not None:
+                if time.monotonic() - canceled_at < REMEMBER_FOR:
+                    return True
+                del self._canceled[prediction_id]
+
+        if not check_redis:
+            return False
+
+        try:
+            return bool(self._redis.exists(KEY_PREFIX + prediction_id))
+        except redis.RedisError:
+            log.warn("failed to look up prediction cancelation", exc_info=True)
+            return False
+
+    def _run(self) -> None:
+        while not self._should_exit.is_set():
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                log.info("subscribed to cancelations", channel=self.channel)
+
+                try:
+                    self._listen(pubsub)
+                finally:
+                    pubsub.close()
+
+            except redis.RedisError:
+                log.error("cancelation subscription failed", exc_info=True)
+                self._should_exit.wait(RESUBSCRIBE_INTERVAL)
+
+    def _listen(self, pubsub: redis.client.PubSub) -> None:
+        while not self._should_exit.is_set():
+            message = pubsub.get_message(timeout=1.0)
+            if message is None or message["type"] != "message":
+                continue
+
+            data = message["data"]
+            if isinstance(data, bytes):
+                data = data.decode()
+            if data:
+                log.debug("received cancelation", prediction_id=data)
+                self.cancel(data)
@@ -0,0 +1,96 @@
+import threading
+import time
+import structlog
+
+from typing import Optional
+
+log = structlog.get_logger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures against a single destination. After
+    `failure_threshold` of them the circuit opens and calls should be
+    short-circuited for `reset_timeout` seconds; after that a single probe is
+    let through (half-open), which either closes the circuit again or re-opens
+    it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and self._cooled_down():
+                return HALF_OPEN
+            return self._state
+
+    @property
+    def retry_at(self) -> Optional[float]:
+        """
+        Monotonic time after which the circuit will allow a probe, if open.
+        """
+        with self._lock:
+            if self._state != OPEN:
+                return None
+            return self._opened_at + self.reset_timeout
+
+    def allow(self) -> bool:
+        """
+        Whether a call may go ahead now. In the half-open state only one
+        caller at a time is allowed through to probe the destination.
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+
+            if self._state == OPEN and self._cooled_down():
+                self._state = HALF_OPEN
+
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != CLOSED:
+                log.info("circuit closed", circuit=self.name)
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    log.warn(
+                        "circuit opened", circuit=self.name, failures=self._failures
+                    )
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def _cooled_down(self) -> bool:
+        return time.monotonic() - self._opened_at >= self.reset_timeout
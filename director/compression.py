@@ -0,0 +1,71 @@
+import functools
+import gzip
+import json
+import structlog
+
+from pydantic import BaseModel, validator
+from typing import Any, Dict, Optional, Tuple
+
+log = structlog.get_logger(__name__)
+
+ENCODINGS = ("gzip", "zstd")
+
+# Bodies smaller than this, in bytes, aren't worth compressing by default.
+DEFAULT_THRESHOLD = 64 * 1024
+
+
+class CompressionParams(BaseModel):
+    encoding: str = "gzip"
+    threshold: int = DEFAULT_THRESHOLD
+    level: Optional[int] = None
+
+    @validator("encoding")
+    def _known_encoding(cls, v: str) -> str:
+        if v not in ENCODINGS:
+            raise ValueError(f"unknown encoding: {v}")
+        return v
+
+
+def encode_json(
+    payload: Any, params: Optional[CompressionParams] = None
+) -> Tuple[bytes, Dict[str, str]]:
+    """
+    Serialize `payload` as a JSON request body, compressed according to
+    `params` if it's big enough. Returns the body and the headers to send
+    with it.
+    """
+    body = json.dumps(payload, allow_nan=False).encode()
+    headers = {"Content-Type": "application/json"}
+
+    if params is None or len(body) < params.threshold:
+        return body, headers
+
+    encoding = params.encoding
+    if encoding == "zstd":
+        zstandard = _zstandard()
+        if zstandard is None:
+            encoding = "gzip"
+        else:
+            level = params.level if params.level is not None else 3
+            compressed = zstandard.ZstdCompressor(level=level).compress(body)
+
+    if encoding == "gzip":
+        level = params.level if params.level is not None else 1
+        compressed = gzip.compress(body, compresslevel=level)
+
+    if len(compressed) >= len(body):
+        return body, headers
+
+    headers["Content-Encoding"] = encoding
+    return compressed, headers
+
+
+@functools.lru_cache(maxsize=None)
+def _zstandard() -> Any:
+    # zstandard is optional; say so once rather than for every payload.
+    try:
+        import zstandard
+    except ImportError:
+        log.warn("zstandard is not installed: falling back to gzip")
+        return None
+    return zstandard
@@ -5,15 +5,29 @@ import requests
 import structlog
 
 from cog import schema
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from cog.server.http import Health
 from cog.server.probes import ProbeHelper
-from opentelemetry import trace
+from opentelemetry import metrics, trace
+from pydantic import parse_obj_as
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry  # type: ignore
 from typing import Any, Callable, List, Optional, Dict
 
 from director.background_tasks import BackgroundTasks
+from director.cancellation import Cancellations
+from director.compression import CompressionParams
+from director.compression import DEFAULT_THRESHOLD as DEFAULT_COMPRESSION_THRESHOLD
+from director.input_cache import InputCache, InputPrefetcher
+from director.ledger import CompletionLedger
+from director.memory import MemoryTracker
+from director.profiler import SamplingProfiler
+from director.result_cache import ResultCache, cache_key
+from director.retry import RetryScheduler
 from director.s3 import UploadParams, upload_caller
+from director.spill import Spill
+from director.spool import WebhookSpool
 
 from .event_types import HealthcheckStatus, Webhook
 from .health_checker import Healthchecker
@@ -39,9 +53,10 @@ PREDICTION_CREATE_TIMEOUT = 5
 # uploads, we should likely try and reduce this to a smaller number, e.g. 5s.
 CANCEL_WAIT = 30
 
-# How long to wait for an explicit healthcheck request before aborting. Note
-# that to avoid failing prematurely this should be at least as long as the it
-# takes for the complete chain of retries configured for the Healthchecker.
+# How long to wait for an explicit healthcheck request before aborting. A
+# requested check is a single probe bounded by the Healthchecker's
+# PROBE_TIMEOUT, but it may have to wait for a periodic probe in flight, so
+# this leaves plenty of room on top of two probe timeouts.
 HEALTHCHECK_WAIT = 10
 
 
@@ -61,12 +76,36 @@ class Director:
         predict_timeout: int,
         max_failure_count: int,
         background_tasks: Optional[BackgroundTasks] = None,
+        spool: Optional[WebhookSpool] = None,
+        retry_scheduler: Optional[RetryScheduler] = None,
+        profiler: Optional[SamplingProfiler] = None,
+        warmups: Optional[Dict[str, Callable[[], Any]]] = None,
+        input_cache: Optional[InputCache] = None,
+        input_prefetcher: Optional[InputPrefetcher] = None,
+        result_cache: Optional[ResultCache] = None,
+        ledger: Optional[CompletionLedger] = None,
+        spill: Optional[Spill] = None,
+        memory_tracker: Optional[MemoryTracker] = None,
+        webhook_compression: Optional[CompressionParams] = None,
+        cancellations: Optional[Cancellations] = None,
     ):
         self.events = events
         self.healthchecker = healthchecker
         self.monitor = monitor
         self.worker = worker
         self.background_tasks = background_tasks
+        self.spool = spool
+        self.retry_scheduler = retry_scheduler
+        self.profiler = profiler
+        self.warmups = warmups or {}
+        self.input_cache = input_cache
+        self.input_prefetcher = input_prefetcher
+        self.result_cache = result_cache
+        self.ledger = ledger
+        self.spill = spill
+        self.memory_tracker = memory_tracker
+        self.webhook_compression = webhook_compression
+        self.cancellations = cancellations
         self.redis_url = redis_url
         self.consume_timeout = consume_timeout
         self.predict_timeout = predict_timeout
@@ -74,8 +113,18 @@ class Director:
 
         self._failure_count = 0
         self._should_exit = False
+        self._consumer = RedisConsumer()
+        self._consumer_connected: Optional[Future] = None
+        self._skip_health_confirmation = False
+        self._pinned_inputs: List[str] = []
+        self._health_confirmed_at: Optional[datetime] = None
+        self._health_confirmation_started_at: Optional[datetime] = None
         self._shutdown_hooks: List[Callable] = []
         self._tracer = trace.get_tracer("cog-director")
+        self._expired_counter = metrics.get_meter("cog-director").create_counter(
+            "director.predictions.expired",
+            description="Predictions failed without running because they expired",
+        )
 
         self.cog_client = _make_local_http_client()
         self.cog_http_base = "http://localhost:5000"
@@ -89,8 +138,11 @@ class Director:
             ProbeHelper().ready()
 
             # First, we wait for the model container to report a successful
-            # setup.
+            # setup. Meanwhile, connections are established (including the
+            # consumer's, though it doesn't fetch anything until we're ready)
+            # and slow imports done in the background.
             self.worker.prepare()
+            self._start_warmups()
             self._setup()
             self.worker.idle()
 
@@ -101,6 +153,11 @@ class Director:
         finally:
             log.info("shutting down worker: bye bye!")
 
+            # The consumer may have been connected but never used.
+            if self._consumer_connected is not None:
+                if self._consumer_connected.done():
+                    self._consumer.close()
+
             try:
                 self._shutdown_model()
             except Exception:
@@ -128,6 +185,32 @@ class Director:
     def _aborted(self):
         return self._should_exit or self.worker.expired
 
+    def _start_warmups(self) -> None:
+        warmups = dict(self.warmups)
+        if self.worker.queue:
+            warmups["redis"] = lambda: self._consumer.connect(
+                self.redis_url, self.worker.queue, self._on_message
+            )
+        if not warmups:
+            return
+
+        pool = ThreadPoolExecutor(max_workers=len(warmups), thread_name_prefix="warmup")
+        futures = {
+            name: pool.submit(_run_warmup, name, func) for name, func in warmups.items()
+        }
+        pool.shutdown(wait=False)
+
+        self._consumer_connected = futures.get("redis")
+
+    def _wait_for_consumer(self) -> None:
+        # If connecting ahead of time failed, consume() connects again.
+        future, self._consumer_connected = self._consumer_connected, None
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                pass
+
     def _setup(self) -> None:
         mark = time.perf_counter()
 
@@ -163,6 +246,10 @@ class Director:
             # bit. We don't need them to run every 100ms.
             self.healthchecker.set_interval(5)
 
+            # The model was ready just now, so there's no need to ask again
+            # before fetching the first message.
+            self._skip_health_confirmation = True
+
             return
 
         if self._aborted():
@@ -176,13 +263,17 @@ class Director:
             self.worker.switched = False
 
         def _on_pre_handler():
+            if self._skip_health_confirmation:
+                self._skip_health_confirmation = False
+                return
             self._confirm_model_health()
 
         while True:
             structlog.contextvars.clear_contextvars()
             structlog.contextvars.bind_contextvars(queue=self.worker.queue)
 
-            RedisConsumer().consume(
+            self._wait_for_consumer()
+            self._consumer.consume(
                 queue=self.worker.queue,
                 redis_url=self.redis_url,
                 on_message=self._on_message,
@@ -203,27 +294,67 @@ class Director:
                 break
 
     def _on_message(self, body, message):
+        dequeued_at = datetime.now(tz=timezone.utc)
+        prediction_id = body.get("id") if isinstance(body, dict) else None
         try:
             log.info("received message")
             self.worker.busy()
+            if self.profiler and prediction_id:
+                self.profiler.prediction_started(prediction_id)
+            if self.memory_tracker:
+                self.memory_tracker.prediction_started()
+            if self.spill is not None:
+                self.spill.track(prediction_id)
+
+            # The next messages' inputs can download while this one runs.
+            if self.input_prefetcher:
+                self.input_prefetcher.trigger()
 
             with self._tracer.start_as_current_span(
                 name="cog.prediction",
                 attributes=span_attributes_from_env(),
             ) as span:
-                self._handle_message(body, span)
+                self._handle_message(body, span, dequeued_at=dequeued_at)
         except Exception:
             self._record_failure()
             log.error("caught exception while running prediction", exc_info=True)
         finally:
+            if self.profiler and prediction_id:
+                self.profiler.prediction_finished(prediction_id)
+            if self.memory_tracker:
+                self.memory_tracker.prediction_finished(prediction_id)
+
+            # Spilled outputs are normally released once the last webhook is
+            # sent, but the prediction may have ended without one. Releasing
+            # from the background tasks thread keeps this behind webhooks
+            # that are still queued; without it, webhooks are sent inline and
+            # there's nothing to wait for.
+            if self.spill is not None and self.background_tasks is not None:
+                self.background_tasks.add_task(self.spill.release, prediction_id)
+            elif self.spill is not None:
+                self.spill.release(prediction_id)
+
             self.monitor.set_current_prediction(None)
 
+            # The next message is guarded by a confirmation of its own.
+            self._health_confirmation_started_at = None
+            self._health_confirmed_at = None
+
+            if self.input_cache is not None and self._pinned_inputs:
+                self.input_cache.release(self._pinned_inputs)
+                self._pinned_inputs = []
+
             message.ack()
 
             self.worker.idle()
             log.info("acked message")
 
-    def _handle_message(self, message: Dict, span: trace.Span) -> None:
+    def _handle_message(
+        self,
+        message: Dict,
+        span: trace.Span,
+        dequeued_at: Optional[datetime] = None,
+    ) -> None:
         prediction_id = message["id"]
 
         structlog.contextvars.bind_contextvars(
@@ -240,7 +371,7 @@ class Director:
             _upload_params = message.get("upload")
             try:
                 params = UploadParams(**_upload_params)
-                _upload_caller = upload_caller(params)
+                _upload_caller = upload_caller(params, spill=self.spill, span=span)
 
             except Exception as e:
                 log.error(
@@ -248,6 +379,24 @@ class Director:
                     exc_info=True,
                 )
 
+        _cache_key = None
+        if self.result_cache is not None:
+            _cache_key = cache_key(message)
+
+        def _on_delivered(payload: Dict[str, Any]) -> None:
+            if self.ledger is not None:
+                self.ledger.record(prediction_id, payload)
+
+            # Results are cached once delivered, when outputs have been
+            # uploaded and the payload carries their URLs.
+            if (
+                self.result_cache is not None
+                and _cache_key is not None
+                and payload.get("status") == schema.Status.SUCCEEDED
+                and not (payload.get("metrics") or {}).get("cache_hit")
+            ):
+                self.result_cache.put(_cache_key, payload)
+
         _webhook_caller = None
         if message.get("webhook") is not None:
             _webhook_caller = webhook_caller(
@@ -255,26 +404,109 @@ class Director:
                 headers=message["webhook"].get("headers"),
                 upload_caller=_upload_caller,
                 background_tasks=self.background_tasks,
+                span=span,
+                spool=self.spool,
+                retry_scheduler=self.retry_scheduler,
+                on_delivered=_on_delivered,
+                spill=self.spill,
+                compression=self._webhook_compression(message["webhook"]),
             )
 
+        # A message that is redelivered because we didn't get to acknowledge
+        # it may belong to a prediction that has already completed.
+        if self.ledger is not None:
+            completed = self.ledger.lookup(prediction_id)
+            if completed is not None:
+                span.set_attribute("prediction.redelivered", True)
+                payload = completed.get("payload")
+                if payload is not None and _webhook_caller is not None:
+                    log.info("prediction already completed: re-sending result")
+                    _webhook_caller(payload)
+                else:
+                    log.info("prediction already completed: skipping")
+                return
+
+        def _on_phase(phase: str, at: datetime) -> None:
+            span.add_event(phase, timestamp=int(at.timestamp() * 1e9))
+
         tracker = PredictionTracker(
             response=schema.PredictionResponse(**message),
             webhook_caller=_webhook_caller,
+            on_phase=_on_phase,
         )
+        # Only a confirmation made while waiting for this message counts; the
+        # first message after setup has none.
+        if self._health_confirmed_at:
+            tracker.mark("health_confirmed", at=self._health_confirmed_at)
+        tracker.mark("dequeued", at=dequeued_at)
         self.monitor.set_current_prediction(tracker._response)
         self._set_span_attributes_from_tracker(span, tracker)
 
+        # Health is confirmed before the prediction span starts, so that span
+        # is recorded after the fact.
+        if self._health_confirmation_started_at and self._health_confirmed_at:
+            self._record_phase_span(
+                span,
+                "cog.prediction.health_confirmation",
+                self._health_confirmation_started_at,
+                self._health_confirmed_at,
+            )
+
+        # Nobody is waiting for the result of a prediction past its deadline,
+        # so don't spend model time on it.
+        deadline = _deadline(message, tracker._response.created_at)
+        if deadline is not None and deadline <= datetime.now(tz=timezone.utc):
+            log.warn("prediction expired: skipping", deadline=deadline.isoformat())
+            span.set_attribute("prediction.expired", True)
+            tracker.expire()
+            self._expired_counter.add(1)
+            self._set_span_attributes_from_tracker(span, tracker)
+            return
+
+        # It may have been canceled while it was waiting in the queue.
+        if self.cancellations is not None and self.cancellations.is_canceled(
+            prediction_id, check_redis=True
+        ):
+            log.info("prediction canceled before it ran: skipping")
+            span.set_attribute("prediction.canceled_externally", True)
+            tracker.force_cancel()
+            self._set_span_attributes_from_tracker(span, tracker)
+            return
+
+        # Deterministic models can be spared repeated inputs altogether.
+        if self.result_cache is not None and _cache_key is not None:
+            cached = self.result_cache.get(_cache_key)
+            span.set_attribute("prediction.cache_hit", cached is not None)
+            if cached is not None:
+                log.info("prediction answered from result cache")
+                tracker.start()
+                tracker.complete_from_cache(cached)
+                self._record_success()
+                self._set_span_attributes_from_tracker(span, tracker)
+                return
+
         # Override webhook to call us
         message["webhook"] = "http://localhost:4900/webhook"
 
+        # Point the model container at cached copies of URL inputs. The
+        # tracker keeps the original inputs for the webhooks.
+        if self.input_cache is not None and isinstance(message.get("input"), dict):
+            message["input"], self._pinned_inputs = self.input_cache.rewrite(
+                message["input"]
+            )
+
         # Call the model container to start the prediction
         try:
-            resp = self.cog_client.put(
-                self.cog_http_base + "/predictions/" + prediction_id,
-                json=message,
-                headers={"Prefer": "respond-async"},
-                timeout=PREDICTION_CREATE_TIMEOUT,
-            )
+            with self._tracer.start_as_current_span(
+                "cog.prediction.create"
+            ) as create_span:
+                resp = self.cog_client.put(
+                    self.cog_http_base + "/predictions/" + prediction_id,
+                    json=message,
+                    headers={"Prefer": "respond-async"},
+                    timeout=PREDICTION_CREATE_TIMEOUT,
+                )
+                create_span.set_attribute("http.status_code", resp.status_code)
         except requests.exceptions.RequestException as e:
             tracker.fail("Unknown error handling prediction.")
             log.error("prediction failed: could not create prediction", exc_info=True)
@@ -302,7 +534,20 @@ class Director:
             self._record_failure(span, e)
             return
 
+        tracker.mark("create_accepted")
         tracker.start()
+        run_started_at = datetime.now(tz=timezone.utc)
+
+        # Messages can ask for their own timeout.
+        predict_timeout = self.predict_timeout
+        if message.get("predict_timeout"):
+            try:
+                predict_timeout = float(message["predict_timeout"])
+            except (TypeError, ValueError):
+                log.error(
+                    "invalid predict_timeout in message",
+                    predict_timeout=message["predict_timeout"],
+                )
 
         # Wait for any of: completion, shutdown signal. Also check to see if we
         # should cancel the running prediction, and make the appropriate HTTP
@@ -314,6 +559,9 @@ class Director:
                 pass
             else:
                 if isinstance(event, Webhook):
+                    # Webhooks prove the model container is alive, so there's
+                    # no need to keep probing it while they keep coming.
+                    self.healthchecker.observed_alive()
                     tracker.update_from_webhook_payload(event.payload)
                 elif isinstance(event, HealthcheckStatus):
                     log.info("received healthcheck status update", data=event)
@@ -327,10 +575,10 @@ class Director:
                 else:
                     log.warn("received unknown event", data=event)
 
-            if self.predict_timeout and tracker.runtime > self.predict_timeout:
+            if predict_timeout and tracker.runtime > predict_timeout:
                 log.warn(
                     "prediction cancelation requested due to timeout",
-                    predict_timeout=self.predict_timeout,
+                    predict_timeout=predict_timeout,
                 )
                 # Mark the prediction as timed out so we handle the
                 # cancelation webhook appropriately.
@@ -338,6 +586,19 @@ class Director:
                 self._cancel_prediction(prediction_id, span, timed_out=True)
                 break
 
+            if self.cancellations is not None and self.cancellations.is_canceled(
+                prediction_id
+            ):
+                log.info("prediction cancelation requested")
+                span.set_attribute("prediction.canceled_externally", True)
+                try:
+                    self._cancel_prediction(prediction_id, span)
+                except requests.exceptions.RequestException:
+                    # It may just have completed; either way, what the model
+                    # container reports next is what counts.
+                    log.warn("failed to cancel prediction", exc_info=True)
+                break
+
         # Wait up to another CANCEL_WAIT seconds for cancelation if necessary
         mark = time.perf_counter()
         while not tracker.is_complete() and time.perf_counter() - mark < CANCEL_WAIT:
@@ -347,6 +608,9 @@ class Director:
                 pass
             else:
                 if isinstance(event, Webhook):
+                    # Webhooks prove the model container is alive, so there's
+                    # no need to keep probing it while they keep coming.
+                    self.healthchecker.observed_alive()
                     tracker.update_from_webhook_payload(event.payload)
 
         # If the prediction is *still* not complete, something is badly wrong
@@ -355,6 +619,14 @@ class Director:
             tracker.force_cancel()
             self._abort("prediction failed to complete after cancelation", span)
 
+        self._record_phase_span(
+            span,
+            "cog.prediction.run",
+            run_started_at,
+            datetime.now(tz=timezone.utc),
+            {"prediction.status": tracker.status.value},
+        )
+
         # Keep track of runs of failures to catch the situation where the
         # worker has gotten into a bad state where it can only fail
         # predictions, but isn't exiting.
@@ -370,6 +642,48 @@ class Director:
 
         self._set_span_attributes_from_tracker(span, tracker)
 
+    def _webhook_compression(
+        self, webhook: Dict[str, Any]
+    ) -> Optional[CompressionParams]:
+        # A webhook destination can set its own compression: null to disable
+        # it, an encoding name, or the full parameters. Otherwise the
+        # director-wide default applies.
+        if "compression" not in webhook:
+            return self.webhook_compression
+
+        compression = webhook["compression"]
+        try:
+            if not compression or compression == "none":
+                return None
+            if isinstance(compression, str):
+                threshold = (
+                    self.webhook_compression.threshold
+                    if self.webhook_compression is not None
+                    else DEFAULT_COMPRESSION_THRESHOLD
+                )
+                return CompressionParams(encoding=compression, threshold=threshold)
+            return CompressionParams(**compression)
+        except Exception:
+            log.error(f"Cannot parse webhook compression. {compression}", exc_info=True)
+            return self.webhook_compression
+
+    def _record_phase_span(
+        self,
+        parent: trace.Span,
+        name: str,
+        start: datetime,
+        end: datetime,
+        attributes: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        # Spans for phases that are easier to time than to wrap.
+        phase_span = self._tracer.start_span(
+            name,
+            context=trace.set_span_in_context(parent),
+            start_time=int(start.timestamp() * 1e9),
+            attributes=attributes,
+        )
+        phase_span.end(end_time=int(end.timestamp() * 1e9))
+
     # OpenTelemetry is very picky about not accepting None types
     def _set_span_attributes_from_tracker(self, span, tracker):
         span.set_attribute("prediction.uuid", tracker._response.id)
@@ -393,6 +707,7 @@ class Director:
             )
 
     def _confirm_model_health(self) -> None:
+        self._health_confirmation_started_at = datetime.now(tz=timezone.utc)
         self.healthchecker.request_status()
         mark = time.perf_counter()
 
@@ -410,6 +725,7 @@ class Director:
                 continue
 
             if event.health == Health.READY:
+                self._health_confirmed_at = datetime.now(tz=timezone.utc)
                 return
 
             # If we get anything else here: unknown, starting, busy,
@@ -452,6 +768,8 @@ class Director:
                 span.set_attribute("http.status_code", response.status_code)
                 span.set_attribute("http.response_length", len(response.content))
 
+        self.worker.record_prediction(succeeded=False)
+
         if not self.max_failure_count:
             return
         self._failure_count += 1
@@ -463,6 +781,7 @@ class Director:
             )
 
     def _record_success(self) -> None:
+        self.worker.record_prediction(succeeded=True)
         self._failure_count = 0
 
     def _abort(
@@ -484,6 +803,46 @@ class Director:
         log.info("requested model container shutdown", response_code=resp.status_code)
 
 
+def _deadline(message: Dict, created_at: Optional[datetime]) -> Optional[datetime]:
+    """
+    The time after which a message's prediction is no longer wanted: its
+    "deadline" (a datetime or a Unix timestamp), or its "ttl" in seconds after
+    it was created, whichever comes first.
+    """
+    deadlines = []
+    try:
+        if message.get("deadline") is not None:
+            deadline = parse_obj_as(datetime, message["deadline"])
+            deadlines.append(deadline)
+        if message.get("ttl") is not None and created_at is not None:
+            deadlines.append(created_at + timedelta(seconds=float(message["ttl"])))
+    except (TypeError, ValueError):
+        log.error(
+            "invalid deadline in message: ignoring it",
+            deadline=message.get("deadline"),
+            ttl=message.get("ttl"),
+        )
+        return None
+
+    # Naive times are taken to be UTC, like created_at.
+    deadlines = [
+        d.replace(tzinfo=timezone.utc) if d.tzinfo is None else d for d in deadlines
+    ]
+    return min(deadlines, default=None)
+
+
+def _run_warmup(name: str, func: Callable[[], Any]) -> Any:
+    mark = time.perf_counter()
+    try:
+        result = func()
+    except Exception:
+        log.warn("warmup failed", warmup=name, exc_info=True)
+        raise
+
+    log.info("warmup finished", warmup=name, seconds=time.perf_counter() - mark)
+    return result
+
+
 def _make_local_http_client() -> requests.Session:
     session = requests.Session()
     adapter = HTTPAdapter(
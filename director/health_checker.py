@@ -1,12 +1,12 @@
 import queue
+import random
 import threading
+import time
 import requests
 import structlog
 
 from attrs import define
 from cog.server.http import Health
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry  # type: ignore
 from typing import Callable, Optional
 
 from .event_types import HealthcheckStatus
@@ -17,6 +17,30 @@ log = structlog.get_logger(__name__)
 # How often to healthcheck initially
 DEFAULT_POLL_INTERVAL = 0.1
 
+# While the model container is starting up, the interval grows by this factor
+# after every probe that doesn't see a change, up to MAX_SETUP_POLL_INTERVAL.
+# Any change resets it.
+SETUP_BACKOFF_FACTOR = 1.5
+MAX_SETUP_POLL_INTERVAL = 1.0
+
+# Fraction by which each interval is randomly stretched or shrunk, so that a
+# fleet of directors started together doesn't probe in lockstep.
+POLL_JITTER = 0.1
+
+# Timeout for a single probe, in seconds. Periodic probes aren't retried: the
+# next probe is never far off.
+PROBE_TIMEOUT = 1.0
+
+# Number of consecutive failed probes (no answer, or an invalid one) before a
+# model container that was ready or busy is reported as UNKNOWN. Until then,
+# it's probed again every MAX_SETUP_POLL_INTERVAL seconds at most. Requested
+# status updates aren't debounced: a failed probe is retried once, and the
+# result reported as is.
+FAILURE_THRESHOLD = 3
+
+SETUP_STATES = {Health.UNKNOWN, Health.STARTING}
+HEALTHY_STATES = {Health.READY, Health.BUSY}
+
 
 class Healthchecker:
     def __init__(
@@ -25,13 +49,18 @@ class Healthchecker:
         events: queue.Queue,
         fetcher: Callable[[], HealthcheckStatus],
         interval: float = DEFAULT_POLL_INTERVAL,
+        failure_threshold: int = FAILURE_THRESHOLD,
     ):
         self._events = events
         self._fetch = fetcher
+        self._failure_threshold = failure_threshold
+        self._failures = 0
 
         self._thread: Optional[threading.Thread] = None
         self._interval = interval
+        self._delay = interval
         self._control: queue.Queue = queue.Queue()
+        self._alive_at: Optional[float] = None
 
         self._state = HealthcheckStatus(health=Health.UNKNOWN)
 
@@ -60,34 +89,91 @@ class Healthchecker:
         """
         self._control.put(_RequestStatus())
 
+    def observed_alive(self) -> None:
+        """
+        Record that the model container just showed signs of life (e.g. sent
+        a webhook). Periodic probes are skipped while it keeps doing so;
+        requested status updates are not.
+        """
+        self._alive_at = time.monotonic()
+
     def join(self) -> None:
         if self._thread is not None:
             self._thread.join()
 
     def _run(self) -> None:
+        next_check = time.monotonic() + self._jittered(self._delay)
+
         while True:
             try:
-                msg = self._control.get(timeout=self._interval)
+                msg = self._control.get(timeout=max(0, next_check - time.monotonic()))
             except queue.Empty:
-                self._check()
+                changed = False
+                if not self._suspended():
+                    changed = self._check()
+                self._back_off(changed)
+                next_check = time.monotonic() + self._jittered(self._delay)
                 continue
 
             if isinstance(msg, _Stop):
                 break
             elif isinstance(msg, _SetInterval):
                 self._interval = msg.value
+                self._delay = msg.value
+                next_check = time.monotonic() + self._jittered(self._delay)
             elif isinstance(msg, _RequestStatus):
                 self._check(force_update=True)
             else:
                 log.warn("unknown message on control queue", msg=msg)
 
-    def _check(self, force_update: bool = False) -> None:
+    def _suspended(self) -> bool:
+        return self._alive_at is not None and (
+            time.monotonic() - self._alive_at < self._interval
+        )
+
+    def _back_off(self, changed: bool) -> None:
+        if self._failures:
+            self._delay = min(self._interval, MAX_SETUP_POLL_INTERVAL)
+        elif changed or self._state.health not in SETUP_STATES:
+            self._delay = self._interval
+        else:
+            self._delay = min(
+                self._delay * SETUP_BACKOFF_FACTOR,
+                max(self._interval, MAX_SETUP_POLL_INTERVAL),
+            )
+
+    def _jittered(self, delay: float) -> float:
+        return delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+    def _check(self, force_update: bool = False) -> bool:
+        """
+        Probe the model container, and emit its state if it changed (or if
+        asked to). Returns whether it changed.
+        """
         state = self._fetch()
 
-        if self._state != state:
+        if self._blip(state) and force_update:
+            # Whoever asked is about to act on the answer, so it has to be a
+            # real one: probe once more, and report what that finds.
+            log.info("requested healthcheck probe failed, retrying")
+            state = self._fetch()
+            self._failures = 0
+        elif self._blip(state):
+            # A single slow or failed periodic probe of a healthy container is
+            # most likely a blip, so the last state stands until failures
+            # persist.
+            self._failures += 1
+            if self._failures < self._failure_threshold:
+                log.info("healthcheck probe failed", failures=self._failures)
+                state = self._state
+        else:
+            self._failures = 0
+
+        changed = self._state != state
+        if changed:
             log.debug("healthchecker status changed", state=state)
         elif not force_update:
-            return
+            return False
 
         self._state = state
 
@@ -96,13 +182,18 @@ class Healthchecker:
         except queue.Full:
             log.warn("failed to enqueue healthcheck status change: queue full")
 
+        return changed
+
+    def _blip(self, state: HealthcheckStatus) -> bool:
+        return state.health == Health.UNKNOWN and self._state.health in HEALTHY_STATES
+
 
-def http_fetcher(url: str) -> Callable:
-    c = _make_http_client()
+def http_fetcher(url: str, timeout: float = PROBE_TIMEOUT) -> Callable:
+    c = requests.Session()
 
     def _fetch() -> HealthcheckStatus:
         try:
-            resp = c.get(url, timeout=1)
+            resp = c.get(url, timeout=timeout)
         except requests.exceptions.RequestException:
             return HealthcheckStatus(health=Health.UNKNOWN)
         else:
@@ -111,20 +202,6 @@ def http_fetcher(url: str) -> Callable:
     return _fetch
 
 
-def _make_http_client() -> requests.Session:
-    session = requests.Session()
-    adapter = HTTPAdapter(
-        max_retries=Retry(
-            total=6,
-            backoff_factor=0.2,
-            status_forcelist=[429, 500, 502, 503, 504],
-        ),
-    )
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
-    return session
-
-
 def _state_from_response(resp: requests.Response) -> HealthcheckStatus:
     if resp.status_code != 200:
         return HealthcheckStatus(health=Health.UNKNOWN)
@@ -5,11 +5,13 @@ import uvicorn
 
 from cog import schema
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
-from typing import Any
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from typing import Any, Optional
 
 from .event_types import Webhook
-
+from .input_cache import InputCache
+from .profiler import SamplingProfiler
+from .spill import Spill
 
 log = structlog.get_logger(__name__)
 
@@ -27,15 +29,28 @@ class Server(uvicorn.Server):
         self._thread.join()
 
 
-def create_app(events: queue.Queue) -> FastAPI:
+def create_app(
+    events: queue.Queue,
+    profiler: Optional[SamplingProfiler] = None,
+    input_cache: Optional[InputCache] = None,
+    spill: Optional[Spill] = None,
+) -> FastAPI:
     app = FastAPI(title="Director")
 
     # The event queue is used to communicate with Director when webhook
     # events are received.
     app.state.events = events
+    app.state.profiler = profiler
+    app.state.input_cache = input_cache
+    app.state.spill = spill
 
     @app.post("/webhook")
     def webhook(payload: schema.PredictionResponse) -> Any:
+        # Large outputs are moved to disk straight away, so that the copies
+        # made of the payload from here on are small.
+        if app.state.spill is not None and payload.output is not None:
+            payload.output = app.state.spill.spill(payload.output, payload.id)
+
         event = Webhook(payload=payload)
         try:
             app.state.events.put(event, timeout=0.1)
@@ -47,4 +62,42 @@ def create_app(events: queue.Queue) -> FastAPI:
 
         return JSONResponse({"status": "ok"}, status_code=200)
 
-    return app
\ No newline at end of file
+    if input_cache is not None:
+
+        # Cached inputs, for the model container to fetch instead of the
+        # original URLs. The file name is only there for the model's benefit.
+        @app.get("/inputs/{digest}/{filename}")
+        def cached_input(digest: str, filename: str) -> Any:
+            path = app.state.input_cache.path(digest)
+            if path is None:
+                return JSONResponse({"detail": "not found"}, status_code=404)
+            return FileResponse(path, filename=filename)
+
+    if profiler is not None:
+
+        @app.get("/debug/profile")
+        def profile() -> Any:
+            # Folded stacks, ready for flamegraph.pl or speedscope.
+            return PlainTextResponse(app.state.profiler.folded())
+
+        @app.get("/debug/profile/stats")
+        def profile_stats() -> Any:
+            return JSONResponse(app.state.profiler.stats())
+
+        @app.post("/debug/profile/start")
+        def profile_start() -> Any:
+            app.state.profiler.reset()
+            app.state.profiler.start()
+            return JSONResponse(app.state.profiler.stats())
+
+        @app.post("/debug/profile/stop")
+        def profile_stop() -> Any:
+            app.state.profiler.stop()
+            return JSONResponse(app.state.profiler.stats())
+
+        @app.post("/debug/profile/predictions/{prediction_id}")
+        def profile_prediction(prediction_id: str) -> Any:
+            app.state.profiler.predictions.add(prediction_id)
+            return JSONResponse(app.state.profiler.stats())
+
+    return app
@@ -0,0 +1,403 @@
+import hashlib
+import os
+import time
+import posixpath
+import tempfile
+import threading
+import requests
+import structlog
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from kombu import Connection
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import quote, urlsplit
+
+from .backlog import peek_messages
+
+log = structlog.get_logger(__name__)
+
+# Where the model container fetches cached inputs from. It shares the pod's
+# network namespace with the director, which serves them from its own app.
+DEFAULT_BASE_URL = "http://localhost:4900/inputs"
+
+# Default bound on the total size of cached inputs, in bytes.
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+# Timeouts for downloading an input, in seconds: to connect and between
+# bytes received.
+DOWNLOAD_TIMEOUT = (5.0, 30.0)
+
+CHUNK_SIZE = 1024 * 1024
+
+# How long a prediction waits for its inputs to be cached in total, in
+# seconds. Inputs that aren't cached by then are passed on as they are, and
+# keep downloading in the background.
+DEFAULT_WAIT_TIMEOUT = 30.0
+
+# Subdirectory of the cache holding the URL index: one file per URL, named by
+# the SHA-256 of the URL and containing the digest of its content, so that
+# cached inputs are found again after a restart.
+URLS_DIRECTORY = ".urls"
+
+# Number of concurrent background downloads.
+PREFETCH_WORKERS = 2
+
+# How many queued messages to look ahead at for inputs to prefetch, and how
+# often to look when not prompted, in seconds.
+PREFETCH_DEPTH = 2
+PREFETCH_INTERVAL = 5.0
+
+
+class InputCache:
+    """
+    Content-addressed disk cache of URL inputs. Inputs are downloaded once,
+    stored under the SHA-256 of their content, and handed to the model
+    container as URLs served by the director, so repeated inputs don't have
+    to be downloaded again by the model. The cache is bounded by total size
+    and evicts least recently used files, except those pinned by a running
+    prediction.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        base_url: str = DEFAULT_BASE_URL,
+        session: Optional[requests.Session] = None,
+        wait_timeout: float = DEFAULT_WAIT_TIMEOUT,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.wait_timeout = wait_timeout
+        self.base_url = base_url.rstrip("/")
+        self.session = session or requests.Session()
+
+        self._lock = threading.Lock()
+        # Digest -> size, least recently used first.
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        # SHA-256 of the URL -> digest of its content.
+        self._urls: Dict[str, str] = {}
+        self._pins: Dict[str, int] = {}
+        self._inflight: Dict[str, Future] = {}
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=PREFETCH_WORKERS, thread_name_prefix="input-prefetch"
+        )
+
+        os.makedirs(os.path.join(directory, URLS_DIRECTORY), exist_ok=True)
+        self._recover()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._files)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def path(self, digest: str) -> Optional[str]:
+        """
+        Path of the cached file with this digest, if there is one.
+        """
+        with self._lock:
+            if digest not in self._files:
+                return None
+            self._files.move_to_end(digest)
+        return os.path.join(self.directory, digest)
+
+    def rewrite(self, inputs: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+        """
+        Return a copy of `inputs` with URL values (including those in lists)
+        replaced by URLs of their cached copies, downloading them first if
+        needed, and the digests it pinned; pass those to `release` once the
+        prediction is done. URLs that can't be cached, or aren't within
+        `wait_timeout`, are left as they are.
+        """
+        pinned: List[str] = []
+        deadline = time.monotonic() + self.wait_timeout
+
+        def replace(value: Any) -> Any:
+            if not _is_url(value):
+                return value
+
+            digest = self._get(value, max(deadline - time.monotonic(), 0))
+            if digest is None:
+                return value
+
+            with self._lock:
+                if digest not in self._files:
+                    return value
+                self._pins[digest] = self._pins.get(digest, 0) + 1
+            pinned.append(digest)
+
+            filename = posixpath.basename(urlsplit(value).path) or "input"
+            return f"{self.base_url}/{digest}/{quote(filename)}"
+
+        rewritten = {}
+        for key, value in inputs.items():
+            if isinstance(value, list):
+                rewritten[key] = [replace(v) for v in value]
+            else:
+                rewritten[key] = replace(value)
+
+        return rewritten, pinned
+
+    def release(self, digests: List[str]) -> None:
+        with self._lock:
+            for digest in digests:
+                count = self._pins.get(digest, 0) - 1
+                if count > 0:
+                    self._pins[digest] = count
+                else:
+                    self._pins.pop(digest, None)
+            self._evict()
+
+    def prefetch(self, inputs: Dict[str, Any]) -> None:
+        """
+        Start downloading any URL inputs that aren't cached yet, without
+        waiting for them.
+        """
+        for value in inputs.values():
+            for v in value if isinstance(value, list) else [value]:
+                if _is_url(v):
+                    self._submit(v)
+
+    def _get(self, url: str, timeout: float) -> Optional[str]:
+        try:
+            return self._submit(url).result(timeout=timeout)
+        except FutureTimeoutError:
+            log.warn("input not cached in time", url=_redact(url))
+            return None
+        except Exception as e:
+            log.warn("cannot cache input", url=_redact(url), error=type(e).__name__)
+            return None
+
+    def _submit(self, url: str) -> Future:
+        with self._lock:
+            digest = self._urls.get(_url_key(url))
+            if digest is not None and digest in self._files:
+                self._files.move_to_end(digest)
+                future: Future = Future()
+                future.set_result(digest)
+                return future
+
+            if url in self._inflight:
+                return self._inflight[url]
+
+            future = self._executor.submit(self._download, url)
+            self._inflight[url] = future
+            return future
+
+    def _download(self, url: str) -> str:
+        try:
+            digest, size = self._fetch(url)
+        except BaseException:
+            with self._lock:
+                self._inflight.pop(url, None)
+            raise
+
+        with self._lock:
+            if digest not in self._files:
+                self._files[digest] = size
+                self._size += size
+            self._files.move_to_end(digest)
+            self._urls[_url_key(url)] = digest
+            self._inflight.pop(url, None)
+            self._evict(keep=digest)
+
+        self._index(url, digest)
+
+        log.info("cached input", url=_redact(url), digest=digest, size=size)
+        return digest
+
+    def _fetch(self, url: str) -> Tuple[str, int]:
+        h = hashlib.sha256()
+        size = 0
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".download-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                with self.session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        h.update(chunk)
+                        size += len(chunk)
+
+                        if size > self.max_bytes:
+                            raise ValueError("input is larger than the cache")
+
+            digest = h.hexdigest()
+            os.replace(tmp, os.path.join(self.directory, digest))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        return digest, size
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        # Called with the lock held. `keep` protects a file that was just
+        # downloaded but isn't pinned yet.
+        for digest in list(self._files):
+            if self._size <= self.max_bytes:
+                break
+            if digest in self._pins or digest == keep:
+                continue
+
+            size = self._files.pop(digest)
+            self._size -= size
+            try:
+                os.unlink(os.path.join(self.directory, digest))
+            except FileNotFoundError:
+                pass
+
+        stale = [key for key, digest in self._urls.items() if digest not in self._files]
+        for key in stale:
+            del self._urls[key]
+            try:
+                os.unlink(os.path.join(self.directory, URLS_DIRECTORY, key))
+            except FileNotFoundError:
+                pass
+
+    def _index(self, url: str, digest: str) -> None:
+        key = _url_key(url)
+        path = os.path.join(self.directory, URLS_DIRECTORY, key)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".index-")
+            with os.fdopen(fd, "w") as f:
+                f.write(digest)
+            os.replace(tmp, path)
+        except OSError:
+            log.warn("cannot index cached input", url=_redact(url), exc_info=True)
+
+    def _recover(self) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name == URLS_DIRECTORY:
+                continue
+            if name.startswith(".download-"):
+                os.unlink(path)
+                continue
+
+            stat = os.stat(path)
+            entries.append((stat.st_atime, name, stat.st_size))
+
+        for _, digest, size in sorted(entries):
+            self._files[digest] = size
+            self._size += size
+
+        urls_directory = os.path.join(self.directory, URLS_DIRECTORY)
+        for key in os.listdir(urls_directory):
+            path = os.path.join(urls_directory, key)
+            if key.startswith(".index-"):
+                os.unlink(path)
+                continue
+            with open(path) as f:
+                self._urls[key] = f.read().strip()
+
+        # Also drops index entries of files that didn't survive.
+        self._evict()
+        if self._files:
+            log.info(
+                "recovered input cache",
+                files=len(self._files),
+                urls=len(self._urls),
+                size=self._size,
+            )
+
+
+class InputPrefetcher:
+    """
+    Looks ahead at the next messages in the consumed queue and prefetches
+    their inputs into the cache, so that downloads overlap with the running
+    prediction. Looking ahead is only possible on the Redis transport.
+    """
+
+    def __init__(
+        self,
+        *,
+        cache: InputCache,
+        redis_url: str,
+        queue: Callable[[], Optional[str]],
+        depth: int = PREFETCH_DEPTH,
+        interval: float = PREFETCH_INTERVAL,
+    ):
+        self._cache = cache
+        self._redis_url = redis_url
+        self._queue = queue
+        self._depth = depth
+        self._interval = interval
+
+        self._thread: Optional[threading.Thread] = None
+        self._should_exit = threading.Event()
+        self._wakeup = threading.Event()
+        self._seen: Set[str] = set()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._should_exit.set()
+        self._wakeup.set()
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def trigger(self) -> None:
+        """
+        Look ahead now, e.g. because a message was just taken off the queue.
+        """
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while not self._should_exit.is_set():
+            try:
+                with Connection(self._redis_url) as conn:
+                    while not self._should_exit.is_set():
+                        self._prefetch(conn)
+                        self._wakeup.wait(self._interval)
+                        self._wakeup.clear()
+
+            except Exception:
+                log.error("failed to prefetch inputs", exc_info=True)
+                self._should_exit.wait(self._interval)
+
+        log.info("shutting down input prefetcher")
+
+    def _prefetch(self, conn: Connection) -> None:
+        queue = self._queue()
+        if not queue:
+            return
+
+        seen = set()
+        for body in peek_messages(conn.default_channel, queue, count=self._depth):
+            prediction_id = body.get("id")
+            seen.add(prediction_id)
+            if prediction_id in self._seen:
+                continue
+
+            inputs = body.get("input")
+            if isinstance(inputs, dict):
+                self._cache.prefetch(inputs)
+
+        self._seen = seen
+
+
+def _is_url(value: Any) -> bool:
+    return isinstance(value, str) and value.startswith(("http://", "https://"))
+
+
+def _url_key(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _redact(url: str) -> str:
+    # Presigned URLs carry credentials in their query string.
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path}"
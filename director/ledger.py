@@ -0,0 +1,69 @@
+import json
+import redis
+import structlog
+
+from typing import Any, Dict, Optional
+
+log = structlog.get_logger(__name__)
+
+# How long to remember completed predictions by default, in seconds. This
+# only needs to outlast redelivery of an unacknowledged message.
+DEFAULT_TTL = 24 * 60 * 60
+
+# Terminal states bigger than this when encoded, in bytes, are recorded
+# without their payload: the prediction is still known to be complete, but
+# its state can't be re-sent.
+MAX_PAYLOAD_SIZE = 256 * 1024
+
+KEY_PREFIX = "director:completed:"
+
+
+class CompletionLedger:
+    """
+    Records, per prediction ID, that a prediction's terminal webhook was
+    delivered. If the director dies before acknowledging the message, the
+    message is redelivered; the ledger lets whichever worker gets it re-send
+    the terminal state instead of running the prediction again.
+    """
+
+    def __init__(self, redis_url: str, ttl: float = DEFAULT_TTL):
+        self.ttl = ttl
+        self._redis = redis.Redis.from_url(redis_url)
+
+    def warm(self) -> None:
+        """
+        Connect to Redis ahead of the first lookup.
+        """
+        try:
+            self._redis.ping()
+        except redis.RedisError:
+            log.info("failed to connect ahead of time", exc_info=True)
+
+    def record(self, prediction_id: str, payload: Dict[str, Any]) -> None:
+        encoded = json.dumps({"payload": payload})
+        if len(encoded) > MAX_PAYLOAD_SIZE:
+            encoded = json.dumps({"payload": None})
+
+        try:
+            self._redis.set(
+                KEY_PREFIX + prediction_id, encoded, px=max(int(self.ttl * 1000), 1)
+            )
+        except redis.RedisError:
+            log.warn("failed to record completed prediction", exc_info=True)
+
+    def lookup(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the ledger entry for a completed prediction: a dict with its
+        terminal "payload" (None if it was too big to keep), or None if the
+        prediction isn't known to have completed.
+        """
+        try:
+            encoded = self._redis.get(KEY_PREFIX + prediction_id)
+        except redis.RedisError:
+            # Running a prediction twice beats not running it at all.
+            log.warn("failed to look up completed prediction", exc_info=True)
+            return None
+
+        if encoded is None:
+            return None
+        return json.loads(encoded)
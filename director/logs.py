@@ -0,0 +1,214 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+import structlog
+
+from collections import OrderedDict
+from cog.logging import replace_level_with_severity
+from cog.logging import setup_logging as cog_setup_logging
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Tuple
+
+# By default a call site (a logger and message) may log this many events per
+# window, in seconds. Anything beyond that is dropped and counted, and the
+# count is attached to the next event that gets through. Warnings and errors
+# are exempt. Call sites can pass `rate_limit=<seconds>` to log at most once
+# per that many seconds instead, whatever the level.
+DEFAULT_RATE_LIMIT = 50
+DEFAULT_RATE_WINDOW = 10.0
+
+# How many call sites the rate limiter keeps track of. Messages are meant to
+# be constant, but one that isn't would otherwise add a call site per event;
+# beyond this the least recently used ones are forgotten.
+MAX_RATE_LIMITED_SITES = 1024
+
+# String fields longer than this, in characters, are truncated.
+MAX_FIELD_LENGTH = 2048
+
+# How many records may wait for the writer thread. Beyond that records are
+# dropped rather than blocking the thread that logs them.
+MAX_QUEUED_RECORDS = 10000
+
+
+class RateLimiter:
+    """
+    Structlog processor that limits how often each call site can log. Call
+    sites are told apart by logger name and message, so messages should be
+    constant strings with variable parts passed as fields.
+    """
+
+    EXEMPT_METHODS = {"warn", "warning", "error", "exception", "critical", "fatal"}
+
+    def __init__(
+        self,
+        limit: int = DEFAULT_RATE_LIMIT,
+        window: float = DEFAULT_RATE_WINDOW,
+        max_sites: int = MAX_RATE_LIMITED_SITES,
+    ):
+        self.limit = limit
+        self.window = window
+        self.max_sites = max_sites
+
+        self._lock = threading.Lock()
+        # call site -> [window start, events in window, events dropped], least
+        # recently logged first
+        self._sites: "OrderedDict[Tuple[str, Any], list]" = OrderedDict()
+
+    def __call__(self, logger: Any, method_name: str, event_dict: Dict) -> Dict:
+        interval = event_dict.pop("rate_limit", None)
+        if interval is not None:
+            limit, window = 1, interval
+        elif method_name in self.EXEMPT_METHODS:
+            return event_dict
+        else:
+            limit, window = self.limit, self.window
+
+        site = (getattr(logger, "name", ""), event_dict.get("event"))
+        now = time.monotonic()
+        with self._lock:
+            state = self._sites.get(site)
+            if state is None:
+                state = self._sites[site] = [now, 0, 0]
+                if len(self._sites) > self.max_sites:
+                    self._sites.popitem(last=False)
+            else:
+                self._sites.move_to_end(site)
+            if now - state[0] >= window:
+                state[0], state[1] = now, 0
+            if state[1] >= limit:
+                state[2] += 1
+                raise structlog.DropEvent
+            state[1] += 1
+            suppressed, state[2] = state[2], 0
+
+        if suppressed:
+            event_dict["suppressed"] = suppressed
+        return event_dict
+
+
+def truncate_fields(logger: Any, method_name: str, event_dict: Dict) -> Dict:
+    for key, value in event_dict.items():
+        if isinstance(value, str) and len(value) > MAX_FIELD_LENGTH:
+            event_dict[key] = _truncate(value)
+    return event_dict
+
+
+def _truncate(value: str) -> str:
+    if len(value) <= MAX_FIELD_LENGTH:
+        return value
+    return f"{value[:MAX_FIELD_LENGTH]}... ({len(value)} characters)"
+
+
+def capture_exc_info(logger: Any, method_name: str, event_dict: Dict) -> Dict:
+    # The exception being handled is only known on the thread that logs it,
+    # but it's formatted on the writer thread.
+    exc_info = event_dict.get("exc_info")
+    if exc_info and not isinstance(exc_info, (tuple, BaseException)):
+        event_dict["exc_info"] = sys.exc_info()
+    return event_dict
+
+
+class _Deferred:
+    """
+    Runs processors on the writer thread, as part of formatting, for events
+    logged through structlog. Other records already went through them.
+    """
+
+    def __init__(self, processors: List[Callable]):
+        self.processors = processors
+
+    def __call__(self, logger: Any, method_name: str, event_dict: Dict) -> Dict:
+        if not event_dict.get("_from_structlog"):
+            return event_dict
+        for processor in self.processors:
+            event_dict = processor(logger, method_name, event_dict)
+        return event_dict
+
+
+def _record_timestamper(key: str) -> Callable:
+    # Like TimeStamper(fmt="iso"), but with the time the record was created
+    # rather than formatted.
+    def stamp(logger: Any, method_name: str, event_dict: Dict) -> Dict:
+        record = event_dict.get("_record")
+        created = record.created if record is not None else time.time()
+        at = datetime.fromtimestamp(created, tz=timezone.utc)
+        event_dict[key] = at.isoformat().replace("+00:00", "Z")
+        return event_dict
+
+    return stamp
+
+
+def _split_processors(processors: List[Callable]) -> Tuple[List, List]:
+    """
+    Split cog's processors into those that have to run on the thread that
+    logs, and those that can wait for the writer thread: timestamping,
+    exception formatting and renaming fields.
+    """
+    immediate, deferred = [], []
+    for processor in processors:
+        if isinstance(processor, structlog.processors.TimeStamper):
+            deferred.append(_record_timestamper(processor.key))
+        elif processor in (
+            structlog.processors.format_exc_info,
+            replace_level_with_severity,
+        ) or isinstance(processor, structlog.processors.EventRenamer):
+            deferred.append(processor)
+        elif processor is structlog.stdlib.ProcessorFormatter.wrap_for_formatter:
+            immediate.append(capture_exc_info)
+            immediate.append(processor)
+        else:
+            immediate.append(processor)
+    return immediate, deferred
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting is left to the writer thread. Records don't leave the
+        # process, so they don't need to be made picklable either.
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup_logging(*, log_level: int = logging.NOTSET) -> logging.handlers.QueueListener:
+    """
+    Configure logging like cog does, but cheaper for the threads that log:
+    events below the log level are dropped before any processing, call sites
+    are rate limited, large fields are truncated, and timestamping,
+    formatting and writing happen on a separate thread. Returns the listener
+    running that thread, which should be stopped on shutdown to flush what's
+    left.
+    """
+    cog_setup_logging(log_level=log_level)
+
+    immediate, deferred = _split_processors(structlog.get_config()["processors"])
+    structlog.configure(
+        processors=[
+            structlog.stdlib.filter_by_level,
+            RateLimiter(),
+            truncate_fields,
+            *immediate,
+        ]
+    )
+
+    root = logging.getLogger()
+    for handler in root.handlers:
+        formatter = handler.formatter
+        if isinstance(formatter, structlog.stdlib.ProcessorFormatter):
+            formatter.processors = [_Deferred(deferred), *formatter.processors]
+
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue(MAX_QUEUED_RECORDS)
+    listener = logging.handlers.QueueListener(
+        records, *root.handlers, respect_handler_level=True
+    )
+    root.handlers = [_QueueHandler(records)]
+    listener.start()
+
+    return listener
@@ -0,0 +1,100 @@
+import tracemalloc
+import structlog
+
+from typing import Any, Dict, List, Optional
+
+log = structlog.get_logger(__name__)
+
+# How many predictions between reports of where memory grew since the start.
+DEFAULT_REPORT_EVERY = 100
+
+# How many allocation sites to include in those reports.
+DEFAULT_TOP = 10
+
+
+class MemoryTracker:
+    """
+    Per-prediction memory accounting with tracemalloc, for soak runs. For
+    every prediction it logs the peak traced memory above where it started
+    and how much of it was retained afterwards, and every so often the
+    allocation sites that grew the most since tracking started.
+
+    Tracing slows allocations down considerably, so this is only meant for
+    soak and load tests, e.g. by running with PYTHONTRACEMALLOC=1.
+    """
+
+    def __init__(
+        self,
+        frames: int = 1,
+        report_every: int = DEFAULT_REPORT_EVERY,
+        top: int = DEFAULT_TOP,
+    ):
+        self.frames = frames
+        self.report_every = report_every
+        self.top = top
+
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._first: Optional[int] = None
+        self._started_at = 0
+        self._peaks: List[int] = []
+        self._retained: List[int] = []
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self._baseline = _snapshot()
+
+    def prediction_started(self) -> None:
+        tracemalloc.reset_peak()
+        self._started_at, _ = tracemalloc.get_traced_memory()
+        if self._first is None:
+            self._first = self._started_at
+
+    def prediction_finished(self, prediction_id: str) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        self._peaks.append(peak - self._started_at)
+        self._retained.append(current - self._started_at)
+
+        log.info(
+            "prediction memory",
+            prediction_id=prediction_id,
+            peak=peak - self._started_at,
+            retained=current - self._started_at,
+            traced=current,
+            growth=current - (self._first or 0),
+        )
+
+        if self.report_every and len(self._peaks) % self.report_every == 0:
+            self.report()
+
+    def report(self) -> None:
+        if self._baseline is None:
+            return
+
+        stats = _snapshot().compare_to(self._baseline, "lineno")
+        log.info(
+            "memory growth since start",
+            predictions=len(self._peaks),
+            top=[str(stat) for stat in stats[: self.top]],
+        )
+
+    def summary(self) -> Dict[str, Any]:
+        current, _ = tracemalloc.get_traced_memory()
+        peaks = sorted(self._peaks)
+        return {
+            "predictions": len(peaks),
+            "peak_p50": peaks[len(peaks) // 2] if peaks else None,
+            "peak_max": peaks[-1] if peaks else None,
+            "retained_max": max(self._retained) if self._retained else None,
+            "traced": current,
+            "growth": current - (self._first or current),
+        }
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ]
+    )
@@ -1,3 +1,4 @@
+import functools
 import os
 import threading
 import time
@@ -8,10 +9,11 @@ from queue import Empty, Full, Queue
 from typing import Optional
 from opentelemetry import trace
 
-
 log = structlog.get_logger(__name__)
 
 
+# The environment doesn't change while running, and these go on every span.
+@functools.lru_cache(maxsize=None)
 def span_attributes_from_env():
     return {
         "hostname": os.environ.get("HOSTNAME", ""),
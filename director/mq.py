@@ -6,8 +6,68 @@ from kombu import Connection, Queue
 
 log = structlog.get_logger(__name__)
 
+# How long a single drain blocks waiting for a message, in seconds. Kept short
+# so that queue switches and aborts are noticed promptly; draining again while
+# a fetch is already in flight doesn't issue another Redis command.
+DRAIN_INTERVAL = 0.1
+
+# How often to run the pre-message hook while idle, in seconds. It always runs
+# before the first drain and after every handled message.
+PRE_MESSAGE_INTERVAL = 1.0
+
 
 class RedisConsumer:
+    """
+    Consumes a single queue. Connecting (which also declares the queue and
+    registers the consumer) is separate from consuming, so that it can be
+    done ahead of time: no message is fetched until `consume` is called.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._consumer = None
+        self._queue = None
+
+    def connect(self, redis_url, queue, on_message):
+        log.info(f"Connecting to redis queue: {queue}")
+
+        conn = Connection(redis_url)
+        try:
+            conn.connect()
+
+            client = getattr(conn.default_channel, "client", None)
+            if client is not None:
+                client.ping()
+
+            consumer = conn.Consumer(
+                Queue(queue, routing_key=queue),
+                callbacks=[on_message],
+                prefetch_count=1,
+            )
+            consumer.consume()
+        except Exception:
+            conn.release()
+            raise
+
+        self._conn = conn
+        self._consumer = consumer
+        self._queue = queue
+
+    def connected(self, queue):
+        return self._conn is not None and self._queue == queue
+
+    def close(self):
+        if self._consumer is not None:
+            try:
+                self._consumer.cancel()
+            except Exception:
+                log.warn("Cannot cancel consumer.", exc_info=True)
+        if self._conn is not None:
+            self._conn.release()
+
+        self._conn = None
+        self._consumer = None
+        self._queue = None
 
     def consume(
         self,
@@ -20,51 +80,62 @@ class RedisConsumer:
         on_start_consume=None,
         timeout=30,
     ):
-        log.info(f"Connecting to redis queue: {queue} with timeout {timeout}")
-
-        with Connection(redis_url) as conn:
-            # Auto failover - drain every second to avoid broken connection.
-            # Consumer will break on should_exit or idle for timeout interval.
-            def consume():
-                if on_start_consume is not None:
-                    on_start_consume()
-
-                mark = time.perf_counter()
-                while True:
-                    try:
-                        if on_pre_message is not None:
-                            on_pre_message()
-
-                        conn.drain_events(timeout=1)
-
-                        # Update mark after message handled.
-                        mark = time.perf_counter()
-
-                    except socket.timeout:
-                        pass
-
-                    is_timeout = timeout > 0 and time.perf_counter() - mark >= timeout
-                    is_aborted = aborted is not None and aborted()
-                    if is_timeout or is_aborted:
-                        log.warn(
-                            "Consumer exiting.",
-                            is_timeout=is_timeout,
-                            is_aborted=is_aborted,
-                        )
-                        break
-
-                    is_switched = switched is not None and switched()
-                    if is_switched:
-                        log.warn("Consumer switched.")
-                        break
-
-            with conn.Consumer(
-                Queue(queue, routing_key=queue),
-                callbacks=[on_message],
-                prefetch_count=1,
-            ):
+        log.info(f"Consuming redis queue: {queue} with timeout {timeout}")
+
+        # Reuse the connection made by `connect` if it's for this queue.
+        if not self.connected(queue):
+            self.close()
+            self.connect(redis_url, queue, on_message)
+
+        conn = self._conn
+
+        # Auto failover - drain every second to avoid broken connection.
+        # Consumer will break on should_exit or idle for timeout interval.
+        def consume():
+            if on_start_consume is not None:
+                on_start_consume()
+
+            mark = time.perf_counter()
+            pre_message_at = None
+            while True:
                 try:
-                    conn.ensure(conn, consume)()
+                    now = time.perf_counter()
+                    if on_pre_message is not None and (
+                        pre_message_at is None
+                        or now - pre_message_at >= PRE_MESSAGE_INTERVAL
+                    ):
+                        on_pre_message()
+                        pre_message_at = now
+
+                    conn.drain_events(timeout=DRAIN_INTERVAL)
+
+                    # Update mark after message handled.
+                    mark = time.perf_counter()
+                    pre_message_at = None
+
+                except socket.timeout:
+                    pass
+
+                is_timeout = timeout > 0 and time.perf_counter() - mark >= timeout
+                is_aborted = aborted is not None and aborted()
+                if is_timeout or is_aborted:
+                    log.warn(
+                        "Consumer exiting.",
+                        is_timeout=is_timeout,
+                        is_aborted=is_aborted,
+                    )
+                    break
+
+                is_switched = switched is not None and switched()
+                if is_switched:
+                    log.warn("Consumer switched.")
+                    break
+
+        try:
+            conn.ensure(conn, consume)()
+
+        except Exception as e:
+            log.error("Exception on consumer.", error=e)
 
-                except Exception as e:
-                    log.error("Exception on consumer.", error=e)
+        finally:
+            self.close()
@@ -16,6 +16,22 @@ ALLOWED_FIELDS_FROM_UNTRUSTED_CONTAINER = (
     "status",
 )
 
+# Phases of a prediction's life, in the order they are expected to happen. The
+# tracker records a wall-clock timestamp for each of them the first time it is
+# reached. "health_confirmed" is when the model container was confirmed ready
+# while waiting for the message, and is missing if it wasn't (e.g. for the
+# first message after setup). "uploaded" and "webhook_delivered" happen after
+# the tracker reaches a terminal state and are recorded by the webhook caller.
+PHASES = (
+    "health_confirmed",
+    "dequeued",
+    "create_accepted",
+    "first_webhook",
+    "output_complete",
+    "uploaded",
+    "webhook_delivered",
+)
+
 
 class PredictionMismatchError(Exception):
     pass
@@ -26,15 +42,39 @@ class PredictionTracker:
         self,
         response: schema.PredictionResponse,
         webhook_caller: Optional[Callable] = None,
+        on_phase: Optional[Callable[[str, datetime], None]] = None,
     ):
         self._webhook_caller = webhook_caller
+        self._on_phase = on_phase
         self._response = response
         self._timed_out = False
+        self._cache_hit = False
+        self._expired = False
+        self._phases: Dict[str, datetime] = {}
 
     def start(self) -> None:
         self._response.status = schema.Status.PROCESSING
         self._response.started_at = datetime.now(tz=timezone.utc)
 
+    def mark(self, phase: str, at: Optional[datetime] = None) -> None:
+        """
+        Record the time at which the prediction reached `phase`. Only the first
+        occurrence of each phase is kept.
+        """
+        if phase not in PHASES:
+            raise ValueError(f"unknown prediction phase: {phase}")
+        if phase in self._phases:
+            return
+
+        at = at or datetime.now(tz=timezone.utc)
+        self._phases[phase] = at
+        if self._on_phase:
+            self._on_phase(phase, at)
+
+    @property
+    def phases(self) -> Dict[str, datetime]:
+        return dict(self._phases)
+
     def is_complete(self) -> bool:
         return schema.Status.is_terminal(self._response.status)
 
@@ -48,8 +88,29 @@ class PredictionTracker:
                 f"received webhook payload for {payload.id} while tracking {self._response.id}"
             )
 
+        self.mark("first_webhook")
+        if schema.Status.is_terminal(payload.status):
+            self.mark("output_complete")
+
         self._update(allowed_fields(payload.dict()))
 
+    def complete_from_cache(self, result: Dict[str, Any]) -> None:
+        """
+        Complete the prediction with the result of an earlier, identical one,
+        without involving the model container.
+        """
+        self._cache_hit = True
+        self.mark("output_complete")
+        self._update({**allowed_fields(result), "status": schema.Status.SUCCEEDED})
+
+    def expire(self) -> None:
+        """
+        Fail the prediction because its deadline passed before it could run,
+        without involving the model container.
+        """
+        self._expired = True
+        self.fail("Prediction expired before it could run")
+
     def fail(self, message: Any) -> None:
         payload = {
             "status": schema.Status.FAILED,
@@ -95,7 +156,14 @@ class PredictionTracker:
 
         if schema.Status.is_terminal(self._response.status):
             self._response.completed_at = datetime.now(tz=timezone.utc)
-            self._response.metrics = {"exec_time": self.runtime}
+            self._response.metrics = {
+                "exec_time": self.runtime,
+                **self._phase_metrics(),
+            }
+            if self._cache_hit:
+                self._response.metrics["cache_hit"] = True
+            if self._expired:
+                self._response.metrics["expired"] = True
 
             if (
                 self._response.status == schema.Status.SUCCEEDED
@@ -103,6 +171,28 @@ class PredictionTracker:
             ):
                 self._response.status = schema.Status.FAILED
 
+    def _phase_metrics(self) -> Dict[str, Any]:
+        metrics: Dict[str, Any] = {
+            "timestamps": {phase: at.timestamp() for phase, at in self._phases.items()},
+        }
+
+        created_at = self._response.created_at
+        if created_at and created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        dequeued_at = self._phases.get("dequeued")
+        accepted_at = self._phases.get("create_accepted")
+
+        # Time spent sitting in the queue before this director picked it up.
+        if created_at and dequeued_at:
+            metrics["queue_time"] = (dequeued_at - created_at).total_seconds()
+
+        # Time the director spent between dequeuing the message and the model
+        # container accepting the prediction.
+        if dequeued_at and accepted_at:
+            metrics["director_overhead"] = (accepted_at - dequeued_at).total_seconds()
+
+        return metrics
+
     def _send_webhook(self) -> None:
         if not self._webhook_caller:
             return
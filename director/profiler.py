@@ -0,0 +1,205 @@
+import collections
+import os
+import sys
+import threading
+import structlog
+
+from typing import Any, Counter, Dict, Iterable, Optional, Set
+
+log = structlog.get_logger(__name__)
+
+# How often to sample thread stacks by default, in seconds.
+DEFAULT_INTERVAL = 0.01
+
+DEFAULT_OUTPUT = "/tmp/director-profile.folded"
+
+
+class SamplingProfiler:
+    """
+    Low-overhead statistical profiler over all director threads. A background
+    thread periodically snapshots every thread's stack with
+    `sys._current_frames()` and counts identical stacks. Results are in the
+    "folded" format understood by flamegraph.pl, speedscope and friends: one
+    line per distinct stack, frames separated by semicolons, then a count.
+
+    Besides profiling everything between `start` and `stop`, the profiler can
+    be restricted to selected predictions, in which case it only samples while
+    one of them is running and writes one file per prediction.
+    """
+
+    def __init__(
+        self,
+        interval: float = DEFAULT_INTERVAL,
+        output: str = DEFAULT_OUTPUT,
+        predictions: Iterable[str] = (),
+    ):
+        self.interval = interval
+        self.output = output
+        self.predictions: Set[str] = set(predictions)
+
+        self._lock = threading.Lock()
+        self._counts: Counter[str] = collections.Counter()
+        self._samples = 0
+        self._thread: Optional[threading.Thread] = None
+        self._should_exit = threading.Event()
+        self._current_prediction: Optional[str] = None
+
+        # Serializes starting and stopping, which happen on the main thread
+        # (per prediction) and on the watcher thread (on request).
+        self._control_lock = threading.Lock()
+        self._toggle_requested = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls) -> "SamplingProfiler":
+        predictions = os.environ.get("DIRECTOR_PROFILE_PREDICTIONS", "")
+        return cls(
+            interval=float(
+                os.environ.get("DIRECTOR_PROFILE_INTERVAL", DEFAULT_INTERVAL)
+            ),
+            output=os.environ.get("DIRECTOR_PROFILE_OUTPUT", DEFAULT_OUTPUT),
+            predictions=[p for p in predictions.split(",") if p],
+        )
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """
+        Start sampling, if not already running.
+        """
+        if self.running:
+            return
+
+        log.info("starting sampling profiler", interval=self.interval)
+        self._should_exit.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop sampling and wait for the sampling thread to finish.
+        """
+        if not self.running:
+            return
+
+        self._should_exit.set()
+        assert self._thread is not None
+        self._thread.join()
+        log.info("stopped sampling profiler", samples=self._samples)
+
+    def toggle(self) -> None:
+        """
+        Start the profiler if it's stopped; otherwise stop it and write out
+        what was collected.
+        """
+        with self._control_lock:
+            if self.running:
+                self.stop()
+                self.write()
+            else:
+                self.reset()
+                self.start()
+
+    def watch(self) -> None:
+        """
+        Start a thread that calls `toggle` whenever `request_toggle` is.
+        """
+        self._watcher = threading.Thread(
+            target=self._watch, name="profiler-watcher", daemon=True
+        )
+        self._watcher.start()
+
+    def request_toggle(self, *args: Any) -> None:
+        """
+        Ask the watcher thread to `toggle` the profiler. Suitable as a signal
+        handler: the signal may interrupt the main thread while it holds the
+        profiler's locks, so this only sets an event.
+        """
+        self._toggle_requested.set()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts.clear()
+            self._samples = 0
+
+    def folded(self) -> str:
+        with self._lock:
+            lines = [f"{stack} {count}" for stack, count in self._counts.items()]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "running": self.running,
+                "samples": self._samples,
+                "stacks": len(self._counts),
+                "interval": self.interval,
+                "predictions": sorted(self.predictions),
+            }
+
+    def write(self, path: Optional[str] = None) -> str:
+        path = path or self.output
+        with open(path, "w") as f:
+            f.write(self.folded())
+        log.info("wrote profile", path=path, samples=self._samples)
+        return path
+
+    def prediction_started(self, prediction_id: str) -> None:
+        with self._control_lock:
+            if prediction_id not in self.predictions or self.running:
+                return
+
+            self._current_prediction = prediction_id
+            self.reset()
+            self.start()
+
+    def prediction_finished(self, prediction_id: str) -> None:
+        with self._control_lock:
+            if prediction_id != self._current_prediction:
+                return
+
+            self._current_prediction = None
+            self.predictions.discard(prediction_id)
+            self.stop()
+
+            root, ext = os.path.splitext(self.output)
+            self.write(f"{root}-{prediction_id}{ext}")
+
+    def _watch(self) -> None:
+        while True:
+            self._toggle_requested.wait()
+            self._toggle_requested.clear()
+            try:
+                self.toggle()
+            except Exception:
+                log.error("failed to toggle sampling profiler", exc_info=True)
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+
+        while not self._should_exit.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stacks.append(_fold(names.get(thread_id, str(thread_id)), frame))
+
+            with self._lock:
+                self._counts.update(stacks)
+                self._samples += 1
+
+
+def _fold(thread_name: str, frame: Any) -> str:
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        frames.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+        frame = frame.f_back
+
+    frames.append(thread_name)
+    frames.reverse()
+    return ";".join(frames)
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import threading
+import time
+import redis
+import structlog
+
+from collections import OrderedDict
+from opentelemetry import metrics
+from typing import Any, Dict, Optional, Tuple
+
+log = structlog.get_logger(__name__)
+
+# Defaults for the local tier: how many results to keep, and for how long, in
+# seconds.
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 60 * 60
+
+# Results bigger than this when encoded, in bytes, aren't cached. That's
+# mostly outputs that weren't uploaded and are still inline data URLs.
+MAX_ENTRY_SIZE = 1024 * 1024
+
+# Prefix of the keys in the shared Redis tier.
+REDIS_KEY_PREFIX = "director:result:"
+
+# Fields of a terminal prediction state that are worth replaying.
+CACHED_FIELDS = ("output", "logs")
+
+# Upload parameters that decide where outputs end up. Credentials aren't
+# included: they don't change the URLs in the result.
+UPLOAD_KEY_FIELDS = ("url", "bucket", "url_prefix", "path_prefix", "object_key")
+
+
+def cache_key(message: Dict[str, Any]) -> str:
+    """
+    Canonical hash of what determines a prediction's result: the model
+    version, the input, and where its outputs are uploaded to (so that a
+    cached result never points at another destination's objects).
+    """
+    upload = message.get("upload") or {}
+    identity = {
+        "version": message.get("version"),
+        "input": message.get("input"),
+        "upload": {k: upload.get(k) for k in UPLOAD_KEY_FIELDS},
+        "presigned": _presigned_destinations(upload),
+        "transforms": upload.get("transforms"),
+    }
+    encoded = json.dumps(identity, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def _presigned_destinations(upload: Dict[str, Any]) -> Any:
+    # Presigned requests are signed per message, so only where they point is
+    # part of the key.
+    puts = upload.get("presigned_puts")
+    if puts is not None:
+        return [
+            put.get("public_url") or str(put.get("url", "")).split("?", 1)[0]
+            for put in puts
+        ]
+
+    post = upload.get("presigned_post")
+    if post is not None:
+        return [post.get("url"), (post.get("fields") or {}).get("key")]
+
+    return None
+
+
+class ResultCache:
+    """
+    Cache of successful prediction results for deterministic models, so that
+    repeated inputs don't run the model again. There is a bounded local tier
+    with a TTL and, optionally, a tier in Redis shared by all workers.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: float = DEFAULT_TTL,
+        redis_url: Optional[str] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._redis = redis.Redis.from_url(redis_url) if redis_url else None
+
+        meter = metrics.get_meter("cog-director")
+        self._hits = meter.create_counter(
+            "director.result_cache.hits",
+            description="Predictions answered from the result cache",
+        )
+        self._misses = meter.create_counter(
+            "director.result_cache.misses",
+            description="Predictions not found in the result cache",
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def warm(self) -> None:
+        """
+        Connect to Redis ahead of the first lookup, if results are shared.
+        """
+        if self._redis is None:
+            return
+        try:
+            self._redis.ping()
+        except redis.RedisError:
+            log.info("failed to connect ahead of time", exc_info=True)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        result = self._get_local(key)
+        tier = "local"
+
+        if result is None and self._redis is not None:
+            result = self._get_shared(key)
+            tier = "redis"
+            if result is not None:
+                self._put_local(key, result)
+
+        if result is None:
+            self._misses.add(1)
+        else:
+            self._hits.add(1, {"tier": tier})
+        return result
+
+    def put(self, key: str, state: Dict[str, Any]) -> None:
+        result = {k: state.get(k) for k in CACHED_FIELDS}
+        encoded = json.dumps(result)
+        if len(encoded) > MAX_ENTRY_SIZE:
+            log.info("result too large to cache", size=len(encoded))
+            return
+
+        self._put_local(key, result)
+
+        if self._redis is not None:
+            try:
+                self._redis.set(
+                    REDIS_KEY_PREFIX + key, encoded, px=max(int(self.ttl * 1000), 1)
+                )
+            except redis.RedisError:
+                log.warn("failed to store result in redis", exc_info=True)
+
+    def _get_local(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, result = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return result
+
+    def _put_local(self, key: str, result: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_shared(self, key: str) -> Optional[Dict[str, Any]]:
+        assert self._redis is not None
+        try:
+            encoded = self._redis.get(REDIS_KEY_PREFIX + key)
+        except redis.RedisError:
+            log.warn("failed to look up result in redis", exc_info=True)
+            return None
+
+        if encoded is None:
+            return None
+        return json.loads(encoded)
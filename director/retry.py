@@ -0,0 +1,324 @@
+import collections
+import itertools
+import math
+import random
+import threading
+import time
+import structlog
+
+from attrs import define, field
+from concurrent.futures import ThreadPoolExecutor
+from opentelemetry import metrics
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from .circuit_breaker import CircuitBreaker
+
+log = structlog.get_logger(__name__)
+
+# Resolution of the timer wheel, in seconds, and the number of slots in it.
+# Delays longer than one revolution (tick * slots) wrap around.
+TICK = 0.1
+SLOTS = 512
+
+# Default retry policy: exponential backoff with full jitter.
+MAX_ATTEMPTS = 12
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.0
+
+# How many deliveries may be in flight to a single destination at once.
+CONCURRENCY = 4
+
+# How many delivery threads to run across all destinations.
+MAX_WORKERS = 8
+
+# How long to keep delivering outstanding work after stop() is called, in
+# seconds.
+SHUTDOWN_GRACE = 30.0
+
+
+@define
+class _Delivery:
+    destination: str
+    func: Callable[[], Any]
+    max_attempts: int
+    key: Optional[str] = None
+    on_success: Optional[Callable[[], None]] = None
+    on_give_up: Optional[Callable[[], None]] = None
+    seq: int = 0
+    attempts: int = 0
+    submitted_at: float = field(factory=time.monotonic)
+
+
+class _TimerWheel:
+    """
+    Hashed timer wheel: O(1) insertion, and each tick only looks at the items
+    in one slot.
+    """
+
+    def __init__(self, tick: float, slots: int):
+        self.tick = tick
+        self._slots: List[List[Tuple[int, Any]]] = [[] for _ in range(slots)]
+        self._cursor = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def schedule(self, item: Any, delay: float) -> None:
+        ticks = max(1, math.ceil(delay / self.tick))
+        rounds, offset = divmod(ticks - 1, len(self._slots))
+        slot = (self._cursor + 1 + offset) % len(self._slots)
+        self._slots[slot].append((rounds, item))
+        self._size += 1
+
+    def advance(self) -> List[Any]:
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        due = []
+        remaining = []
+        for rounds, item in self._slots[self._cursor]:
+            if rounds == 0:
+                due.append(item)
+            else:
+                remaining.append((rounds - 1, item))
+        self._slots[self._cursor] = remaining
+        self._size -= len(due)
+        return due
+
+
+class RetryScheduler:
+    """
+    Delivers calls to remote destinations without blocking the caller.
+    Failed calls are re-scheduled on a timer wheel with exponential backoff
+    and jitter instead of sleeping in the calling thread; each destination has
+    its own concurrency limit and circuit breaker, so one failing endpoint
+    doesn't hold up deliveries to healthy ones.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_attempts: int = MAX_ATTEMPTS,
+        backoff_base: float = BACKOFF_BASE,
+        backoff_max: float = BACKOFF_MAX,
+        concurrency: int = CONCURRENCY,
+        max_workers: int = MAX_WORKERS,
+    ):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.concurrency = concurrency
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._wheel = _TimerWheel(TICK, SLOTS)
+        self._ready: Dict[str, Deque[_Delivery]] = collections.defaultdict(
+            collections.deque
+        )
+        self._inflight: Dict[str, int] = collections.defaultdict(int)
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latest: Dict[str, int] = {}
+        self._seq = itertools.count(1)
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="delivery"
+        )
+        self._thread: Optional[threading.Thread] = None
+        self._stopping_at: Optional[float] = None
+
+        meter = metrics.get_meter("cog-director")
+        self._retries = meter.create_counter(
+            "director.delivery.retries",
+            description="Deliveries re-scheduled after a failed attempt",
+        )
+        self._give_ups = meter.create_counter(
+            "director.delivery.give_ups",
+            description="Deliveries abandoned after exhausting their attempts",
+        )
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Trigger the termination of the scheduler thread. Outstanding
+        deliveries, including scheduled retries, get up to SHUTDOWN_GRACE
+        seconds to finish.
+        """
+        self._stopping_at = time.monotonic()
+        self._wakeup.set()
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def breaker(self, destination: str) -> CircuitBreaker:
+        with self._lock:
+            return self._breaker(destination)
+
+    def submit(
+        self,
+        destination: str,
+        func: Callable[[], Any],
+        *,
+        key: Optional[str] = None,
+        max_attempts: Optional[int] = None,
+        on_success: Optional[Callable[[], None]] = None,
+        on_give_up: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        Schedule `func` to be called for `destination` as soon as a delivery
+        slot is free. `func` signals failure by raising. A later submission
+        with the same `key` supersedes any earlier one that hasn't succeeded.
+        """
+        delivery = _Delivery(
+            destination=destination,
+            func=func,
+            key=key,
+            max_attempts=max_attempts or self.max_attempts,
+            on_success=on_success,
+            on_give_up=on_give_up,
+            seq=next(self._seq),
+        )
+
+        with self._lock:
+            if key is not None:
+                self._latest[key] = delivery.seq
+            self._ready[destination].append(delivery)
+
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        next_tick = time.monotonic() + TICK
+
+        while True:
+            self._wakeup.wait(timeout=max(next_tick - time.monotonic(), 0))
+            self._wakeup.clear()
+
+            with self._lock:
+                while time.monotonic() >= next_tick:
+                    for delivery in self._wheel.advance():
+                        self._ready[delivery.destination].append(delivery)
+                    next_tick += TICK
+
+                self._dispatch()
+
+                if self._stopping_at is not None:
+                    pending = (
+                        len(self._wheel)
+                        + sum(len(q) for q in self._ready.values())
+                        + sum(self._inflight.values())
+                    )
+                    if not pending:
+                        break
+                    if time.monotonic() - self._stopping_at > SHUTDOWN_GRACE:
+                        log.warn(
+                            "dropping undelivered calls on shutdown", pending=pending
+                        )
+                        break
+
+        log.info("shutting down retry scheduler")
+
+    def _dispatch(self) -> None:
+        for destination, ready in self._ready.items():
+            breaker = self._breaker(destination)
+
+            while ready and self._inflight[destination] < self.concurrency:
+                delivery = ready[0]
+                if self._superseded(delivery):
+                    ready.popleft()
+                    continue
+
+                # While the circuit is open deliveries wait in line; they're
+                # let through one at a time once it's ready to probe.
+                if not breaker.allow():
+                    break
+
+                ready.popleft()
+                self._inflight[destination] += 1
+                self._executor.submit(self._attempt, delivery, breaker)
+
+    def _attempt(self, delivery: _Delivery, breaker: CircuitBreaker) -> None:
+        delivery.attempts += 1
+        try:
+            delivery.func()
+
+        except Exception:
+            breaker.record_failure()
+            self._failed(delivery)
+
+        else:
+            breaker.record_success()
+            self._settle(delivery)
+            if delivery.on_success is not None:
+                self._callback(delivery.on_success)
+
+        finally:
+            with self._lock:
+                self._inflight[delivery.destination] -= 1
+            self._wakeup.set()
+
+    def _failed(self, delivery: _Delivery) -> None:
+        attributes = {"destination": delivery.destination}
+
+        with self._lock:
+            superseded = self._superseded(delivery)
+        if superseded:
+            log.info("dropping superseded delivery", destination=delivery.destination)
+            return
+
+        if delivery.attempts >= delivery.max_attempts:
+            log.error(
+                "giving up on delivery",
+                destination=delivery.destination,
+                attempts=delivery.attempts,
+                exc_info=True,
+            )
+            self._give_ups.add(1, attributes)
+            self._settle(delivery)
+            if delivery.on_give_up is not None:
+                self._callback(delivery.on_give_up)
+            return
+
+        # Full jitter: spread retries evenly over [0, backoff] so that a
+        # recovering destination isn't hit by synchronized waves.
+        backoff = min(
+            self.backoff_base * 2 ** (delivery.attempts - 1), self.backoff_max
+        )
+        delay = random.uniform(0, backoff)
+        log.warn(
+            "delivery failed, retrying",
+            destination=delivery.destination,
+            attempts=delivery.attempts,
+            retry_in=delay,
+            exc_info=True,
+        )
+        self._retries.add(1, attributes)
+
+        with self._lock:
+            self._wheel.schedule(delivery, delay)
+
+    def _superseded(self, delivery: _Delivery) -> bool:
+        if delivery.key is None:
+            return False
+        return self._latest.get(delivery.key) != delivery.seq
+
+    def _settle(self, delivery: _Delivery) -> None:
+        # The latest delivery for a key is done with, one way or the other, so
+        # the key can be forgotten. Earlier deliveries for it still don't
+        # match, and stay superseded.
+        with self._lock:
+            if delivery.key is not None and not self._superseded(delivery):
+                del self._latest[delivery.key]
+
+    def _breaker(self, destination: str) -> CircuitBreaker:
+        if destination not in self._breakers:
+            self._breakers[destination] = CircuitBreaker(destination)
+        return self._breakers[destination]
+
+    def _callback(self, func: Callable[[], None]) -> None:
+        try:
+            func()
+        except Exception:
+            log.error("delivery callback failed", exc_info=True)
@@ -1,110 +1,610 @@
 import base64
-import boto3
 import hashlib
 import mimetypes
+import requests
+import threading
 import structlog
 import time
 
-from botocore.config import Config
-from pydantic import BaseModel
-from typing import Any, Callable, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from opentelemetry import metrics, trace
+from opentelemetry.metrics import CallbackOptions, Observation
+from pydantic import BaseModel, root_validator
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry  # type: ignore
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from director.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from director.webhook import preconnect, requests_session
+from director.spill import Spill
+from director.transforms import Blob, TransformParams, pipeline
+from director.transforms import executor as transform_executor
 
 log = structlog.get_logger(__name__)
 
+# How many S3 clients to keep around. Clients are keyed by endpoint and
+# credentials and reused across predictions, so that their connection pools
+# stay warm.
+CLIENT_CACHE_SIZE = 16
 
-class UploadParams(BaseModel):
+_clients: "OrderedDict[Tuple[str, str, str], Any]" = OrderedDict()
+_clients_lock = threading.Lock()
+
+# Attempts boto3 makes per upload. Persistent trouble with an endpoint is left
+# to its circuit breaker, rather than retried for every object.
+MAX_ATTEMPTS = 3
+
+# Timeouts for connecting to the object store and waiting for it to respond,
+# in seconds.
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 60.0
+
+# An upload counts as a failure for the circuit breaker if it takes longer
+# than SLOW_UPLOAD_TIME seconds plus one second per MIN_UPLOAD_RATE bytes.
+SLOW_UPLOAD_TIME = 10.0
+MIN_UPLOAD_RATE = 1024 * 1024
+
+# One circuit breaker per object store endpoint. While an endpoint's circuit
+# is open, outputs are sent inline instead of being uploaded.
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+CIRCUIT_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# How many outputs to upload at once. Uploads are network bound, so they have
+# their own threads; output transforms are handed to the (CPU-sized)
+# transform pool from there.
+UPLOAD_THREADS = 8
+
+_upload_executor = ThreadPoolExecutor(
+    max_workers=UPLOAD_THREADS, thread_name_prefix="upload"
+)
+
+# Presigned uploads go through one pooled session shared by all predictions.
+# It doesn't need more connections per host than there are upload threads.
+POOL_SIZE = UPLOAD_THREADS
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+class PresignedPut(BaseModel):
     url: str
-    bucket: str
-    access_key: str
-    secret_key: str
-    url_prefix: str
+    # Where the object can be read from once uploaded. Defaults to the
+    # presigned URL without its query string.
+    public_url: Optional[str] = None
+
+
+class PresignedPost(BaseModel):
+    url: str
+    # Form fields of the POST policy. A "key" containing "${filename}" gets
+    # the object's name substituted; without a key, objects are named like
+    # in the other modes. A key without "${filename}" names a single object,
+    # so only one output can be uploaded. "Content-Type" and
+    # "Content-Encoding" fields, if present, are filled in for each object.
+    fields: Dict[str, str]
+
+
+class UploadParams(BaseModel):
+    """
+    Where to upload outputs to. Either the object store's `url`, `bucket`
+    and credentials are given, and the director signs requests itself, or
+    the message carries presigned requests: PUT URLs, used by outputs in
+    order, or a POST policy.
+    """
+
+    url: Optional[str] = None
+    bucket: Optional[str] = None
+    access_key: Optional[str] = None
+    secret_key: Optional[str] = None
+    url_prefix: Optional[str] = None
     path_prefix: Optional[str] = None
     object_key: Optional[str] = None
+    transforms: Optional[List[TransformParams]] = None
+    presigned_puts: Optional[List[PresignedPut]] = None
+    presigned_post: Optional[PresignedPost] = None
 
+    @root_validator(skip_on_failure=True)
+    def _check_mode(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+        if values.get("presigned_puts") is not None:
+            # Without a URL, every output would silently go inline.
+            if not values["presigned_puts"]:
+                raise ValueError("presigned_puts is empty")
+            return values
 
-def upload_caller(params: UploadParams) -> Callable[[Any], Optional[str]]:
+        required = ["url_prefix"]
+        if values.get("presigned_post") is None:
+            required += ["url", "bucket", "access_key", "secret_key"]
+        missing = [f for f in required if not values.get(f)]
+        if missing:
+            raise ValueError(f"missing upload parameters: {', '.join(missing)}")
+        return values
 
-    config = Config(
-        signature_version="s3v4",
-        s3={
-            "addressing_style": "virtual",
-        },
-        retries={
-            "max_attempts": 10,
-            "mode": "standard",
-        },
-    )
-    s3_client = boto3.client(
-        "s3",
-        endpoint_url=params.url,
-        aws_access_key_id=params.access_key,
-        aws_secret_access_key=params.secret_key,
-        config=config,
-    )
+
+def upload_caller(
+    params: UploadParams,
+    spill: Optional[Spill] = None,
+    span: Optional[trace.Span] = None,
+) -> Callable[[Any], Optional[str]]:
+    # The element -> URL part depends on the mode; everything else is the
+    # same.
+    if params.presigned_puts is not None:
+        put, endpoint = _presigned_put(params)
+    elif params.presigned_post is not None:
+        put, endpoint = _presigned_post(params)
+    else:
+        put, endpoint = _signed_put(params)
+
+    upload_breaker = breaker(endpoint)
+
+    # Elements are uploaded on other threads, so each upload's span gets its
+    # parent explicitly.
+    tracer = trace.get_tracer("cog-director")
+    context = trace.set_span_in_context(span) if span else None
+
+    transform = pipeline(params.transforms) if params.transforms else None
+
+    # Uploaded URL per output element (see `element_key`), so that elements
+    # uploaded while the prediction was still running aren't uploaded again
+    # at the end.
+    uploaded: Dict[str, str] = {}
+
+    def is_file(value: Any) -> bool:
+        if spill is not None and spill.is_ref(value):
+            return True
+        return isinstance(value, str) and value.startswith("data:")
+
+    def element_key(value: str) -> str:
+        # Spill references are short and stable across webhooks; inline data
+        # URLs are hashed rather than kept around as keys.
+        if spill is not None and spill.is_ref(value):
+            return value
+        return hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
 
     def caller(response: Any) -> Any:
+        # Keys of this response's elements, so each is only hashed once.
+        keys: Dict[int, str] = {}
+
+        def key_of(element: str) -> str:
+            key = keys.get(id(element))
+            if key is None:
+                key = keys[id(element)] = element_key(element)
+            return key
+
         def upload(base64_url: str) -> str:
-            try:
-                # Extract the content type from the base64 URL
-                content_type = base64_url.split(";")[0].split(":")[1]
+            if not is_file(base64_url):
+                # Already a URL (or not a file at all): nothing to upload.
+                return base64_url
+
+            key = key_of(base64_url)
+            if key in uploaded:
+                return uploaded[key]
 
-                # Strip the prefix to get the base64-encoded string
-                base64_image = base64_url.split(",")[1]
+            if isinstance(put, _Presigned) and not put.has_target(key):
+                log.warn("no presigned target left: sending output inline")
+                return base64_url
 
-                # Decode the base64 string to bytes
-                image_data = base64.b64decode(base64_image)
+            spilled = spill is not None and spill.is_ref(base64_url)
+            with tracer.start_as_current_span(
+                "cog.prediction.upload",
+                context=context,
+                attributes={"upload.spilled": spilled},
+            ) as upload_span:
+                # Don't bother decoding and transforming outputs that can't be
+                # uploaded.
+                if upload_breaker.state == OPEN:
+                    return _short_circuit(upload_span, base64_url)
 
-                object_key = params.object_key
-                if not object_key:
-                    # Compute the md5 hash from image_data as object key.
-                    object_key = hashlib.md5(image_data).hexdigest()
+                try:
+                    if spilled:
+                        assert spill is not None
+                        content_type, image_data = spill.decode_data_url(base64_url)
+                    else:
+                        content_type, image_data = decode_data_url(base64_url)
 
-                    # Add extension if possible.
-                    ext = mimetypes.guess_extension(content_type)
-                    if ext:
-                        object_key = f"{object_key}{ext}"
+                    # Run the message's output transforms, e.g. re-encoding.
+                    content_encoding = None
+                    if transform:
+                        blob = transform_executor.submit(
+                            transform, Blob(content_type=content_type, data=image_data)
+                        ).result()
+                        content_type = blob.content_type
+                        content_encoding = blob.content_encoding
+                        image_data = blob.data
 
-                    # Add prefix if needed.
-                    if params.path_prefix:
-                        object_key = f"{params.path_prefix}/{object_key}"
+                    upload_span.set_attributes(
+                        {
+                            "upload.content_type": content_type,
+                            "upload.size": len(image_data),
+                        }
+                    )
+                    if not upload_breaker.allow():
+                        return _short_circuit(upload_span, base64_url)
 
-                s3_client.put_object(
-                    Bucket=params.bucket,
-                    Key=object_key,
-                    Body=image_data,
-                    ContentType=content_type,
-                )
+                    mark = time.perf_counter()
+                    try:
+                        url = put(key, image_data, content_type, content_encoding)
+                    except Exception:
+                        upload_breaker.record_failure()
+                        raise
+                    _record_upload_time(
+                        upload_breaker, time.perf_counter() - mark, len(image_data)
+                    )
 
-                return f"{params.url_prefix}/{object_key}"
+                    uploaded[key] = url
+                    return url
 
-            except Exception:
-                log.error(f"Cannot upload file to {params.url}", exc_info=True)
-                return base64_url
+                except Exception as e:
+                    upload_span.record_exception(e)
+                    upload_span.set_status(trace.Status(trace.StatusCode.ERROR))
+                    log.error(f"Cannot upload file to {endpoint}", exc_info=True)
+                    return base64_url
+
+        # Presigned targets go to outputs in order, so they're handed out
+        # here rather than by whichever upload gets there first.
+        if isinstance(put, _Presigned):
+            for element in _elements(response):
+                if is_file(element) and key_of(element) not in uploaded:
+                    put.assign(key_of(element))
 
         log.info("Uploading results.")
 
         start_time = time.time()
 
+        # Elements are uploaded concurrently; map keeps them in order.
         if isinstance(response, list):
-            result = []
-            for base64_url in response:
-                result.append(upload(base64_url))
+            result = list(_upload_executor.map(upload, response))
 
         elif isinstance(response, dict):
             result = {}
             for key in response.keys():
-                urls = []
-                for base64_url in response.get(key, []):
-                    urls.append(upload(base64_url))
-
-                result[key] = urls
+                result[key] = list(_upload_executor.map(upload, response.get(key, [])))
 
         else:
             result = response
 
         elapsed_time = time.time() - start_time
-        log.info(f"Results uploaded in {elapsed_time:.2f} seconds")
+        log.info("results uploaded", elapsed_time=elapsed_time)
 
         return result, elapsed_time
 
     return caller
+
+
+# Uploads a decoded output, given its element key, and returns its URL.
+_Put = Callable[[str, bytes, str, Optional[str]], str]
+
+
+def _signed_put(params: UploadParams) -> Tuple[_Put, str]:
+    assert params.url and params.access_key and params.secret_key
+    s3_client = client(params.url, params.access_key, params.secret_key)
+
+    def put(
+        key: str, data: bytes, content_type: str, content_encoding: Optional[str]
+    ) -> str:
+        object_key = make_object_key(params, data, content_type)
+
+        extra_args = {}
+        if content_encoding:
+            extra_args["ContentEncoding"] = content_encoding
+
+        s3_client.put_object(
+            Bucket=params.bucket,
+            Key=object_key,
+            Body=data,
+            ContentType=content_type,
+            **extra_args,
+        )
+        return f"{params.url_prefix}/{object_key}"
+
+    return put, params.url
+
+
+class _PresignedPuts:
+    """
+    Uploads outputs to the message's presigned PUT URLs, in the order the
+    outputs were assigned them.
+    """
+
+    def __init__(self, targets: List[PresignedPut]):
+        self._targets = list(targets)
+        # Element key -> URL, or None if there were none left.
+        self._assigned: Dict[str, Optional[PresignedPut]] = {}
+
+    def assign(self, key: str) -> None:
+        if key not in self._assigned:
+            self._assigned[key] = self._targets.pop(0) if self._targets else None
+
+    def has_target(self, key: str) -> bool:
+        return self._assigned.get(key) is not None
+
+    def __call__(
+        self,
+        key: str,
+        data: bytes,
+        content_type: str,
+        content_encoding: Optional[str],
+    ) -> str:
+        target = self._assigned[key]
+        assert target is not None
+
+        headers = {"Content-Type": content_type}
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+
+        resp = presigned_session().put(
+            target.url,
+            data=data,
+            headers=headers,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        )
+        resp.raise_for_status()
+        return target.public_url or target.url.split("?", 1)[0]
+
+
+def _presigned_put(params: UploadParams) -> Tuple[_Put, str]:
+    assert params.presigned_puts
+    return (
+        _PresignedPuts(params.presigned_puts),
+        _origin(params.presigned_puts[0].url),
+    )
+
+
+class _PresignedPost:
+    """
+    Uploads outputs with the message's POST policy. A policy with a fixed key
+    has room for a single object, which goes to the first output assigned to
+    it; the others have no target.
+    """
+
+    def __init__(self, params: UploadParams):
+        assert params.presigned_post is not None
+        self._params = params
+        self._post = params.presigned_post
+        self._key_field = self._post.fields.get("key")
+        self._fixed = (
+            self._key_field is not None and "${filename}" not in self._key_field
+        )
+        # Element key the fixed key was assigned to.
+        self._assigned: Optional[str] = None
+
+    def assign(self, key: str) -> None:
+        if self._fixed and self._assigned is None:
+            self._assigned = key
+
+    def has_target(self, key: str) -> bool:
+        return not self._fixed or self._assigned == key
+
+    def __call__(
+        self,
+        key: str,
+        data: bytes,
+        content_type: str,
+        content_encoding: Optional[str],
+    ) -> str:
+        assert self.has_target(key)
+
+        if self._key_field is None:
+            object_key = make_object_key(self._params, data, content_type)
+        elif self._fixed:
+            object_key = self._key_field
+        else:
+            name = make_object_key(self._params, data, content_type)
+            object_key = self._key_field.replace("${filename}", name.rsplit("/", 1)[-1])
+
+        fields = dict(self._post.fields)
+        fields["key"] = object_key
+        if "Content-Type" in fields:
+            fields["Content-Type"] = content_type
+        if "Content-Encoding" in fields and content_encoding:
+            fields["Content-Encoding"] = content_encoding
+
+        # The file has to be the last field of the form.
+        resp = presigned_session().post(
+            self._post.url,
+            data=fields,
+            files={"file": (object_key.rsplit("/", 1)[-1], data, content_type)},
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        )
+        resp.raise_for_status()
+        return f"{self._params.url_prefix}/{object_key}"
+
+
+# Presigned modes, which have a limited number of targets to hand out.
+_Presigned = (_PresignedPuts, _PresignedPost)
+
+
+def _presigned_post(params: UploadParams) -> Tuple[_Put, str]:
+    assert params.presigned_post is not None
+    return _PresignedPost(params), _origin(params.presigned_post.url)
+
+
+def presigned_session() -> requests.Session:
+    """
+    Return the session shared by presigned uploads. Requests are already
+    signed, so it carries no credentials or trace context of its own.
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = requests_session(propagate_trace=False)
+            adapter = HTTPAdapter(
+                pool_connections=POOL_SIZE,
+                pool_maxsize=POOL_SIZE,
+                max_retries=Retry(
+                    total=MAX_ATTEMPTS - 1,
+                    backoff_factor=0.1,
+                    status_forcelist=[500, 502, 503, 504],
+                    allowed_methods=["PUT", "POST"],
+                ),
+            )
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def _elements(response: Any) -> List[Any]:
+    if isinstance(response, list):
+        return response
+    if isinstance(response, dict):
+        return [e for key in response.keys() for e in response.get(key, [])]
+    return []
+
+
+def _origin(url: str) -> str:
+    # Presigned URLs carry signatures, which shouldn't end up in logs or
+    # metrics.
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def breaker(endpoint_url: str) -> CircuitBreaker:
+    """
+    Return the circuit breaker for uploads to an object store endpoint.
+    """
+    with _breakers_lock:
+        if endpoint_url not in _breakers:
+            _breakers[endpoint_url] = CircuitBreaker(
+                f"s3:{urlsplit(endpoint_url).netloc}"
+            )
+        return _breakers[endpoint_url]
+
+
+def _record_upload_time(
+    upload_breaker: CircuitBreaker, elapsed: float, size: int
+) -> None:
+    # An endpoint that takes forever to accept uploads is as bad as one that
+    # rejects them.
+    if elapsed > SLOW_UPLOAD_TIME + size / MIN_UPLOAD_RATE:
+        log.warn("slow upload", elapsed=elapsed, size=size)
+        upload_breaker.record_failure()
+    else:
+        upload_breaker.record_success()
+
+
+def _short_circuit(upload_span: trace.Span, base64_url: str) -> str:
+    upload_span.set_attribute("upload.short_circuited", True)
+    _short_circuited.add(1)
+    log.info("upload circuit open: sending output inline", rate_limit=10.0)
+    return base64_url
+
+
+def _observe_circuits(options: CallbackOptions) -> Iterable[Observation]:
+    with _breakers_lock:
+        breakers = list(_breakers.items())
+    for endpoint_url, upload_breaker in breakers:
+        yield Observation(
+            CIRCUIT_STATES[upload_breaker.state],
+            {"endpoint": urlsplit(endpoint_url).netloc},
+        )
+
+
+_meter = metrics.get_meter("cog-director")
+_meter.create_observable_gauge(
+    "director.s3.circuit_state",
+    callbacks=[_observe_circuits],
+    description="State of the upload circuit per endpoint: 0 closed, 1 half-open, 2 open",
+)
+_short_circuited = _meter.create_counter(
+    "director.s3.uploads_short_circuited",
+    description="Outputs sent inline because the upload circuit was open",
+)
+
+
+def client(endpoint_url: str, access_key: str, secret_key: str) -> Any:
+    """
+    Return a (cached) S3 client for the given endpoint and credentials.
+    """
+    key = (endpoint_url, access_key, secret_key)
+
+    # Client creation isn't thread safe in boto3, so it's serialized here too.
+    with _clients_lock:
+        if key in _clients:
+            _clients.move_to_end(key)
+            return _clients[key]
+
+        _clients[key] = _make_client(endpoint_url, access_key, secret_key)
+        while len(_clients) > CLIENT_CACHE_SIZE:
+            _clients.popitem(last=False)
+
+        return _clients[key]
+
+
+def warm() -> None:
+    """
+    Import boto3 and load the S3 service model, so that the first upload
+    doesn't pay for it. Creating a client doesn't touch the network, and
+    clients are made per credentials, which only come with messages.
+    """
+    with _clients_lock:
+        _make_client("http://localhost", "warmup", "warmup")
+
+
+def warm_presigned(url: Optional[str] = None) -> None:
+    """
+    Create the presigned upload session and, given the URL of a bucket or
+    endpoint that presigned requests go to, open a connection to it ahead of
+    the first upload.
+    """
+    session = presigned_session()
+    if url is not None:
+        preconnect(session, url)
+
+
+def _make_client(endpoint_url: str, access_key: str, secret_key: str) -> Any:
+    # boto3 takes a while to import and to load the service model, so it's
+    # only done when first needed (or ahead of time by `warm`).
+    import boto3
+    from botocore.config import Config
+
+    config = Config(
+        signature_version="s3v4",
+        s3={
+            "addressing_style": "virtual",
+        },
+        retries={
+            "max_attempts": MAX_ATTEMPTS,
+            "mode": "standard",
+        },
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+    )
+    return boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        config=config,
+    )
+
+
+def decode_data_url(base64_url: str) -> Tuple[str, bytes]:
+    # Extract the content type from the base64 URL
+    content_type = base64_url.split(";")[0].split(":")[1]
+
+    # Strip the prefix to get the base64-encoded string
+    base64_image = base64_url.split(",")[1]
+
+    # Decode the base64 string to bytes
+    return content_type, base64.b64decode(base64_image)
+
+
+def make_object_key(params: UploadParams, data: bytes, content_type: str) -> str:
+    object_key = params.object_key
+    if not object_key:
+        # Compute the md5 hash from data as object key.
+        object_key = hashlib.md5(data).hexdigest()
+
+        # Add extension if possible.
+        ext = mimetypes.guess_extension(content_type)
+        if ext:
+            object_key = f"{object_key}{ext}"
+
+        # Add prefix if needed.
+        if params.path_prefix:
+            object_key = f"{params.path_prefix}/{object_key}"
+
+    return object_key
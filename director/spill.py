@@ -0,0 +1,178 @@
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import structlog
+
+from attrs import define
+from typing import Any, Dict, Optional, Set, Tuple
+
+log = structlog.get_logger(__name__)
+
+# Output values longer than this, in characters, are spilled to disk.
+DEFAULT_THRESHOLD = 1024 * 1024
+
+# Spilled values are replaced by "spill:<token>". Tokens are random and only
+# honoured if this process issued them, so the (untrusted) model container
+# can't make the director read arbitrary files by sending such strings.
+REF_PREFIX = "spill:"
+
+# Chunk size for decoding spilled data URLs, in base64 characters (a multiple
+# of 4, so chunks decode independently).
+DECODE_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+@define
+class _Spilled:
+    path: str
+    prediction_id: Optional[str]
+    digest: str
+
+
+class Spill:
+    """
+    Keeps large output values (typically base64 data URLs) out of memory.
+    Values above the threshold are written to a file as soon as they arrive
+    and replaced by a short reference, which is what the tracker, the
+    webhook caller and the background tasks pass around. The value is only
+    read back where it's actually needed: to upload it, or to send it inline
+    if it can't be uploaded.
+    """
+
+    def __init__(
+        self, directory: Optional[str] = None, threshold: int = DEFAULT_THRESHOLD
+    ):
+        self.threshold = threshold
+        self.directory = tempfile.mkdtemp(prefix="director-spill-", dir=directory)
+
+        self._lock = threading.Lock()
+        self._refs: Dict[str, _Spilled] = {}
+        # (prediction ID, digest) -> ref, as cog repeats all outputs so far in
+        # every webhook.
+        self._by_digest: Dict[Tuple[Optional[str], str], str] = {}
+        # Predictions whose outputs may be spilled: between `track` and
+        # `release`.
+        self._active: Set[Optional[str]] = set()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._refs)
+
+    def track(self, prediction_id: Optional[str]) -> None:
+        """
+        Allow outputs of a prediction to be spilled, until it's released.
+        """
+        with self._lock:
+            self._active.add(prediction_id)
+
+    def spill(self, value: Any, prediction_id: Optional[str] = None) -> Any:
+        """
+        Return `value` with large strings, including those nested in lists
+        and dicts, replaced by references. Values of predictions that aren't
+        being tracked (e.g. late or stray webhooks) are returned as they are,
+        as nothing would release them.
+        """
+        with self._lock:
+            if prediction_id not in self._active:
+                return value
+        return self._spill(value, prediction_id)
+
+    def _spill(self, value: Any, prediction_id: Optional[str]) -> Any:
+        if isinstance(value, list):
+            return [self._spill(v, prediction_id) for v in value]
+        if isinstance(value, dict):
+            return {k: self._spill(v, prediction_id) for k, v in value.items()}
+        if not isinstance(value, str) or len(value) <= self.threshold:
+            return value
+
+        digest = hashlib.blake2b(value.encode()).hexdigest()
+        with self._lock:
+            ref = self._by_digest.get((prediction_id, digest))
+            if ref is not None:
+                return ref
+
+        token = uuid.uuid4().hex
+        path = os.path.join(self.directory, token)
+        with open(path, "w") as f:
+            f.write(value)
+
+        ref = REF_PREFIX + token
+        with self._lock:
+            self._refs[ref] = _Spilled(
+                path=path, prediction_id=prediction_id, digest=digest
+            )
+            self._by_digest[(prediction_id, digest)] = ref
+        return ref
+
+    def is_ref(self, value: Any) -> bool:
+        if not isinstance(value, str) or not value.startswith(REF_PREFIX):
+            return False
+        with self._lock:
+            return value in self._refs
+
+    def read(self, ref: str) -> str:
+        with open(self._path(ref)) as f:
+            return f.read()
+
+    def decode_data_url(self, ref: str) -> Tuple[str, bytes]:
+        """
+        Like s3.decode_data_url, for a spilled data URL, without reading the
+        encoded string into memory in one piece.
+        """
+        with open(self._path(ref), "rb") as f:
+            header = f.read(256).split(b",", 1)[0]
+            content_type = header.split(b";")[0].split(b":")[1].decode()
+            f.seek(len(header) + 1)
+
+            chunks = []
+            while True:
+                chunk = f.read(DECODE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(base64.b64decode(chunk))
+
+        return content_type, b"".join(chunks)
+
+    def materialize(self, value: Any) -> Any:
+        """
+        Return `value` with references replaced by the values they stand for.
+        """
+        if isinstance(value, list):
+            return [self.materialize(v) for v in value]
+        if isinstance(value, dict):
+            return {k: self.materialize(v) for k, v in value.items()}
+        if self.is_ref(value):
+            return self.read(value)
+        return value
+
+    def release(self, prediction_id: Optional[str]) -> None:
+        """
+        Delete everything spilled for a prediction, and stop tracking it.
+        """
+        with self._lock:
+            self._active.discard(prediction_id)
+            refs = [
+                r for r, s in self._refs.items() if s.prediction_id == prediction_id
+            ]
+            spilled = [self._refs.pop(r) for r in refs]
+            for s in spilled:
+                self._by_digest.pop((s.prediction_id, s.digest), None)
+
+        for s in spilled:
+            try:
+                os.unlink(s.path)
+            except FileNotFoundError:
+                pass
+
+    def close(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _path(self, ref: str) -> str:
+        with self._lock:
+            spilled = self._refs.get(ref)
+        if spilled is None:
+            raise KeyError(f"unknown spill reference: {ref}")
+        return spilled.path
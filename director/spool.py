@@ -0,0 +1,327 @@
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+import requests
+import structlog
+
+from attrs import define, field
+from typing import Any, Dict, List, Optional, Set
+
+log = structlog.get_logger(__name__)
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+# With the "interval" fsync policy, how often to flush the active segment to
+# disk, in seconds.
+FSYNC_INTERVAL = 1.0
+
+# Size above which the active segment is closed and a new one started, in
+# bytes.
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Backoff between replay attempts of an undelivered payload, in seconds.
+REPLAY_BACKOFF_MIN = 1.0
+REPLAY_BACKOFF_MAX = 300.0
+
+# How long to keep replaying a payload before giving up on it, in seconds.
+MAX_ENTRY_AGE = 24 * 60 * 60
+
+# Timeout for a single replay attempt, in seconds.
+REPLAY_TIMEOUT = 10.0
+
+
+@define
+class SpoolEntry:
+    id: str
+    url: str
+    payload: Any
+    headers: Optional[Dict[str, str]] = None
+    created_at: float = field(factory=time.time)
+
+    # Replay bookkeeping, not persisted.
+    segment: int = 0
+    attempts: int = 0
+    next_attempt_at: float = 0.0
+
+
+class WebhookSpool:
+    """
+    Append-only on-disk log of terminal webhook payloads that haven't been
+    acknowledged by their receiver yet. A background drainer replays
+    unacknowledged payloads with backoff, and anything still outstanding when
+    the process dies is replayed on the next start.
+
+    Segments are JSON lines files of "put" and "ack" records. A segment is
+    deleted once it is no longer being written to and every payload in it,
+    and in all older segments, has been acknowledged.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fsync: str = "interval",
+        segment_size: int = SEGMENT_SIZE,
+        session: Optional[requests.Session] = None,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy: {fsync}")
+
+        self.directory = directory
+        self.fsync = fsync
+        self.segment_size = segment_size
+
+        self._lock = threading.Lock()
+        self._pending: Dict[str, SpoolEntry] = {}
+        self._unacked: Dict[int, Set[str]] = {}
+        self._segment = 0
+        self._file: Any = None
+        self._dirty = False
+        self._last_fsync = time.monotonic()
+
+        self._session = session or requests.Session()
+        self._thread: Optional[threading.Thread] = None
+        self._should_exit = threading.Event()
+        self._wakeup = threading.Event()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._should_exit.set()
+        self._wakeup.set()
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+        with self._lock:
+            self._sync(force=True)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def append(
+        self,
+        url: str,
+        payload: Any,
+        headers: Optional[Dict[str, str]] = None,
+        hold: bool = False,
+    ) -> str:
+        """
+        Durably record a payload for delivery and return its spool ID. The
+        caller is expected to attempt delivery itself and `ack` on success;
+        otherwise the drainer takes over after the first backoff period. With
+        `hold`, the drainer leaves the entry alone until it is `release`d, for
+        callers that do their own retrying.
+        """
+        entry = SpoolEntry(
+            id=uuid.uuid4().hex, url=url, payload=payload, headers=headers
+        )
+        if hold:
+            entry.next_attempt_at = math.inf
+        else:
+            entry.next_attempt_at = time.monotonic() + REPLAY_BACKOFF_MIN
+
+        with self._lock:
+            self._write(
+                {
+                    "op": "put",
+                    "id": entry.id,
+                    "url": entry.url,
+                    "headers": entry.headers,
+                    "payload": entry.payload,
+                    "created_at": entry.created_at,
+                }
+            )
+            entry.segment = self._segment
+            self._pending[entry.id] = entry
+            self._unacked.setdefault(self._segment, set()).add(entry.id)
+
+        return entry.id
+
+    def ack(self, entry_id: str) -> None:
+        with self._lock:
+            entry = self._pending.pop(entry_id, None)
+            if entry is None:
+                return
+
+            self._write({"op": "ack", "id": entry_id})
+            self._unacked.get(entry.segment, set()).discard(entry_id)
+            self._collect()
+
+    def release(self, entry_id: str) -> None:
+        """
+        Hand a held entry over to the drainer.
+        """
+        with self._lock:
+            entry = self._pending.get(entry_id)
+            if entry is not None:
+                entry.next_attempt_at = time.monotonic()
+
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while not self._should_exit.is_set():
+            for entry in self._due():
+                if self._should_exit.is_set():
+                    break
+                self._replay(entry)
+
+            with self._lock:
+                self._sync()
+
+            self._wakeup.wait(timeout=min(FSYNC_INTERVAL, REPLAY_BACKOFF_MIN))
+            self._wakeup.clear()
+
+        log.info("shutting down webhook spool", pending=len(self))
+
+    def _due(self) -> List[SpoolEntry]:
+        now = time.monotonic()
+        with self._lock:
+            return [e for e in self._pending.values() if e.next_attempt_at <= now]
+
+    def _replay(self, entry: SpoolEntry) -> None:
+        entry.attempts += 1
+        try:
+            resp = self._session.post(
+                entry.url,
+                json=entry.payload,
+                headers=entry.headers,
+                timeout=REPLAY_TIMEOUT,
+            )
+            resp.raise_for_status()
+
+        except requests.exceptions.RequestException:
+            if time.time() - entry.created_at > MAX_ENTRY_AGE:
+                log.error(
+                    "giving up on spooled webhook",
+                    spool_id=entry.id,
+                    attempts=entry.attempts,
+                )
+                self.ack(entry.id)
+                return
+
+            backoff = min(
+                REPLAY_BACKOFF_MIN * 2 ** (entry.attempts - 1), REPLAY_BACKOFF_MAX
+            )
+            entry.next_attempt_at = time.monotonic() + backoff * random.uniform(
+                0.5, 1.0
+            )
+            log.warn(
+                "failed to replay spooled webhook",
+                spool_id=entry.id,
+                attempts=entry.attempts,
+                retry_in=entry.next_attempt_at - time.monotonic(),
+            )
+            return
+
+        log.info("replayed spooled webhook", spool_id=entry.id, attempts=entry.attempts)
+        self.ack(entry.id)
+
+    def _recover(self) -> None:
+        segments = self._segments()
+
+        for segment in segments:
+            self._unacked.setdefault(segment, set())
+            path = self._path(segment)
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn write at the end of a segment: everything
+                        # before it is intact.
+                        log.warn("skipping corrupt spool record", segment=path)
+                        continue
+
+                    if record.get("op") == "put":
+                        entry = SpoolEntry(
+                            id=record["id"],
+                            url=record["url"],
+                            payload=record["payload"],
+                            headers=record.get("headers"),
+                            created_at=record.get("created_at", time.time()),
+                            segment=segment,
+                        )
+                        self._pending[entry.id] = entry
+                        self._unacked.setdefault(segment, set()).add(entry.id)
+                    elif record.get("op") == "ack":
+                        entry = self._pending.pop(record["id"], None)
+                        if entry is not None:
+                            self._unacked[entry.segment].discard(entry.id)
+
+        self._segment = segments[-1] + 1 if segments else 0
+        self._collect()
+
+        if self._pending:
+            log.info("recovered spooled webhooks", pending=len(self._pending))
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        if self._file is None or self._file.tell() >= self.segment_size:
+            self._rotate()
+
+        self._file.write(json.dumps(record).encode() + b"\n")
+        self._dirty = True
+        self._sync(force=self.fsync == "always")
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._sync(force=True)
+            self._file.close()
+            self._segment += 1
+
+        self._file = open(self._path(self._segment), "ab")
+        self._unacked.setdefault(self._segment, set())
+
+    def _sync(self, force: bool = False) -> None:
+        if self._file is None or not self._dirty:
+            return
+
+        self._file.flush()
+        if self.fsync == "never":
+            self._dirty = False
+            return
+
+        now = time.monotonic()
+        if force or now - self._last_fsync >= FSYNC_INTERVAL:
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+            self._dirty = False
+
+    def _collect(self) -> None:
+        # Delete fully acknowledged segments, oldest first, never the one
+        # being written to.
+        for segment in sorted(self._unacked):
+            if segment == self._segment or self._unacked[segment]:
+                break
+
+            del self._unacked[segment]
+            try:
+                os.remove(self._path(segment))
+            except FileNotFoundError:
+                pass
+
+    def _segments(self) -> List[int]:
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith("segment-") and name.endswith(".log"):
+                try:
+                    segments.append(int(name[len("segment-") : -len(".log")]))
+                except ValueError:
+                    continue
+        return sorted(segments)
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment:08d}.log")
@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+import structlog
+
+from attrs import define, field
+from collections import OrderedDict
+from opentelemetry.context import Context
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, Span, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter
+from opentelemetry.sdk.trace.sampling import (
+    ALWAYS_ON,
+    ParentBased,
+    Sampler,
+    SamplingResult,
+    TraceIdRatioBased,
+)
+from opentelemetry.trace import Link, SpanKind, StatusCode
+from opentelemetry.trace.span import TraceState
+from opentelemetry.util.types import Attributes
+from typing import List, Optional, Sequence
+
+from director.monitor import span_attributes_from_env
+
+log = structlog.get_logger(__name__)
+
+# Name of the root span of every prediction. Sampling only applies to these;
+# other traces, like utilization spans, are always kept.
+PREDICTION_SPAN = "cog.prediction"
+
+# How many traces to hold spans for while waiting for their root span to end,
+# and how many spans per trace. Traces beyond that are dropped, oldest first,
+# as are traces whose root span hasn't ended after PENDING_TIMEOUT seconds,
+# which is longer than any prediction should run.
+MAX_PENDING_TRACES = 64
+MAX_PENDING_SPANS = 1024
+PENDING_TIMEOUT = 6 * 60 * 60
+
+# How many sampling decisions to remember, for spans that end after their
+# root span (e.g. delivery of the terminal webhook).
+MAX_DECISIONS = 1024
+
+
+@define
+class _Pending:
+    spans: List[ReadableSpan] = field(factory=list)
+    since: float = field(factory=time.monotonic)
+
+
+class PredictionSampler(Sampler):
+    """
+    Head sampler that keeps a fraction of prediction traces, based on their
+    trace ID, and everything else.
+    """
+
+    def __init__(self, ratio: float):
+        self._ratio = TraceIdRatioBased(ratio)
+
+    def should_sample(
+        self,
+        parent_context: Optional[Context],
+        trace_id: int,
+        name: str,
+        kind: Optional[SpanKind] = None,
+        attributes: Attributes = None,
+        links: Optional[Sequence[Link]] = None,
+        trace_state: Optional[TraceState] = None,
+    ) -> SamplingResult:
+        sampler = self._ratio if name == PREDICTION_SPAN else ALWAYS_ON
+        return sampler.should_sample(
+            parent_context, trace_id, name, kind, attributes, links, trace_state
+        )
+
+    def get_description(self) -> str:
+        return f"PredictionSampler{{{self._ratio.rate}}}"
+
+
+class TailSamplingProcessor(SpanProcessor):
+    """
+    Holds on to a prediction's spans until its root span ends, and then
+    passes them on only if the prediction was head sampled (by trace ID, like
+    PredictionSampler), failed, or took at least `slow_threshold` seconds.
+    All spans have to be recorded for this to work.
+    """
+
+    def __init__(
+        self,
+        delegate: SpanProcessor,
+        ratio: float = 0.0,
+        slow_threshold: Optional[float] = None,
+    ):
+        self.delegate = delegate
+        self.slow_threshold = slow_threshold
+
+        self._bound = TraceIdRatioBased.get_bound_for_rate(ratio)
+        self._lock = threading.Lock()
+        # Traces in the order their first span ended.
+        self._pending: "OrderedDict[int, _Pending]" = OrderedDict()
+        self._decisions: "OrderedDict[int, bool]" = OrderedDict()
+
+    def on_start(self, span: Span, parent_context: Optional[Context] = None) -> None:
+        self.delegate.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        assert span.context is not None
+        trace_id = span.context.trace_id
+        is_root = span.parent is None or span.parent.is_remote
+
+        with self._lock:
+            keep = self._decisions.get(trace_id)
+
+            if keep is None and not is_root:
+                pending = self._pending.setdefault(trace_id, _Pending())
+                if len(pending.spans) < MAX_PENDING_SPANS:
+                    pending.spans.append(span)
+                self._evict()
+                return
+
+            if keep is None:
+                keep = self._keep(span)
+                self._decisions[trace_id] = keep
+                while len(self._decisions) > MAX_DECISIONS:
+                    self._decisions.popitem(last=False)
+                pending = self._pending.pop(trace_id, None)
+                spans = pending.spans if pending is not None else []
+                spans.append(span)
+            else:
+                spans = [span]
+
+        if keep:
+            for s in spans:
+                self.delegate.on_end(s)
+
+    def shutdown(self) -> None:
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.delegate.force_flush(timeout_millis)
+
+    def _evict(self) -> None:
+        expired_at = time.monotonic() - PENDING_TIMEOUT
+        while self._pending:
+            trace_id, pending = next(iter(self._pending.items()))
+            if len(self._pending) <= MAX_PENDING_TRACES and pending.since > expired_at:
+                break
+
+            del self._pending[trace_id]
+            log.debug(
+                "dropping spans of unfinished trace",
+                trace_id=f"{trace_id:032x}",
+                spans=len(pending.spans),
+            )
+
+    def _keep(self, root: ReadableSpan) -> bool:
+        if root.name != PREDICTION_SPAN:
+            return True
+
+        assert root.context is not None
+        if root.context.trace_id & TraceIdRatioBased.TRACE_ID_LIMIT < self._bound:
+            return True
+
+        attributes = root.attributes or {}
+        if root.status.status_code == StatusCode.ERROR:
+            return True
+        if attributes.get("prediction.status") == "failed":
+            return True
+        if attributes.get("prediction.timed_out"):
+            return True
+
+        if (
+            self.slow_threshold is not None
+            and root.end_time is not None
+            and root.start_time is not None
+        ):
+            duration = (root.end_time - root.start_time) / 1e9
+            if duration >= self.slow_threshold:
+                return True
+
+        return False
+
+
+def tracer_provider_from_env(exporter: SpanExporter) -> TracerProvider:
+    """
+    Set up tracing for the director. Resource attributes are read from the
+    environment once. DIRECTOR_TRACE_SAMPLE_RATIO sets the fraction of
+    predictions traced (default: all). If DIRECTOR_TRACE_KEEP_SLOWER_THAN is
+    set, every prediction is recorded and the decision is made when it ends:
+    sampled, failed and slower predictions (in seconds) are kept.
+    """
+    ratio = float(os.environ.get("DIRECTOR_TRACE_SAMPLE_RATIO", 1.0))
+    slow_threshold = os.environ.get("DIRECTOR_TRACE_KEEP_SLOWER_THAN")
+
+    resource = Resource.create(span_attributes_from_env())
+    processor: SpanProcessor = BatchSpanProcessor(exporter)
+
+    if slow_threshold is None:
+        provider = TracerProvider(
+            resource=resource, sampler=ParentBased(PredictionSampler(ratio))
+        )
+    else:
+        provider = TracerProvider(resource=resource, sampler=ALWAYS_ON)
+        processor = TailSamplingProcessor(
+            processor, ratio=ratio, slow_threshold=float(slow_threshold)
+        )
+
+    provider.add_span_processor(processor)
+    log.info(
+        "tracing configured",
+        sample_ratio=ratio,
+        keep_slower_than=slow_threshold,
+    )
+    return provider
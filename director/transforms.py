@@ -0,0 +1,180 @@
+import gzip
+import io
+import os
+import structlog
+
+from attrs import define
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel
+from typing import Any, Callable, Dict, List, Optional
+
+log = structlog.get_logger(__name__)
+
+# Output transformations are CPU bound (image encoders release the GIL), so
+# they run on a shared pool sized to the CPUs, rather than on the threads that
+# upload them.
+executor = ThreadPoolExecutor(
+    max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="transform"
+)
+
+TEXT_CONTENT_TYPES = ("application/json", "application/xml", "image/svg+xml")
+
+
+@define
+class Blob:
+    content_type: str
+    data: bytes
+    content_encoding: Optional[str] = None
+
+
+Stage = Callable[[Blob], Blob]
+
+
+class TransformParams(BaseModel):
+    name: str
+    options: Dict[str, Any] = {}
+
+
+def reencode(format: str, quality: int = 80, lossless: bool = False) -> Stage:
+    """
+    Re-encode raster images to `format` (e.g. WEBP or AVIF). Images that
+    can't be decoded, or formats the installed Pillow can't write, are passed
+    through unchanged.
+    """
+    format = format.upper()
+    content_type = f"image/{format.lower()}"
+
+    def stage(blob: Blob) -> Blob:
+        if not _is_raster_image(blob) or blob.content_type == content_type:
+            return blob
+
+        image = _open_image(blob)
+        if image is None:
+            return blob
+
+        out = io.BytesIO()
+        try:
+            image.save(out, format=format, quality=quality, lossless=lossless)
+        except (KeyError, OSError, ValueError):
+            log.warn("cannot re-encode image", format=format, exc_info=True)
+            return blob
+
+        # Lossless re-encoding of an already well compressed image can come
+        # out bigger; there's no point uploading that.
+        if lossless and out.tell() >= len(blob.data):
+            return blob
+
+        return Blob(content_type=content_type, data=out.getvalue())
+
+    return stage
+
+
+def downscale(max_size: int = 512) -> Stage:
+    """
+    Downscale raster images so that neither side exceeds `max_size` pixels,
+    keeping their aspect ratio and format. This is lossy and replaces the
+    output: the full-resolution image is not uploaded anywhere, so it's only
+    for messages that explicitly ask for smaller outputs instead.
+    """
+
+    def stage(blob: Blob) -> Blob:
+        if not _is_raster_image(blob):
+            return blob
+
+        image = _open_image(blob)
+        if image is None or max(image.size) <= max_size:
+            return blob
+
+        format = image.format
+        image.thumbnail((max_size, max_size))
+
+        out = io.BytesIO()
+        try:
+            image.save(out, format=format)
+        except (KeyError, OSError, ValueError):
+            log.warn("cannot save downscaled image", format=format, exc_info=True)
+            return blob
+
+        return Blob(content_type=blob.content_type, data=out.getvalue())
+
+    return stage
+
+
+def gzip_text(level: int = 6) -> Stage:
+    """
+    Gzip text and JSON outputs. The content type is kept and the object is
+    stored with `Content-Encoding: gzip`, so clients decode it transparently.
+    """
+
+    def stage(blob: Blob) -> Blob:
+        if blob.content_encoding or not _is_text(blob):
+            return blob
+
+        data = gzip.compress(blob.data, compresslevel=level)
+        if len(data) >= len(blob.data):
+            return blob
+
+        return Blob(content_type=blob.content_type, data=data, content_encoding="gzip")
+
+    return stage
+
+
+STAGES: Dict[str, Callable[..., Stage]] = {
+    "webp": lambda **options: reencode("WEBP", **options),
+    "avif": lambda **options: reencode("AVIF", **options),
+    "downscale": downscale,
+    "gzip": gzip_text,
+}
+
+
+def pipeline(specs: List[TransformParams]) -> Stage:
+    """
+    Build a single stage running the named stages in order. Unknown stage
+    names are rejected up front, so a bad message fails before any upload.
+    """
+    stages = []
+    for spec in specs:
+        if spec.name not in STAGES:
+            raise ValueError(f"unknown output transform: {spec.name}")
+        stages.append(STAGES[spec.name](**spec.options))
+
+    def run(blob: Blob) -> Blob:
+        for stage in stages:
+            try:
+                blob = stage(blob)
+            except Exception:
+                log.error("output transform failed", exc_info=True)
+        return blob
+
+    return run
+
+
+def _is_raster_image(blob: Blob) -> bool:
+    return (
+        blob.content_type.startswith("image/")
+        and blob.content_type not in TEXT_CONTENT_TYPES
+        and blob.content_encoding is None
+    )
+
+
+def _is_text(blob: Blob) -> bool:
+    return blob.content_type.startswith("text/") or blob.content_type in (
+        TEXT_CONTENT_TYPES
+    )
+
+
+def _open_image(blob: Blob) -> Any:
+    try:
+        from PIL import Image
+    except ImportError:
+        log.warn("Pillow is not installed: image transforms are disabled")
+        return None
+
+    try:
+        image = Image.open(io.BytesIO(blob.data))
+        image.load()
+    except Exception:
+        log.warn("cannot decode image", content_type=blob.content_type)
+        return None
+
+    return image
@@ -1,12 +1,16 @@
 import os
-from typing import Any, Callable, Optional
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional, Tuple
 
 import requests
 import structlog
 from fastapi.encoders import jsonable_encoder
+from opentelemetry import trace
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry  # type: ignore
 from typing import Dict
+from urllib.parse import urlsplit
 
 from cog.schema import PredictionResponse, Status
 from cog.server.response_throttler import ResponseThrottler
@@ -14,23 +18,57 @@ from cog.server.telemetry import current_trace_context
 from cog.server.useragent import get_user_agent
 
 from director.background_tasks import BackgroundTasks
+from director.compression import CompressionParams, encode_json
+from director.retry import RetryScheduler
+from director.spill import Spill
+from director.spool import WebhookSpool
 
 log = structlog.get_logger(__name__)
 
 _response_interval = float(os.environ.get("COG_THROTTLE_RESPONSE_INTERVAL", 0.3))
 
+# Timeout for a single webhook delivery attempt made through the retry
+# scheduler or backed by the spool, in seconds.
+DELIVERY_TIMEOUT = 10.0
+
+# Timeout for the request made at startup to open a connection ahead of the
+# first webhook, in seconds.
+WARMUP_TIMEOUT = 2.0
+
+# How often to log that webhooks are being throttled, at most, in seconds.
+THROTTLED_LOG_INTERVAL = 10.0
+
+# Webhook sessions are shared by all predictions, so that connections to
+# webhook receivers are kept alive between predictions.
+_sessions: Optional[Tuple[requests.Session, requests.Session]] = None
+_sessions_lock = threading.Lock()
+
 
 def webhook_caller(
     url: str,
     background_tasks: Optional[BackgroundTasks] = None,
     headers: Dict = None,
     upload_caller: Optional[Callable] = None,
+    span: Optional[trace.Span] = None,
+    spool: Optional[WebhookSpool] = None,
+    retry_scheduler: Optional[RetryScheduler] = None,
+    on_delivered: Optional[Callable[[Dict[str, Any]], None]] = None,
+    spill: Optional[Spill] = None,
+    compression: Optional[CompressionParams] = None,
 ) -> Callable[[Any], None]:
 
+    tracer = trace.get_tracer("cog-director")
     throttler = ResponseThrottler(response_interval=_response_interval)
 
-    default_session = requests_session()
-    retry_session = requests_session_with_retries()
+    default_session, retry_session = shared_sessions()
+
+    # The sessions are shared, so trace context goes on each request instead.
+    headers = {**_trace_headers(), **(headers or {})}
+
+    # Webhooks are sent from other threads, so their spans get their parent
+    # explicitly.
+    context = trace.set_span_in_context(span) if span else None
+    destination = urlsplit(url).netloc
 
     def _webhook_call(response: Dict) -> None:
         if isinstance(response, Dict):
@@ -43,27 +81,188 @@ def webhook_caller(
                     # Note that if upload failed, base64 url will be used.
                     response.output, upload_time = upload_caller(response.output)
                     response.metrics["upload_time"] = upload_time
+                    _mark(response, "uploaded")
 
-                # Send response to webhook.
-                session = (
-                    retry_session
-                    if Status.is_terminal(response.status)
-                    else default_session
-                )
-                resp = session.post(
-                    url,
-                    json=jsonable_encoder(response.dict(exclude_unset=True)),
-                    headers=headers,
-                )
-                resp.raise_for_status()
+                # Upload outputs produced so far while the model is still
+                # running. The upload caller remembers what it has uploaded,
+                # so only new elements are uploaded here and the terminal
+                # upload only has to deal with whatever came last.
+                elif (
+                    upload_caller
+                    and response.status == Status.PROCESSING
+                    and response.output
+                ):
+                    response.output, _ = upload_caller(response.output)
+
+                # Whatever is still spilled to disk (not uploaded) has to go
+                # inline.
+                if spill is not None:
+                    response.output = spill.materialize(response.output)
+
+                payload = jsonable_encoder(response.dict(exclude_unset=True))
+
+                if retry_scheduler is not None:
+                    _schedule(response, payload)
+                else:
+                    _send(response, payload)
 
             except:
                 log.warn("Caught exception while sending webhook", exc_info=True)
 
+            finally:
+                # Nothing refers to the spilled outputs after the last webhook.
+                if spill is not None and Status.is_terminal(response.status):
+                    spill.release(response.id)
+
             throttler.update_last_sent_response_time()
 
         else:
-            log.warn(f"Response being throttled. {response}")
+            # Throttling is routine while a prediction is running.
+            log.debug(
+                "webhook throttled",
+                prediction_id=response.id,
+                status=response.status,
+                rate_limit=THROTTLED_LOG_INTERVAL,
+            )
+
+    def _send(response: PredictionResponse, payload: Any) -> None:
+        # Send response to webhook. With a spool, terminal payloads are
+        # persisted first and sent once; if that fails the spool drainer keeps
+        # retrying, even across restarts. The spooled copy is held until then,
+        # so that the drainer doesn't send it again while this attempt is
+        # still in flight.
+        spool_id = None
+        kwargs: Dict[str, Any] = {}
+        if spool is not None and Status.is_terminal(response.status):
+            spool_id = spool.append(url, payload, headers, hold=True)
+            session = default_session
+            kwargs["timeout"] = DELIVERY_TIMEOUT
+        elif Status.is_terminal(response.status):
+            session = retry_session
+        else:
+            session = default_session
+
+        body, body_headers = encode_json(payload, compression)
+        try:
+            _post(session, response, body, {**headers, **body_headers}, **kwargs)
+        except Exception:
+            if spool_id is not None:
+                spool.release(spool_id)
+            raise
+
+        if spool_id is not None:
+            spool.ack(spool_id)
+
+        if Status.is_terminal(response.status):
+            _record_delivery(response, payload)
+
+    def _schedule(response: PredictionResponse, payload: Any) -> None:
+        assert retry_scheduler is not None
+
+        # Encoded (and compressed) once, however often it's retried.
+        body, body_headers = encode_json(payload, compression)
+        post_headers = {**headers, **body_headers}
+
+        def _attempt() -> None:
+            _post(
+                default_session,
+                response,
+                body,
+                post_headers,
+                timeout=DELIVERY_TIMEOUT,
+            )
+
+        # Progress updates are best effort and superseded by the next one, so
+        # they are sent once from here, and skipped while the destination's
+        # circuit is open.
+        if not Status.is_terminal(response.status):
+            breaker = retry_scheduler.breaker(destination)
+            if not breaker.allow():
+                log.info("skipping webhook: circuit open", destination=destination)
+                return
+            try:
+                _attempt()
+            except Exception:
+                breaker.record_failure()
+                raise
+            breaker.record_success()
+            return
+
+        # Terminal updates are handed to the scheduler, which retries them
+        # without holding up this thread. A spooled copy is held until the
+        # scheduler either delivers it or gives up on it.
+        spool_id = None
+        if spool is not None:
+            spool_id = spool.append(url, payload, headers, hold=True)
+
+        def _on_success() -> None:
+            if spool_id is not None:
+                spool.ack(spool_id)
+            _record_delivery(response, payload)
+
+        def _on_give_up() -> None:
+            if spool_id is not None:
+                spool.release(spool_id)
+
+        retry_scheduler.submit(
+            destination, _attempt, on_success=_on_success, on_give_up=_on_give_up
+        )
+
+    def _post(
+        session: requests.Session,
+        response: PredictionResponse,
+        body: bytes,
+        post_headers: Dict[str, str],
+        **kwargs: Any,
+    ) -> None:
+        # One span per delivery attempt.
+        with tracer.start_as_current_span(
+            name="cog.prediction.webhook",
+            context=context,
+            attributes={
+                "prediction.status": response.status.value,
+                "webhook.destination": destination,
+                "http.request_content_length": len(body),
+            },
+        ) as attempt_span:
+            resp = session.post(url, data=body, headers=post_headers, **kwargs)
+            attempt_span.set_attribute("http.status_code", resp.status_code)
+            resp.raise_for_status()
+
+    def _record_delivery(response: PredictionResponse, payload: Any) -> None:
+        delivered_at = _mark(response, "webhook_delivered")
+
+        # Let the caller know what was delivered, e.g. to cache the result.
+        if on_delivered is not None:
+            try:
+                on_delivered(payload)
+            except Exception:
+                log.warn("caught exception in webhook delivery hook", exc_info=True)
+
+        # The prediction span has usually ended by the time the terminal
+        # webhook goes out, so record delivery in a child span of its own.
+        context = trace.set_span_in_context(span) if span else None
+        with tracer.start_as_current_span(
+            name="cog.prediction.delivery",
+            context=context,
+        ) as delivery_span:
+            for phase, ts in (response.metrics or {}).get("timestamps", {}).items():
+                if phase in {"uploaded", "webhook_delivered"}:
+                    delivery_span.add_event(phase, timestamp=int(ts * 1e9))
+
+            if response.created_at:
+                created_at = response.created_at
+                if created_at.tzinfo is None:
+                    created_at = created_at.replace(tzinfo=timezone.utc)
+                end_to_end_time = (delivered_at - created_at).total_seconds()
+                delivery_span.set_attribute(
+                    "prediction.end_to_end_time", end_to_end_time
+                )
+                log.info(
+                    "terminal webhook delivered",
+                    end_to_end_time=end_to_end_time,
+                    status=response.status,
+                )
 
     def caller(response: Dict) -> None:
         if background_tasks:
@@ -74,7 +273,60 @@ def webhook_caller(
     return caller
 
 
-def requests_session(auth_key: Optional[str] = None) -> requests.Session:
+def _mark(response: PredictionResponse, phase: str) -> datetime:
+    at = datetime.now(tz=timezone.utc)
+    if response.metrics is not None:
+        response.metrics.setdefault("timestamps", {})[phase] = at.timestamp()
+    return at
+
+
+def shared_sessions() -> Tuple[requests.Session, requests.Session]:
+    """
+    Return the webhook sessions shared across predictions: one plain and one
+    that retries. They carry no trace context of their own.
+    """
+    global _sessions
+
+    with _sessions_lock:
+        if _sessions is None:
+            _sessions = (
+                requests_session(propagate_trace=False),
+                requests_session_with_retries(propagate_trace=False),
+            )
+        return _sessions
+
+
+def warm(url: Optional[str] = None) -> None:
+    """
+    Create the shared webhook sessions and, given a webhook URL, open a
+    connection to its origin ahead of the first webhook. Webhooks go through
+    the retry scheduler, so only the plain session is connected.
+    """
+    default_session, _ = shared_sessions()
+    if url is not None:
+        preconnect(default_session, url)
+
+
+def preconnect(session: requests.Session, url: str) -> None:
+    """
+    Open a connection to the origin of `url` in the session's pool with a
+    cheap HEAD request. Whatever the response, the connection is kept alive
+    for later requests; failures are logged and otherwise ignored.
+    """
+    parts = urlsplit(url)
+    try:
+        session.head(
+            f"{parts.scheme}://{parts.netloc}/",
+            timeout=WARMUP_TIMEOUT,
+            allow_redirects=False,
+        )
+    except requests.RequestException:
+        log.info("failed to connect ahead of time", origin=parts.netloc, exc_info=True)
+
+
+def requests_session(
+    auth_key: Optional[str] = None, propagate_trace: bool = True
+) -> requests.Session:
     session = requests.Session()
     session.headers["user-agent"] = (
         get_user_agent() + " " + str(session.headers["user-agent"])
@@ -83,20 +335,19 @@ def requests_session(auth_key: Optional[str] = None) -> requests.Session:
     if auth_key:
         session.headers["Authorization"] = f"Bearer {auth_key}"
 
-    ctx = current_trace_context() or {}
-    for key, value in ctx.items():
-        session.headers[key] = str(value)
+    if propagate_trace:
+        session.headers.update(_trace_headers())
 
     return session
 
 
 def requests_session_with_retries(
-    auth_key: Optional[str] = None,
+    auth_key: Optional[str] = None, propagate_trace: bool = True
 ) -> requests.Session:
     # This session will retry requests up to 12 times, with exponential
     # backoff. In total it'll try for up to roughly 320 seconds, providing
     # resilience through temporary networking and availability issues.
-    session = requests_session(auth_key)
+    session = requests_session(auth_key, propagate_trace=propagate_trace)
     adapter = HTTPAdapter(
         max_retries=Retry(
             total=12,
@@ -109,3 +360,8 @@ def requests_session_with_retries(
     session.mount("https://", adapter)
 
     return session
+
+
+def _trace_headers() -> Dict[str, str]:
+    ctx = current_trace_context() or {}
+    return {key: str(value) for key, value in ctx.items()}
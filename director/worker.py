@@ -1,16 +1,56 @@
+import collections
+import redis
 import structlog
 import time
 import threading
 
-from typing import Optional
+from typing import Any, Deque, Dict, Optional, Tuple
+from urllib.parse import urlsplit
 
 from director.background_tasks import BackgroundTasks
+from director.retry import RetryScheduler
 from director.webhook import requests_session
 
 log = structlog.get_logger(__name__)
 
 NEXT_QUEUE_INTERVAL: float = 15.0
 
+# How long the control plane may hold a long-poll next queue request before
+# answering with the current assignment, in seconds.
+NEXT_QUEUE_WAIT: float = 30.0
+
+# A long-poll that answers faster than this without a change means the control
+# plane doesn't support holding requests, so fall back to the poll interval.
+MIN_LONG_POLL: float = 1.0
+
+# How often to resynchronize the assignment over HTTP while listening for
+# pub/sub updates, in case a published change was missed, in seconds.
+PUBSUB_RESYNC_INTERVAL: float = 60.0
+
+NEXT_QUEUE_MODES = ("poll", "long-poll", "pubsub")
+
+# How long to wait for further status changes before reporting the latest
+# one, in seconds. Busy/idle flips within this window are coalesced.
+REPORT_DEBOUNCE: float = 0.5
+
+# How often to report even if the status hasn't changed, so that the rolling
+# counters stay fresh while the worker is continuously busy, in seconds.
+REPORT_HEARTBEAT: float = 15.0
+
+# How many times the retry scheduler should try a status report before giving
+# up on it; a newer status supersedes it anyway.
+REPORT_ATTEMPTS = 3
+
+# Timeout for a single status report, in seconds.
+REPORT_TIMEOUT = 10.0
+
+# How often to log that the worker can't report its status, at most, in
+# seconds. Whether it can doesn't change while running.
+CANNOT_REPORT_LOG_INTERVAL = 3600.0
+
+# Window over which the rolling counters are computed, in seconds.
+STATS_WINDOW: float = 60.0
+
 
 class Worker:
     def __init__(
@@ -20,8 +60,19 @@ class Worker:
         id: Optional[str] = None,
         report_url: Optional[str] = None,
         report_key: Optional[str] = None,
+        next_queue_mode: str = "poll",
+        redis_url: Optional[str] = None,
+        retry_scheduler: Optional[RetryScheduler] = None,
     ):
+        if next_queue_mode not in NEXT_QUEUE_MODES:
+            raise ValueError(f"unknown next queue mode: {next_queue_mode}")
+        if next_queue_mode == "pubsub" and not redis_url:
+            raise ValueError("pubsub next queue mode requires a redis url")
+
         self.background_tasks = background_tasks
+        self.retry_scheduler = retry_scheduler
+        self.next_queue_mode = next_queue_mode
+        self.redis_url = redis_url
 
         self.id = id
         self.report_url = f"{report_url}/worker"
@@ -31,83 +82,340 @@ class Worker:
         self.switched = False
         self.expired = False
 
+        self.stats = WorkerStats()
+        self.backlog: Optional[Dict[str, Any]] = None
+
         self._thread: Optional[threading.Thread] = None
+        self._reporter: Optional[threading.Thread] = None
         self._should_exit = threading.Event()
 
+        # Latest status not yet sent, guarded by _report_cond.
+        self._report_cond = threading.Condition()
+        self._pending_status: Optional[str] = None
+        self._last_status: Optional[str] = None
+        self._report_lock = threading.Lock()
+
     def start(self) -> None:
         self._thread = threading.Thread(target=self._run)
         self._thread.start()
 
+        self._reporter = threading.Thread(target=self._report_loop)
+        self._reporter.start()
+
     def stop(self) -> None:
         log.info("Stopping worker report.")
 
         self._should_exit.set()
+        with self._report_cond:
+            self._report_cond.notify_all()
 
     def join(self) -> None:
         if self._thread is not None:
             self._thread.join()
+        if self._reporter is not None:
+            self._reporter.join()
 
         log.info("Worker is down")
 
+    @property
+    def queue_channel(self) -> str:
+        return f"worker:{self.id}:queue"
+
     def _run(self):
+        if self.next_queue_mode == "long-poll" and self._can_report():
+            self._run_long_poll()
+        elif self.next_queue_mode == "pubsub" and self._can_report():
+            self._run_pubsub()
+        else:
+            self._run_poll()
+
+    def _run_poll(self):
         while not self._should_exit.is_set():
             self.next_queue()
-            time.sleep(NEXT_QUEUE_INTERVAL)
+            self._should_exit.wait(NEXT_QUEUE_INTERVAL)
+
+    def _run_long_poll(self):
+        while not self._should_exit.is_set():
+            mark = time.perf_counter()
+            changed = self._next_queue(wait=NEXT_QUEUE_WAIT)
+
+            if changed is None:
+                # Request failed: back off before trying again.
+                self._should_exit.wait(NEXT_QUEUE_INTERVAL)
+            elif not changed and time.perf_counter() - mark < MIN_LONG_POLL:
+                self._should_exit.wait(NEXT_QUEUE_INTERVAL)
+
+    def _run_pubsub(self):
+        while not self._should_exit.is_set():
+            try:
+                client = redis.Redis.from_url(self.redis_url)
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.queue_channel)
+                log.info("subscribed to queue assignments", channel=self.queue_channel)
+
+                try:
+                    self._listen(pubsub)
+                finally:
+                    pubsub.close()
+                    client.close()
+
+            except redis.RedisError:
+                log.error("queue assignment subscription failed", exc_info=True)
+                self._should_exit.wait(NEXT_QUEUE_INTERVAL)
+
+    def _listen(self, pubsub: redis.client.PubSub):
+        # Subscribed: fetch the current assignment so that nothing published
+        # before the subscription was established is missed.
+        self._next_queue()
+        resync_at = time.perf_counter() + PUBSUB_RESYNC_INTERVAL
+
+        while not self._should_exit.is_set():
+            message = pubsub.get_message(timeout=1.0)
+            if message is not None and message["type"] == "message":
+                data = message["data"]
+                if isinstance(data, bytes):
+                    data = data.decode()
+                self._apply_queue(data or None)
+
+            if time.perf_counter() >= resync_at:
+                self._next_queue()
+                resync_at = time.perf_counter() + PUBSUB_RESYNC_INTERVAL
 
     def prepare(self):
         self.report("prepare")
 
     def idle(self):
+        self.stats.idle()
         self.report("idle")
 
     def busy(self):
+        self.stats.busy()
         self.report("busy")
 
     def shutdown(self):
         self.report("shutdown")
 
+    def record_prediction(self, succeeded: bool) -> None:
+        self.stats.record(succeeded)
+
+    def set_backlog(self, backlog: Any) -> None:
+        self.backlog = backlog.to_dict()
+
     def report(self, status: str):
         if not self._can_report():
             return
 
-        self.background_tasks.add_task(self._report, status)
+        # Shutdown is the last thing we'll ever say, so don't let it sit in
+        # the debounce window, and make sure nothing is said after it.
+        if status == "shutdown":
+            with self._report_cond:
+                self._pending_status = None
+                self._last_status = status
+            self._report(status)
+            return
+
+        with self._report_cond:
+            if self._last_status == "shutdown":
+                return
+            self._pending_status = status
+            self._report_cond.notify_all()
+
+    def _report_loop(self):
+        while not self._should_exit.is_set():
+            with self._report_cond:
+                self._report_cond.wait_for(
+                    lambda: self._pending_status is not None
+                    or self._should_exit.is_set(),
+                    timeout=REPORT_HEARTBEAT,
+                )
+
+            if self._should_exit.is_set():
+                break
+
+            # Let further changes arrive, then send whatever is latest.
+            self._should_exit.wait(REPORT_DEBOUNCE)
+
+            with self._report_cond:
+                status = self._pending_status or self._last_status
+                self._pending_status = None
+
+            if status is not None and status != "shutdown":
+                self._submit_report(status)
+
+    def _remember(self, status: str):
+        # Remember the desired status even if sending it fails, so that the
+        # next heartbeat retries it.
+        with self._report_cond:
+            if self._last_status != "shutdown":
+                self._last_status = status
 
     def _report(self, status: str):
+        self._remember(status)
         try:
+            self._put_status(status)
+        except:
+            log.error("failed to report worker status", exc_info=True)
+
+    def _submit_report(self, status: str):
+        if self.retry_scheduler is None:
+            self._report(status)
+            return
+
+        self._remember(status)
+        self.retry_scheduler.submit(
+            urlsplit(self.report_url).netloc,
+            lambda: self._put_status(status),
+            key=f"worker-status:{self.id}",
+            max_attempts=REPORT_ATTEMPTS,
+        )
+
+    def _put_status(self, status: str):
+        # Reports are sent one at a time, so that one still queued or being
+        # retried can't overtake shutdown, and is dropped once it's been said.
+        with self._report_lock:
+            with self._report_cond:
+                superseded = self._last_status == "shutdown" and status != "shutdown"
+            if superseded:
+                log.debug(
+                    "dropping worker status superseded by shutdown", status=status
+                )
+                return
+
             resp = self.session.put(
-                f"{self.report_url}/status/{self.id}?status={status}"
+                f"{self.report_url}/status/{self.id}",
+                params={"status": status},
+                json={**self.stats.snapshot(), "backlog": self.backlog},
+                timeout=REPORT_TIMEOUT,
             )
             resp.raise_for_status()
 
-        except:
-            log.error("failed to report worker status", exc_info=True)
-
     def next_queue(self):
         if not self._can_report():
             return
 
         self.background_tasks.add_task(self._next_queue)
 
-    def _next_queue(self):
+    def _next_queue(self, wait: Optional[float] = None) -> Optional[bool]:
+        """
+        Fetch the current queue assignment. With `wait`, ask the control plane
+        to hold the request until the assignment differs from our current
+        queue or `wait` seconds pass. Returns whether the queue changed, or
+        None if the request failed.
+        """
+        params = None
+        timeout = None
+        if wait is not None:
+            params = {"wait": wait, "queue": self.queue}
+            timeout = wait + 10
+
         try:
-            resp = self.session.get(f"{self.report_url}/next_queue/{self.id}")
+            resp = self.session.get(
+                f"{self.report_url}/next_queue/{self.id}",
+                params=params,
+                timeout=timeout,
+            )
             resp.raise_for_status()
 
-            queue = resp.json().get("queue")
-
-            self.expired = queue is None
-            if queue != self.queue:
-                # Update worker queue.
-                self.switched = queue != self.queue
-                self.queue = queue
+            return self._apply_queue(resp.json().get("queue"))
 
         except:
             log.error("failed to get next queue", exc_info=True)
+            return None
+
+    def _apply_queue(self, queue: Optional[str]) -> bool:
+        self.expired = queue is None
+        if queue == self.queue:
+            return False
+
+        log.info("queue assignment changed", queue=queue, previous=self.queue)
+
+        # Update worker queue.
+        self.switched = True
+        self.queue = queue
+        return True
 
     def _can_report(self):
         can_report = self.id and self.report_url
 
         if not can_report:
-            log.info(f"Worker cannot report. ID: {self.id} URL: {self.report_url}")
+            log.info(
+                "worker cannot report",
+                worker_id=self.id,
+                report_url=self.report_url,
+                rate_limit=CANNOT_REPORT_LOG_INTERVAL,
+            )
 
         return can_report
+
+
+class WorkerStats:
+    """
+    Rolling counters over the last STATS_WINDOW seconds: predictions completed,
+    predictions failed and the fraction of time spent busy.
+    """
+
+    def __init__(self, window: float = STATS_WINDOW):
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._busy_since: Optional[float] = None
+        self._busy_spans: Deque[Tuple[float, float]] = collections.deque()
+        self._outcomes: Deque[Tuple[float, bool]] = collections.deque()
+
+    def busy(self) -> None:
+        with self._lock:
+            if self._busy_since is None:
+                self._busy_since = time.monotonic()
+
+    def idle(self) -> None:
+        with self._lock:
+            if self._busy_since is not None:
+                self._busy_spans.append((self._busy_since, time.monotonic()))
+                self._busy_since = None
+
+    def record(self, succeeded: bool) -> None:
+        with self._lock:
+            self._outcomes.append((time.monotonic(), succeeded))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            window_start = now - self.window
+            self._expire(window_start)
+
+            busy_seconds = sum(
+                end - max(start, window_start) for start, end in self._busy_spans
+            )
+            if self._busy_since is not None:
+                busy_seconds += now - max(self._busy_since, window_start)
+
+            elapsed = self._elapsed(now)
+            completed = sum(1 for _, ok in self._outcomes if ok)
+
+            return {
+                "window": self.window,
+                "completed": completed,
+                "failed": len(self._outcomes) - completed,
+                "utilization": min(busy_seconds / elapsed, 1.0) if elapsed else 0.0,
+                "service_rate": len(self._outcomes) / elapsed if elapsed else 0.0,
+            }
+
+    def service_rate(self) -> float:
+        """
+        Predictions finished per second over the window.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now - self.window)
+            elapsed = self._elapsed(now)
+            return len(self._outcomes) / elapsed if elapsed else 0.0
+
+    def _elapsed(self, now: float) -> float:
+        return min(self.window, now - self._started_at)
+
+    def _expire(self, window_start: float) -> None:
+        while self._busy_spans and self._busy_spans[0][1] < window_start:
+            self._busy_spans.popleft()
+        while self._outcomes and self._outcomes[0][0] < window_start:
+            self._outcomes.popleft()
@@ -0,0 +1,62 @@
+import threading
+import time
+import pytest
+
+from fakeredis import TcpFakeServer
+from kombu import Connection
+from typing import Any, Callable, Iterator, Tuple
+
+from benchmarks.standins import FakeControlPlane
+from director.backlog import queue_length
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def serve_redis(address: Tuple[str, int] = ("127.0.0.1", 0)) -> TcpFakeServer:
+    server = TcpFakeServer(address, server_type="redis")
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fill_queue(redis_url: str, queue: str, n: int) -> None:
+    with Connection(redis_url) as conn:
+        q = conn.SimpleQueue(queue)
+        for i in range(n):
+            q.put({"id": f"p{i}"})
+        q.close()
+
+
+def queue_size(redis_url: str, queue: str) -> int:
+    with Connection(redis_url) as conn:
+        return queue_length(conn.default_channel, queue)
+
+
+def stop_server(server: Any) -> None:
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def redis_server() -> Iterator[TcpFakeServer]:
+    server = serve_redis()
+    yield server
+    stop_server(server)
+
+
+@pytest.fixture
+def redis_url(redis_server: TcpFakeServer) -> str:
+    host, port = redis_server.server_address[:2]
+    return f"redis://{host}:{port}/0"
+
+
+@pytest.fixture
+def control_plane() -> FakeControlPlane:
+    return FakeControlPlane(queue="q1")
@@ -0,0 +1,37 @@
+from kombu import Connection
+
+from director.backlog import BacklogSampler, queue_length
+
+
+def test_queue_length_counts_messages_until_drained(redis_url):
+    with Connection(redis_url) as conn:
+        queue = conn.SimpleQueue("q")
+        for i in range(3):
+            queue.put({"i": i})
+
+        assert queue_length(conn.default_channel, "q") == 3
+
+        for _ in range(3):
+            queue.get(timeout=1).ack()
+
+        assert queue_length(conn.default_channel, "q") == 0
+        assert queue_length(conn.default_channel, "missing") == 0
+        queue.close()
+
+
+def test_sampler_reports_drained_queue_as_empty(redis_url):
+    sampler = BacklogSampler(redis_url=redis_url, queue=lambda: "q")
+
+    with Connection(redis_url) as conn:
+        queue = conn.SimpleQueue("q")
+        queue.put({"created_at": "2024-01-01T00:00:00Z"})
+        sampler._sample(conn)
+        assert sampler.latest is not None
+        assert sampler.latest.length == 1
+        assert sampler.latest.oldest_age is not None
+
+        queue.get(timeout=1).ack()
+        sampler._sample(conn)
+        assert sampler.latest.length == 0
+        assert sampler.latest.oldest_age is None
+        queue.close()
@@ -0,0 +1,43 @@
+import pytest
+import redis
+
+from typing import Iterator
+
+from director.cancellation import DEFAULT_CHANNEL, KEY_PREFIX, Cancellations
+
+from .conftest import wait_for
+
+
+@pytest.fixture
+def cancellations(redis_url: str) -> Iterator[Cancellations]:
+    cancellations = Cancellations(redis_url)
+    cancellations.start()
+    yield cancellations
+    cancellations.stop()
+    cancellations.join()
+
+
+def test_published_cancelations_are_remembered(redis_url, cancellations):
+    client = redis.Redis.from_url(redis_url)
+    assert wait_for(lambda: client.publish(DEFAULT_CHANNEL, "p1"))
+
+    assert wait_for(lambda: cancellations.is_canceled("p1"))
+    assert not cancellations.is_canceled("p2")
+
+
+def test_cancelation_keys_are_only_checked_on_request(redis_url):
+    client = redis.Redis.from_url(redis_url)
+    client.set(KEY_PREFIX + "p1", 1, ex=60)
+    cancellations = Cancellations(redis_url)
+
+    assert not cancellations.is_canceled("p1")
+    assert cancellations.is_canceled("p1", check_redis=True)
+    assert not cancellations.is_canceled("p2", check_redis=True)
+
+
+def test_unreachable_redis_means_not_canceled():
+    cancellations = Cancellations("redis://127.0.0.1:1")
+    cancellations.cancel("p1")
+
+    assert cancellations.is_canceled("p1", check_redis=True)
+    assert not cancellations.is_canceled("p2", check_redis=True)
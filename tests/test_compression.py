@@ -0,0 +1,61 @@
+import gzip
+import json
+import pytest
+
+from pydantic import ValidationError
+
+from director.compression import CompressionParams, encode_json
+
+PAYLOAD = {"output": ["x" * 100] * 100}
+
+
+def test_small_bodies_are_sent_as_is():
+    body, headers = encode_json({"id": "p1"}, CompressionParams(threshold=1024))
+    assert json.loads(body) == {"id": "p1"}
+    assert "Content-Encoding" not in headers
+
+
+def test_no_params_means_no_compression():
+    body, headers = encode_json(PAYLOAD)
+    assert json.loads(body) == PAYLOAD
+    assert "Content-Encoding" not in headers
+
+
+def test_gzip_round_trip():
+    body, headers = encode_json(PAYLOAD, CompressionParams(threshold=0))
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Content-Type"] == "application/json"
+    assert json.loads(gzip.decompress(body)) == PAYLOAD
+
+
+def test_zstd_round_trip():
+    zstandard = pytest.importorskip("zstandard")
+    params = CompressionParams(encoding="zstd", threshold=0)
+    body, headers = encode_json(PAYLOAD, params)
+    assert headers["Content-Encoding"] == "zstd"
+    decompressed = zstandard.ZstdDecompressor().decompress(body)
+    assert json.loads(decompressed) == PAYLOAD
+
+
+def test_incompressible_bodies_are_sent_as_is():
+    body, headers = encode_json("x", CompressionParams(threshold=0))
+    assert body == b'"x"'
+    assert "Content-Encoding" not in headers
+
+
+def test_rejects_unknown_encoding():
+    with pytest.raises(ValidationError):
+        CompressionParams(encoding="brotli")
+
+
+def test_rejects_non_finite_numbers():
+    with pytest.raises(ValueError):
+        encode_json({"output": float("nan")})
+
+
+def test_zstd_falls_back_to_gzip_without_zstandard(monkeypatch):
+    monkeypatch.setattr("director.compression._zstandard", lambda: None)
+    params = CompressionParams(encoding="zstd", threshold=0)
+    body, headers = encode_json(PAYLOAD, params)
+    assert headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(body)) == PAYLOAD
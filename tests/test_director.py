@@ -0,0 +1,371 @@
+import os
+import queue
+import signal
+import threading
+import pytest
+import redis
+
+from datetime import datetime, timedelta, timezone
+
+from cog import schema
+from cog.server.http import Health
+from typing import Any, Dict, Iterator, List, Optional
+
+from benchmarks.standins import (
+    FakeModel,
+    ModelProfile,
+    _model_handler,
+    _receiver_handler,
+    _serve,
+)
+from director.background_tasks import BackgroundTasks
+from director.cancellation import DEFAULT_CHANNEL, Cancellations
+from director.cancellation import KEY_PREFIX as CANCEL_KEY_PREFIX
+from director.director import Abort, Director, _deadline
+from director.event_types import HealthcheckStatus, Webhook
+from director.health_checker import Healthchecker
+from director.ledger import CompletionLedger
+from director.monitor import Monitor
+from director.result_cache import ResultCache
+from director.spill import Spill
+from director.worker import Worker
+
+from .conftest import fill_queue, queue_size, stop_server, wait_for
+
+
+class _Model(FakeModel):
+    """
+    The fake model container, sending its webhooks straight to the director's
+    event queue rather than to the director's HTTP server.
+    """
+
+    def __init__(self, events: queue.Queue, profile: ModelProfile):
+        super().__init__(profile)
+        self.events = events
+        self.spill: Optional[Spill] = None
+        self.predictions: List[str] = []
+
+    def predict(self, request: Dict[str, Any]) -> None:
+        self.predictions.append(request["id"])
+        super().predict(request)
+
+    def _send(self, url: str, response: Dict[str, Any]) -> None:
+        payload = schema.PredictionResponse(**response)
+        # Like the director's webhook endpoint.
+        if self.spill is not None and payload.output is not None:
+            payload.output = self.spill.spill(payload.output, payload.id)
+        self.events.put(Webhook(payload=payload))
+
+
+class _Message:
+    def __init__(self) -> None:
+        self.acked = False
+
+    def ack(self) -> None:
+        self.acked = True
+
+
+class _Harness:
+    def __init__(
+        self,
+        model: _Model,
+        cog_url: str,
+        receiver_url: str,
+        received: "queue.Queue[Dict[str, Any]]",
+    ) -> None:
+        self.model = model
+        self.events = model.events
+        self.cog_url = cog_url
+        self.receiver_url = receiver_url
+        # Terminal webhooks, as recorded by the receiver.
+        self.received = received
+
+    def director(self, **kwargs: Any) -> Director:
+        kwargs.setdefault("predict_timeout", 10)
+        kwargs.setdefault("redis_url", "redis://127.0.0.1:1/0")
+        director = Director(
+            events=self.events,
+            healthchecker=Healthchecker(
+                events=self.events,
+                fetcher=lambda: HealthcheckStatus(health=Health.READY),
+            ),
+            monitor=Monitor(),
+            worker=Worker(queue="q1", background_tasks=BackgroundTasks()),
+            consume_timeout=1,
+            max_failure_count=0,
+            **kwargs,
+        )
+        director.cog_http_base = self.cog_url
+        return director
+
+    def message(self, prediction_id: str = "p1", **fields: Any) -> Dict[str, Any]:
+        return {
+            "id": prediction_id,
+            "version": "v1",
+            "input": {"prompt": "hello"},
+            "webhook": {"url": self.receiver_url},
+            **fields,
+        }
+
+    def deliver(self, director: Director, body: Dict[str, Any]) -> _Message:
+        message = _Message()
+        director._on_message(body, message)
+        return message
+
+    def terminal(self, timeout: float = 5.0) -> Dict[str, Any]:
+        return self.received.get(timeout=timeout)
+
+
+@pytest.fixture
+def harness() -> Iterator[_Harness]:
+    events: queue.Queue = queue.Queue()
+    profile = ModelProfile(
+        latency=0.05, output_size=1024, log_rate=0, webhook_rate=0, setup_time=0
+    )
+    model = _Model(events, profile)
+
+    cog = _serve(("127.0.0.1", 0), _model_handler(model))
+    received: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+    receiver = _serve(("127.0.0.1", 0), _receiver_handler(received))  # type: ignore
+
+    yield _Harness(
+        model,
+        cog_url="http://%s:%d" % cog.server_address[:2],
+        receiver_url="http://%s:%d/webhook" % receiver.server_address[:2],
+        received=received,
+    )
+
+    stop_server(cog)
+    stop_server(receiver)
+
+
+def test_prediction_runs_and_sends_terminal_webhook(harness):
+    director = harness.director()
+    message = harness.deliver(director, harness.message())
+
+    assert message.acked
+    assert harness.model.predictions == ["p1"]
+    assert harness.terminal()["status"] == "succeeded"
+
+
+def test_spilled_outputs_are_released_without_background_tasks(harness, tmp_path):
+    spill = Spill(str(tmp_path), threshold=100)
+    harness.model.spill = spill
+    director = harness.director(spill=spill)
+
+    # Nothing releases the spilled outputs of a prediction without a webhook
+    # but the director itself.
+    body = harness.message()
+    del body["webhook"]
+    message = harness.deliver(director, body)
+
+    assert message.acked
+    assert harness.model.predictions == ["p1"]
+    assert len(spill) == 0
+    assert os.listdir(spill.directory) == []
+
+
+def test_deadline_from_iso_timestamp():
+    deadline = _deadline({"deadline": "2030-01-02T03:04:05+01:00"}, None)
+    assert deadline == datetime(2030, 1, 2, 2, 4, 5, tzinfo=timezone.utc)
+
+
+def test_deadline_from_epoch_timestamp():
+    deadline = _deadline({"deadline": 1893549845}, None)
+    assert deadline == datetime(2030, 1, 2, 2, 4, 5, tzinfo=timezone.utc)
+
+
+def test_naive_deadline_is_utc():
+    deadline = _deadline({"deadline": "2030-01-02T02:04:05"}, None)
+    assert deadline == datetime(2030, 1, 2, 2, 4, 5, tzinfo=timezone.utc)
+
+
+def test_deadline_from_ttl_is_relative_to_creation():
+    created_at = datetime(2030, 1, 1, tzinfo=timezone.utc)
+    assert _deadline({"ttl": 90}, created_at) == created_at + timedelta(seconds=90)
+    # Without a creation time, a TTL means nothing.
+    assert _deadline({"ttl": 90}, None) is None
+
+
+def test_earliest_deadline_wins():
+    created_at = datetime(2030, 1, 1, tzinfo=timezone.utc)
+    message = {"deadline": "2030-01-01T00:01:00Z", "ttl": "120"}
+    assert _deadline(message, created_at) == datetime(
+        2030, 1, 1, 0, 1, tzinfo=timezone.utc
+    )
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        {"deadline": "tomorrow"},
+        {"deadline": {"at": 1}},
+        {"ttl": "soon"},
+        {"ttl": [1]},
+        {},
+    ],
+)
+def test_invalid_or_missing_deadline_is_ignored(message):
+    assert _deadline(message, datetime.now(tz=timezone.utc)) is None
+
+
+def test_expired_prediction_fails_without_running(harness):
+    director = harness.director()
+    created_at = datetime.now(tz=timezone.utc) - timedelta(minutes=5)
+    body = harness.message(created_at=created_at.isoformat(), ttl=60)
+    message = harness.deliver(director, body)
+
+    assert message.acked
+    assert harness.model.predictions == []
+    terminal = harness.terminal()
+    assert terminal["status"] == "failed"
+    assert terminal["metrics"]["expired"] is True
+
+
+def test_prediction_runs_before_its_deadline(harness):
+    director = harness.director()
+    deadline = datetime.now(tz=timezone.utc) + timedelta(minutes=5)
+    message = harness.deliver(director, harness.message(deadline=deadline.isoformat()))
+
+    assert message.acked
+    assert harness.model.predictions == ["p1"]
+    assert harness.terminal()["status"] == "succeeded"
+
+
+def test_invalid_deadline_does_not_stop_the_prediction(harness):
+    director = harness.director()
+    message = harness.deliver(director, harness.message(deadline="tomorrow"))
+
+    assert message.acked
+    assert harness.model.predictions == ["p1"]
+    assert harness.terminal()["status"] == "succeeded"
+
+
+def test_nothing_is_fetched_when_setup_fails(harness, redis_url):
+    fill_queue(redis_url, "q1", 2)
+    director = harness.director(redis_url=redis_url)
+
+    # Setup fails once the consumer has connected ahead of time.
+    connected = []
+
+    def fail_setup():
+        connected.append(wait_for(lambda: director._consumer.connected("q1")))
+        harness.events.put(HealthcheckStatus(health=Health.SETUP_FAILED))
+
+    handlers = {s: signal.getsignal(s) for s in (signal.SIGINT, signal.SIGTERM)}
+    threading.Thread(target=fail_setup).start()
+    try:
+        with pytest.raises(Abort):
+            director.start()
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    assert connected == [True]
+    assert harness.model.predictions == []
+    assert queue_size(redis_url, "q1") == 2
+
+
+def test_health_confirmation_is_stamped_on_the_message_it_guarded(harness):
+    director = harness.director()
+    harness.events.put(HealthcheckStatus(health=Health.READY))
+    director._confirm_model_health()
+    confirmed_at = director._health_confirmed_at
+
+    harness.deliver(director, harness.message("p1"))
+    timestamps = harness.terminal()["metrics"]["timestamps"]
+    assert timestamps["health_confirmed"] == confirmed_at.timestamp()
+    assert timestamps["health_confirmed"] <= timestamps["dequeued"]
+
+    # The next message wasn't guarded by a confirmation of its own.
+    harness.deliver(director, harness.message("p2"))
+    assert "health_confirmed" not in harness.terminal()["metrics"]["timestamps"]
+
+
+def test_cache_hit_skips_the_model(harness):
+    director = harness.director(result_cache=ResultCache())
+    harness.deliver(director, harness.message("p1"))
+    assert harness.terminal()["metrics"].get("cache_hit") is None
+
+    message = harness.deliver(director, harness.message("p2"))
+
+    assert message.acked
+    assert harness.model.predictions == ["p1"]
+    terminal = harness.terminal()
+    assert terminal["id"] == "p2"
+    assert terminal["status"] == "succeeded"
+    assert terminal["metrics"]["cache_hit"] is True
+
+
+def test_different_input_misses_the_cache(harness):
+    director = harness.director(result_cache=ResultCache())
+    harness.deliver(director, harness.message("p1"))
+    harness.deliver(director, harness.message("p2", input={"prompt": "bye"}))
+
+    assert harness.model.predictions == ["p1", "p2"]
+
+
+def test_redelivered_completed_prediction_is_not_run_again(harness, redis_url):
+    director = harness.director(ledger=CompletionLedger(redis_url))
+    harness.deliver(director, harness.message("p1"))
+    first = harness.terminal()
+
+    message = harness.deliver(director, harness.message("p1"))
+
+    assert message.acked
+    assert harness.model.predictions == ["p1"]
+    resent = harness.terminal()
+    assert resent["id"] == "p1"
+    assert resent["status"] == "succeeded"
+    assert resent["metrics"] == first["metrics"]
+
+
+def test_redelivered_prediction_without_payload_is_skipped(
+    harness, redis_url, monkeypatch
+):
+    # Completed, but too big for its terminal state to be kept.
+    monkeypatch.setattr("director.ledger.MAX_PAYLOAD_SIZE", 0)
+    ledger = CompletionLedger(redis_url)
+    ledger.record("p1", {"id": "p1", "status": "succeeded"})
+    director = harness.director(ledger=ledger)
+
+    message = harness.deliver(director, harness.message("p1"))
+
+    assert message.acked
+    assert harness.model.predictions == []
+    with pytest.raises(queue.Empty):
+        harness.terminal(timeout=0.5)
+
+
+def test_cancelation_published_mid_prediction(harness, redis_url):
+    cancellations = Cancellations(redis_url)
+    cancellations.start()
+    harness.model.profile.latency = 10
+    director = harness.director(cancellations=cancellations)
+
+    def cancel():
+        client = redis.Redis.from_url(redis_url)
+        wait_for(lambda: harness.model.predictions == ["p1"])
+        wait_for(lambda: client.publish(DEFAULT_CHANNEL, "p1"))
+
+    threading.Thread(target=cancel).start()
+    try:
+        message = harness.deliver(director, harness.message("p1"))
+    finally:
+        cancellations.stop()
+        cancellations.join()
+
+    assert message.acked
+    assert harness.model.canceled == {"p1"}
+    assert harness.terminal()["status"] == "canceled"
+
+
+def test_prediction_canceled_while_queued_is_not_run(harness, redis_url):
+    redis.Redis.from_url(redis_url).set(CANCEL_KEY_PREFIX + "p1", 1, ex=60)
+    director = harness.director(cancellations=Cancellations(redis_url))
+
+    message = harness.deliver(director, harness.message("p1"))
+
+    assert message.acked
+    assert harness.model.predictions == []
+    assert harness.terminal()["status"] == "canceled"
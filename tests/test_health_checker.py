@@ -0,0 +1,70 @@
+import queue
+
+from cog.server.http import Health
+from typing import List, Tuple
+
+from director.event_types import HealthcheckStatus
+from director.health_checker import FAILURE_THRESHOLD, Healthchecker
+
+
+def _checker(probes: List[Health]) -> Tuple[Healthchecker, queue.Queue]:
+    results = iter(probes)
+    events: queue.Queue = queue.Queue()
+    checker = Healthchecker(
+        events=events,
+        fetcher=lambda: HealthcheckStatus(health=next(results)),
+    )
+    return checker, events
+
+
+def _emitted(events: queue.Queue) -> List[Health]:
+    emitted = []
+    while not events.empty():
+        emitted.append(events.get().health)
+    return emitted
+
+
+def test_failed_probes_are_absorbed_below_threshold():
+    probes = [Health.READY] + [Health.UNKNOWN] * (FAILURE_THRESHOLD - 1)
+    checker, events = _checker(probes + [Health.BUSY])
+    for _ in range(len(probes) + 1):
+        checker._check()
+
+    assert _emitted(events) == [Health.READY, Health.BUSY]
+
+
+def test_persistent_failure_is_reported():
+    checker, events = _checker([Health.READY] + [Health.UNKNOWN] * FAILURE_THRESHOLD)
+    for _ in range(FAILURE_THRESHOLD + 1):
+        checker._check()
+
+    assert _emitted(events) == [Health.READY, Health.UNKNOWN]
+
+
+def test_requested_status_after_failed_probe_is_not_stale():
+    checker, events = _checker([Health.READY, Health.UNKNOWN, Health.UNKNOWN])
+    checker._check()
+    checker._check(force_update=True)
+
+    assert _emitted(events) == [Health.READY, Health.UNKNOWN]
+
+
+def test_requested_status_after_blip_reprobes():
+    probes = [Health.READY, Health.UNKNOWN, Health.UNKNOWN, Health.READY]
+    checker, events = _checker(probes + [Health.UNKNOWN] * (FAILURE_THRESHOLD - 1))
+    checker._check()
+    checker._check()
+    checker._check(force_update=True)
+    for _ in range(FAILURE_THRESHOLD - 1):
+        checker._check()
+
+    # The retried probe succeeds, and resets the count of failures.
+    assert _emitted(events) == [Health.READY, Health.READY]
+
+
+def test_failures_during_setup_are_reported():
+    checker, events = _checker([Health.STARTING, Health.UNKNOWN])
+    checker._check()
+    checker._check()
+
+    assert _emitted(events) == [Health.STARTING, Health.UNKNOWN]
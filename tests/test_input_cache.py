@@ -0,0 +1,88 @@
+import threading
+import time
+import pytest
+
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, Iterator
+
+from benchmarks.standins import _serve
+from director.input_cache import InputCache
+
+from .conftest import stop_server
+
+
+class _Inputs:
+    def __init__(self) -> None:
+        self.url = ""
+        self.requests: Dict[str, int] = {}
+        self.release = threading.Event()
+        self.release.set()
+
+
+@pytest.fixture
+def inputs() -> Iterator:
+    state = _Inputs()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            state.requests[self.path] = state.requests.get(self.path, 0) + 1
+            state.release.wait()
+            body = self.path.encode() * 100
+            self.send_response(200)
+            self.send_header("content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = _serve(("127.0.0.1", 0), Handler)
+    state.url = "http://%s:%d" % server.server_address[:2]
+    yield state
+    state.release.set()
+    stop_server(server)
+
+
+def test_cached_inputs_survive_restart(tmp_path, inputs):
+    url = f"{inputs.url}/image.png"
+    cache = InputCache(str(tmp_path))
+    rewritten, pinned = cache.rewrite({"image": url})
+    cache.release(pinned)
+    assert rewritten["image"].endswith("/image.png")
+    assert inputs.requests == {"/image.png": 1}
+
+    restarted = InputCache(str(tmp_path))
+    assert len(restarted) == 1
+    assert restarted.rewrite({"image": url})[0] == rewritten
+    assert inputs.requests == {"/image.png": 1}
+
+
+def test_evicted_inputs_are_dropped_from_the_index(tmp_path, inputs):
+    cache = InputCache(str(tmp_path), max_bytes=300)
+    for name in ("a", "b"):
+        _, pinned = cache.rewrite({"x": f"{inputs.url}/{name}"})
+        cache.release(pinned)
+    assert len(cache) == 1
+
+    restarted = InputCache(str(tmp_path), max_bytes=300)
+    restarted.rewrite({"x": f"{inputs.url}/a"})
+    assert inputs.requests == {"/a": 2, "/b": 1}
+
+
+def test_rewrite_waits_at_most_wait_timeout(tmp_path, inputs):
+    url = f"{inputs.url}/slow"
+    inputs.release.clear()
+    cache = InputCache(str(tmp_path), wait_timeout=0.2)
+
+    mark = time.monotonic()
+    rewritten, pinned = cache.rewrite({"a": url, "b": [url]})
+    assert time.monotonic() - mark < 1.0
+    assert rewritten == {"a": url, "b": [url]}
+    assert pinned == []
+
+    # The download carries on, for the next prediction with that input.
+    inputs.release.set()
+    cache.wait_timeout = 5.0
+    rewritten, pinned = cache.rewrite({"a": url})
+    assert rewritten["a"] != url
+    assert inputs.requests == {"/slow": 1}
@@ -0,0 +1,36 @@
+import time
+
+from director.ledger import MAX_PAYLOAD_SIZE, CompletionLedger
+
+
+def test_records_are_looked_up_by_prediction_id(redis_url):
+    CompletionLedger(redis_url).record("p1", {"status": "succeeded"})
+
+    ledger = CompletionLedger(redis_url)
+    assert ledger.lookup("p1") == {"payload": {"status": "succeeded"}}
+    assert ledger.lookup("p2") is None
+
+
+def test_large_payloads_are_recorded_without_them(redis_url):
+    ledger = CompletionLedger(redis_url)
+    ledger.record("p1", {"output": "x" * MAX_PAYLOAD_SIZE})
+    assert ledger.lookup("p1") == {"payload": None}
+
+
+def test_sub_second_ttl(redis_url):
+    ledger = CompletionLedger(redis_url, ttl=0.2)
+    ledger.record("p1", {"status": "succeeded"})
+    assert ledger.lookup("p1") is not None
+
+    time.sleep(0.3)
+    assert ledger.lookup("p1") is None
+
+
+def test_warm_connects_ahead_of_time(redis_url):
+    ledger = CompletionLedger(redis_url)
+    ledger.warm()
+    assert len(ledger._redis.connection_pool._available_connections) == 1
+
+
+def test_warm_ignores_unreachable_redis():
+    CompletionLedger("redis://127.0.0.1:1/0").warm()
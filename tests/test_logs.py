@@ -0,0 +1,71 @@
+import pytest
+import structlog
+
+from director.logs import RateLimiter, capture_exc_info
+
+
+class _Logger:
+    name = "test"
+
+
+def _log(limiter: RateLimiter, method_name: str, **event_dict) -> bool:
+    try:
+        limiter(_Logger(), method_name, {"event": "message", **event_dict})
+    except structlog.DropEvent:
+        return False
+    return True
+
+
+def test_call_sites_are_limited_per_window():
+    limiter = RateLimiter(limit=3, window=60)
+    assert [_log(limiter, "info") for _ in range(5)] == [True] * 3 + [False] * 2
+
+
+def test_suppressed_events_are_counted_on_the_next_one():
+    limiter = RateLimiter(limit=1, window=0)
+    event = {"event": "message"}
+    limiter._sites[("test", "message")] = [0.0, 1, 4]
+    assert limiter(_Logger(), "info", dict(event))["suppressed"] == 4
+
+
+@pytest.mark.parametrize("method_name", ["warning", "error", "exception"])
+def test_warnings_and_errors_are_exempt(method_name):
+    limiter = RateLimiter(limit=1, window=60)
+    assert all(_log(limiter, method_name) for _ in range(5))
+
+
+def test_explicit_rate_limit_applies_to_every_level():
+    limiter = RateLimiter()
+    assert [_log(limiter, "error", rate_limit=60) for _ in range(3)] == [
+        True,
+        False,
+        False,
+    ]
+
+
+def test_least_recently_logged_call_sites_are_forgotten():
+    limiter = RateLimiter(limit=1, window=60, max_sites=2)
+
+    def log(event: str) -> bool:
+        try:
+            limiter(_Logger(), "info", {"event": event})
+        except structlog.DropEvent:
+            return False
+        return True
+
+    assert log("a") and log("b")
+    assert not log("a")
+    # "b" is the least recently logged, so it makes room for "c".
+    assert log("c")
+    assert list(limiter._sites) == [("test", "a"), ("test", "c")]
+    assert not log("a")
+    assert log("b")
+
+
+def test_exception_is_captured_on_the_logging_thread():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        event_dict = capture_exc_info(None, "error", {"exc_info": True})
+
+    assert event_dict["exc_info"][0] is ValueError
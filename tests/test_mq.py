@@ -0,0 +1,41 @@
+import time
+
+from director.mq import DRAIN_INTERVAL, RedisConsumer
+
+from .conftest import fill_queue, queue_size
+
+
+def test_connecting_fetches_nothing(redis_url):
+    fill_queue(redis_url, "q1", 2)
+    received = []
+
+    consumer = RedisConsumer()
+    consumer.connect(redis_url, "q1", lambda body, message: received.append(body))
+    assert consumer.connected("q1")
+    time.sleep(DRAIN_INTERVAL * 5)
+    consumer.close()
+
+    assert received == []
+    assert queue_size(redis_url, "q1") == 2
+
+
+def test_consuming_fetches_one_message_at_a_time(redis_url):
+    fill_queue(redis_url, "q1", 2)
+    received = []
+
+    def on_message(body, message):
+        received.append(body["id"])
+        message.ack()
+
+    consumer = RedisConsumer()
+    consumer.connect(redis_url, "q1", on_message)
+    consumer.consume(
+        redis_url,
+        "q1",
+        on_message,
+        aborted=lambda: len(received) == 1,
+        timeout=5,
+    )
+
+    assert received == ["p0"]
+    assert queue_size(redis_url, "q1") == 1
@@ -0,0 +1,76 @@
+import pytest
+
+from cog import schema
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Tuple
+
+from director.prediction_tracker import PHASES, PredictionTracker
+
+CREATED_AT = datetime(2030, 1, 1, tzinfo=timezone.utc)
+
+
+def _tracker(**fields: Any) -> Tuple[PredictionTracker, List[Dict[str, Any]]]:
+    sent: List[Dict[str, Any]] = []
+    response = schema.PredictionResponse(id="p1", input={}, **fields)
+    return PredictionTracker(response=response, webhook_caller=sent.append), sent
+
+
+def _webhook(status: str, **fields: Any) -> schema.PredictionResponse:
+    return schema.PredictionResponse(id="p1", input={}, status=status, **fields)
+
+
+def test_phases_are_recorded_in_order():
+    phases = []
+    tracker, sent = _tracker(created_at=CREATED_AT)
+    tracker._on_phase = lambda phase, at: phases.append(phase)
+
+    tracker.mark("health_confirmed")
+    tracker.mark("dequeued")
+    tracker.mark("create_accepted")
+    tracker.start()
+    tracker.update_from_webhook_payload(_webhook("processing"))
+    tracker.update_from_webhook_payload(_webhook("succeeded", output="ok"))
+
+    expected = [p for p in PHASES if p not in {"uploaded", "webhook_delivered"}]
+    assert phases == expected
+
+    timestamps = sent[-1]["metrics"]["timestamps"]
+    assert list(timestamps) == expected
+    assert list(timestamps.values()) == sorted(timestamps.values())
+
+
+def test_only_the_first_occurrence_of_a_phase_counts():
+    tracker, _ = _tracker()
+    first = CREATED_AT + timedelta(seconds=1)
+    tracker.mark("dequeued", at=first)
+    tracker.mark("dequeued", at=first + timedelta(seconds=1))
+
+    assert tracker.phases == {"dequeued": first}
+
+
+def test_unknown_phases_are_rejected():
+    tracker, _ = _tracker()
+    with pytest.raises(ValueError):
+        tracker.mark("dispatched")
+
+
+def test_queue_time_and_overhead_are_derived_from_phases():
+    tracker, sent = _tracker(created_at=CREATED_AT)
+    tracker.mark("dequeued", at=CREATED_AT + timedelta(seconds=3))
+    tracker.mark("create_accepted", at=CREATED_AT + timedelta(seconds=3.5))
+    tracker.start()
+    tracker.update_from_webhook_payload(_webhook("succeeded", output="ok"))
+
+    metrics = sent[-1]["metrics"]
+    assert metrics["queue_time"] == 3.0
+    assert metrics["director_overhead"] == 0.5
+
+
+def test_naive_creation_time_is_utc():
+    tracker, sent = _tracker(created_at=CREATED_AT.replace(tzinfo=None))
+    tracker.mark("dequeued", at=CREATED_AT + timedelta(seconds=2))
+    tracker.fail("error")
+
+    metrics = sent[-1]["metrics"]
+    assert metrics["queue_time"] == 2.0
+    assert "director_overhead" not in metrics
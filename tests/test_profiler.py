@@ -0,0 +1,74 @@
+import os
+import sys
+
+from director.profiler import SamplingProfiler, _fold
+
+from .conftest import wait_for
+
+
+def _sampled(profiler: SamplingProfiler) -> bool:
+    return profiler.stats()["samples"] > 0
+
+
+def test_selected_predictions_are_written_to_their_own_file(tmp_path):
+    output = str(tmp_path / "profile.folded")
+    profiler = SamplingProfiler(interval=0.001, output=output, predictions=["p1"])
+
+    profiler.prediction_started("p2")
+    assert not profiler.running
+
+    profiler.prediction_started("p1")
+    assert profiler.running
+    assert wait_for(lambda: _sampled(profiler))
+    profiler.prediction_finished("p1")
+
+    assert not profiler.running
+    assert profiler.predictions == set()
+    assert os.listdir(tmp_path) == ["profile-p1.folded"]
+    with open(tmp_path / "profile-p1.folded") as f:
+        assert f.read()
+
+
+def test_folded_stacks():
+    def inner():
+        return _fold("MainThread", sys._getframe())
+
+    def outer():
+        return inner(), sys._getframe().f_lineno
+
+    stack, line = outer()
+    frames = stack.split(";")
+    assert frames[0] == "MainThread"
+    assert frames[-2] == f"outer (test_profiler.py:{line})"
+    assert frames[-1].startswith("inner (test_profiler.py:")
+
+
+def test_folded_output_is_one_stack_and_count_per_line(tmp_path):
+    profiler = SamplingProfiler(interval=0.001, output=str(tmp_path / "p.folded"))
+    profiler.start()
+    assert wait_for(lambda: _sampled(profiler))
+    profiler.stop()
+
+    lines = profiler.folded().splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert stack.split(";")[0]
+        assert int(count) > 0
+
+
+def test_toggle_requests_are_handled_on_the_watcher_thread(tmp_path):
+    output = str(tmp_path / "profile.folded")
+    profiler = SamplingProfiler(interval=0.001, output=output)
+    profiler.watch()
+
+    # Like a signal arriving while the main thread holds the profiler's lock:
+    # the request must not wait for it.
+    with profiler._lock:
+        profiler.request_toggle()
+    assert wait_for(lambda: profiler.running)
+    assert wait_for(lambda: _sampled(profiler))
+
+    profiler.request_toggle()
+    assert wait_for(lambda: os.path.exists(output))
+    assert not profiler.running
@@ -0,0 +1,34 @@
+import time
+
+from director.result_cache import ResultCache, cache_key
+
+
+def _message(**upload):
+    return {"version": "v1", "input": {"prompt": "a"}, "upload": upload or None}
+
+
+def test_results_are_shared_through_redis(redis_url):
+    state = {"output": ["https://cdn/a.png"], "logs": "", "status": "succeeded"}
+    ResultCache(redis_url=redis_url).put("k", state)
+
+    other = ResultCache(redis_url=redis_url)
+    assert other.get("k") == {"output": ["https://cdn/a.png"], "logs": ""}
+
+
+def test_sub_second_ttl(redis_url):
+    cache = ResultCache(ttl=0.2, redis_url=redis_url)
+    cache.put("k", {"output": ["x"]})
+    assert ResultCache(redis_url=redis_url).get("k") is not None
+
+    time.sleep(0.3)
+    assert cache.get("k") is None
+
+
+def test_presigned_signatures_are_not_part_of_the_key():
+    put = "https://bucket.s3/out.png?X-Amz-Signature="
+    a = _message(presigned_puts=[{"url": put + "a"}])
+    b = _message(presigned_puts=[{"url": put + "b"}])
+    c = _message(presigned_puts=[{"url": "https://bucket.s3/other.png?sig"}])
+
+    assert cache_key(a) == cache_key(b)
+    assert cache_key(a) != cache_key(c)
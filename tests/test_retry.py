@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+from director.retry import RetryScheduler
+
+from .conftest import wait_for
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = RetryScheduler(max_attempts=3, backoff_base=0.01, backoff_max=0.01)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+    scheduler.join()
+
+
+def flaky(failures):
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) <= failures:
+            raise RuntimeError("failed")
+
+    return func, calls
+
+
+def test_retries_until_success(scheduler):
+    func, calls = flaky(failures=2)
+    succeeded = threading.Event()
+
+    scheduler.submit("a", func, key="p1", on_success=succeeded.set)
+
+    assert succeeded.wait(timeout=5)
+    assert len(calls) == 3
+    assert scheduler._latest == {}
+
+
+def test_gives_up_after_max_attempts(scheduler):
+    func, calls = flaky(failures=10)
+    gave_up = threading.Event()
+
+    scheduler.submit("a", func, key="p1", max_attempts=2, on_give_up=gave_up.set)
+
+    assert gave_up.wait(timeout=5)
+    assert len(calls) == 2
+    assert scheduler._latest == {}
+
+
+def test_later_submission_supersedes_earlier_one(scheduler):
+    old, old_calls = flaky(failures=10)
+    new, new_calls = flaky(failures=0)
+    succeeded = threading.Event()
+    gave_up = threading.Event()
+
+    scheduler.submit("a", old, key="p1", on_give_up=gave_up.set)
+    wait_for(lambda: old_calls)
+    scheduler.submit("a", new, key="p1", on_success=succeeded.set)
+
+    assert succeeded.wait(timeout=5)
+    scheduler.stop()
+    scheduler.join()
+    assert len(old_calls) < 3
+    assert not gave_up.is_set()
+    assert scheduler._latest == {}
+
+
+def test_stop_delivers_outstanding_work():
+    scheduler = RetryScheduler(backoff_base=0.01, backoff_max=0.01)
+    scheduler.start()
+    func, calls = flaky(failures=1)
+
+    scheduler.submit("a", func)
+    scheduler.stop()
+    scheduler.join()
+
+    assert len(calls) == 2
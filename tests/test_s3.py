@@ -0,0 +1,184 @@
+import base64
+import os
+import threading
+import pytest
+
+from email.parser import BytesParser
+from email.policy import default
+from http.server import BaseHTTPRequestHandler
+from typing import Iterator, List, Tuple
+
+from benchmarks.standins import _serve
+from director.s3 import UploadParams, upload_caller, warm_presigned
+from director.spill import Spill
+from director.transforms import STAGES
+
+from .conftest import stop_server
+
+
+class _Store:
+    def __init__(self) -> None:
+        self.url = ""
+        # (method, key, size) of every object received.
+        self.objects: List[Tuple[str, str, int]] = []
+
+
+@pytest.fixture
+def store() -> Iterator[_Store]:
+    state = _Store()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_PUT(self) -> None:
+            body = self.rfile.read(int(self.headers["content-length"]))
+            state.objects.append(("PUT", self.path, len(body)))
+            self._reply(200)
+
+        def do_HEAD(self) -> None:
+            state.objects.append(("HEAD", self.path, 0))
+            self._reply(200)
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers["content-length"]))
+            header = f"content-type: {self.headers['content-type']}\r\n\r\n"
+            form = BytesParser(policy=default).parsebytes(header.encode() + body)
+            fields = {
+                part.get_param("name", header="content-disposition"): part
+                for part in form.iter_parts()
+            }
+            key = fields["key"].get_content()
+            size = len(fields["file"].get_payload(decode=True))
+            state.objects.append(("POST", key, size))
+            self._reply(204)
+
+        def _reply(self, status: int) -> None:
+            self.send_response(status)
+            self.send_header("content-length", "0")
+            self.end_headers()
+
+    server = _serve(("127.0.0.1", 0), Handler)
+    state.url = "http://%s:%d" % server.server_address[:2]
+    yield state
+    stop_server(server)
+
+
+def _data_url(size: int) -> str:
+    return "data:image/png;base64," + base64.b64encode(os.urandom(size)).decode()
+
+
+def test_elements_are_uploaded_once_across_webhooks(store):
+    params = UploadParams(presigned_puts=[{"url": f"{store.url}/a?sig"}])
+    caller = upload_caller(params)
+    first = _data_url(100)
+
+    # A progress webhook, and the terminal one repeating the same output.
+    assert caller([first])[0] == [f"{store.url}/a"]
+    assert caller([first])[0] == [f"{store.url}/a"]
+    assert len(store.objects) == 1
+
+
+def test_spilled_elements_are_uploaded(store, tmp_path):
+    spill = Spill(str(tmp_path), threshold=100)
+    spill.track("p1")
+    ref = spill.spill(_data_url(1000), "p1")
+
+    params = UploadParams(presigned_puts=[{"url": f"{store.url}/a?sig"}])
+    caller = upload_caller(params, spill=spill)
+    assert caller([ref])[0] == [f"{store.url}/a"]
+    assert caller([ref])[0] == [f"{store.url}/a"]
+    assert store.objects == [("PUT", "/a?sig", 1000)]
+
+
+def test_presigned_puts_are_used_in_order(store):
+    params = UploadParams(
+        presigned_puts=[
+            {"url": f"{store.url}/a?sig"},
+            {"url": f"{store.url}/b?sig", "public_url": "https://cdn/b"},
+        ]
+    )
+    outputs = [_data_url(10), _data_url(20), _data_url(30)]
+    result, _ = upload_caller(params)(outputs)
+
+    # Without a URL left, the last output is sent inline. Uploads run
+    # concurrently, so they may arrive in any order.
+    assert result == [f"{store.url}/a", "https://cdn/b", outputs[2]]
+    assert sorted(store.objects) == [("PUT", "/a?sig", 10), ("PUT", "/b?sig", 20)]
+
+
+def test_presigned_post(store):
+    params = UploadParams(
+        url_prefix="https://cdn",
+        presigned_post={
+            "url": f"{store.url}/",
+            "fields": {"key": "out/${filename}", "policy": "p"},
+        },
+    )
+    result, _ = upload_caller(params)({"images": [_data_url(10)]})
+
+    [url] = result["images"]
+    assert url.startswith("https://cdn/out/") and url.endswith(".png")
+    assert store.objects == [("POST", url[len("https://cdn/") :], 10)]
+
+
+def test_params_need_credentials_or_presigned_requests():
+    with pytest.raises(ValueError):
+        UploadParams(url="http://s3", bucket="b", url_prefix="https://cdn")
+    with pytest.raises(ValueError):
+        UploadParams(presigned_post={"url": "http://s3", "fields": {}})
+
+
+def test_transforms_run_on_the_transform_pool(store, monkeypatch):
+    threads = []
+
+    def probe():
+        def stage(blob):
+            threads.append(threading.current_thread().name)
+            return blob
+
+        return stage
+
+    monkeypatch.setitem(STAGES, "probe", probe)
+    params = UploadParams(
+        presigned_puts=[{"url": f"{store.url}/a?sig"}],
+        transforms=[{"name": "probe"}],
+    )
+    upload_caller(params)([_data_url(10)])
+
+    [name] = threads
+    assert name.startswith("transform")
+    assert len(store.objects) == 1
+
+
+def test_presigned_post_with_fixed_key_uploads_one_output(store):
+    params = UploadParams(
+        url_prefix="https://cdn",
+        presigned_post={"url": f"{store.url}/", "fields": {"key": "out/result"}},
+    )
+    caller = upload_caller(params)
+    outputs = [_data_url(10), _data_url(20)]
+
+    # The second output would overwrite the first, so it's sent inline.
+    result, _ = caller(outputs)
+    assert result == ["https://cdn/out/result", outputs[1]]
+    assert store.objects == [("POST", "out/result", 10)]
+
+    # Later webhooks don't upload it again.
+    assert caller(outputs)[0] == result
+    assert len(store.objects) == 1
+
+
+def test_presigned_puts_must_not_be_empty():
+    with pytest.raises(ValueError):
+        UploadParams(presigned_puts=[])
+
+
+def test_warm_presigned_connects_to_the_endpoint(store):
+    warm_presigned(f"{store.url}/bucket/key?sig")
+    # Only the origin: presigned URLs carry signatures.
+    assert store.objects == [("HEAD", "/", 0)]
+
+
+def test_warm_presigned_ignores_unreachable_endpoints():
+    warm_presigned("http://127.0.0.1:1/bucket")
@@ -0,0 +1,47 @@
+import base64
+import os
+
+from director.spill import Spill
+
+
+def _data_url(data: bytes) -> str:
+    return "data:image/png;base64," + base64.b64encode(data).decode()
+
+
+def test_large_values_are_spilled_and_read_back(tmp_path):
+    spill = Spill(str(tmp_path), threshold=100)
+    spill.track("p1")
+    url = _data_url(os.urandom(200))
+    output = spill.spill({"images": [url, "small"]}, "p1")
+
+    ref = output["images"][0]
+    assert spill.is_ref(ref)
+    assert output["images"][1] == "small"
+    assert spill.materialize(output) == {"images": [url, "small"]}
+    assert spill.decode_data_url(ref) == ("image/png", base64.b64decode(url[22:]))
+
+    # cog repeats outputs in every webhook: they're only spilled once.
+    assert spill.spill([url], "p1") == [ref]
+    assert len(spill) == 1
+
+
+def test_release_deletes_spilled_files(tmp_path):
+    spill = Spill(str(tmp_path), threshold=100)
+    spill.track("p1")
+    spill.spill("x" * 200, "p1")
+    spill.release("p1")
+
+    assert len(spill) == 0
+    assert os.listdir(spill.directory) == []
+
+
+def test_untracked_predictions_are_not_spilled(tmp_path):
+    spill = Spill(str(tmp_path), threshold=100)
+    value = "x" * 200
+    assert spill.spill(value, "stray") == value
+
+    # A webhook arriving after the prediction was released.
+    spill.track("p1")
+    spill.release("p1")
+    assert spill.spill(value, "p1") == value
+    assert len(spill) == 0
@@ -0,0 +1,138 @@
+import json
+import os
+import time
+import pytest
+
+from http.server import BaseHTTPRequestHandler
+from typing import Any, Iterator, List
+
+from benchmarks.standins import _serve
+from director.spool import WebhookSpool
+from director.webhook import webhook_caller
+
+from .conftest import stop_server, wait_for
+
+
+class _Receiver:
+    def __init__(self) -> None:
+        self.url = ""
+        self.payloads: List[Any] = []
+        self.delay = 0.0
+        self.status = 200
+
+
+@pytest.fixture
+def receiver() -> Iterator:
+    state = _Receiver()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers["content-length"]))
+            state.payloads.append(json.loads(body))
+            time.sleep(state.delay)
+            self.send_response(state.status)
+            self.send_header("content-length", "0")
+            self.end_headers()
+
+    server = _serve(("127.0.0.1", 0), Handler)
+    state.url = "http://%s:%d/webhook" % server.server_address[:2]
+    yield state
+    stop_server(server)
+
+
+def test_unacknowledged_payloads_survive_restart(tmp_path):
+    spool = WebhookSpool(str(tmp_path))
+    delivered = spool.append("http://example.com", {"id": "p1"})
+    spool.append("http://example.com", {"id": "p2"})
+    spool.ack(delivered)
+    spool.join()
+
+    spool = WebhookSpool(str(tmp_path))
+    assert [e.payload for e in spool._pending.values()] == [{"id": "p2"}]
+    spool.join()
+
+
+def test_torn_write_is_skipped_on_recovery(tmp_path):
+    spool = WebhookSpool(str(tmp_path))
+    spool.append("http://example.com", {"id": "p1"})
+    spool.join()
+
+    (segment,) = os.listdir(tmp_path)
+    with open(tmp_path / segment, "ab") as f:
+        f.write(b'{"op": "put", "id": "p2", "ur')
+
+    spool = WebhookSpool(str(tmp_path))
+    assert len(spool) == 1
+    spool.join()
+
+
+def test_acknowledged_segments_are_deleted(tmp_path):
+    spool = WebhookSpool(str(tmp_path), segment_size=1)
+    ids = [spool.append("http://example.com", {"id": i}) for i in range(3)]
+    assert len(os.listdir(tmp_path)) == 3
+
+    for entry_id in ids:
+        spool.ack(entry_id)
+    spool.join()
+
+    # Only the segment being written to when the spool was closed is left.
+    assert len(os.listdir(tmp_path)) == 1
+    assert len(WebhookSpool(str(tmp_path))) == 0
+
+
+def test_drainer_replays_released_entries(tmp_path, receiver):
+    spool = WebhookSpool(str(tmp_path))
+    spool.start()
+    try:
+        held = spool.append(receiver.url, {"id": "p1"}, hold=True)
+        assert not wait_for(lambda: receiver.payloads, timeout=0.5)
+
+        spool.release(held)
+        assert wait_for(lambda: not len(spool))
+        assert receiver.payloads == [{"id": "p1"}]
+    finally:
+        spool.stop()
+        spool.join()
+
+
+def test_rejects_unknown_fsync_policy(tmp_path):
+    with pytest.raises(ValueError):
+        WebhookSpool(str(tmp_path), fsync="sometimes")
+
+
+def _terminal(prediction_id: str) -> dict:
+    return {"id": prediction_id, "input": {}, "status": "succeeded", "output": "ok"}
+
+
+def test_slow_webhook_is_not_replayed_while_in_flight(tmp_path, receiver, monkeypatch):
+    monkeypatch.setattr("director.spool.REPLAY_BACKOFF_MIN", 0.05)
+    spool = WebhookSpool(str(tmp_path))
+    spool.start()
+    receiver.delay = 0.5
+    try:
+        webhook_caller(receiver.url, spool=spool)(_terminal("p1"))
+
+        assert len(spool) == 0
+        assert [p["id"] for p in receiver.payloads] == ["p1"]
+    finally:
+        spool.stop()
+        spool.join()
+
+
+def test_failed_webhook_is_handed_to_the_drainer(tmp_path, receiver):
+    spool = WebhookSpool(str(tmp_path))
+    receiver.status = 500
+    webhook_caller(receiver.url, spool=spool)(_terminal("p1"))
+    assert len(spool) == 1
+
+    receiver.status = 200
+    spool.start()
+    try:
+        assert wait_for(lambda: not len(spool))
+        assert [p["id"] for p in receiver.payloads] == ["p1", "p1"]
+    finally:
+        spool.stop()
+        spool.join()
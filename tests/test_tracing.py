@@ -0,0 +1,143 @@
+import pytest
+
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+    InMemorySpanExporter,
+)
+from opentelemetry.sdk.trace.sampling import ALWAYS_ON
+from opentelemetry.trace import StatusCode
+from typing import Any, Iterator, List, Tuple
+
+from director.tracing import (
+    MAX_PENDING_TRACES,
+    PENDING_TIMEOUT,
+    PREDICTION_SPAN,
+    PredictionSampler,
+    TailSamplingProcessor,
+)
+
+# Span start and end times, in nanoseconds.
+SECOND = 10**9
+
+
+@pytest.fixture
+def processor() -> TailSamplingProcessor:
+    exporter = InMemorySpanExporter()
+    return TailSamplingProcessor(SimpleSpanProcessor(exporter), slow_threshold=10)
+
+
+@pytest.fixture
+def traced(processor) -> Iterator[Tuple[Any, InMemorySpanExporter]]:
+    provider = TracerProvider(sampler=ALWAYS_ON)
+    provider.add_span_processor(processor)
+    yield provider.get_tracer("test"), processor.delegate.span_exporter
+    provider.shutdown()
+
+
+def _exported(exporter: InMemorySpanExporter) -> List[str]:
+    return sorted(span.name for span in exporter.get_finished_spans())
+
+
+def _prediction(tracer: Any, **attributes: Any) -> Any:
+    root = tracer.start_span(PREDICTION_SPAN, start_time=0)
+    context = trace.set_span_in_context(root)
+    tracer.start_span("child", context=context, start_time=0).end(end_time=SECOND)
+    for key, value in attributes.items():
+        root.set_attribute(key, value)
+    return root, context
+
+
+def test_fast_healthy_predictions_are_dropped(traced):
+    tracer, exporter = traced
+    root, _ = _prediction(tracer, **{"prediction.status": "succeeded"})
+    root.end(end_time=SECOND)
+
+    assert _exported(exporter) == []
+
+
+def test_failed_predictions_are_kept(traced):
+    tracer, exporter = traced
+    root, _ = _prediction(tracer, **{"prediction.status": "failed"})
+    root.end(end_time=SECOND)
+
+    assert _exported(exporter) == ["child", PREDICTION_SPAN]
+
+
+def test_predictions_with_errors_are_kept(traced):
+    tracer, exporter = traced
+    root, _ = _prediction(tracer)
+    root.set_status(StatusCode.ERROR)
+    root.end(end_time=SECOND)
+
+    assert _exported(exporter) == ["child", PREDICTION_SPAN]
+
+
+def test_slow_predictions_are_kept(traced):
+    tracer, exporter = traced
+    root, _ = _prediction(tracer)
+    root.end(end_time=11 * SECOND)
+
+    assert _exported(exporter) == ["child", PREDICTION_SPAN]
+
+
+def test_late_spans_follow_their_root(traced):
+    tracer, exporter = traced
+    kept, kept_context = _prediction(tracer, **{"prediction.status": "failed"})
+    kept.end(end_time=SECOND)
+    dropped, dropped_context = _prediction(tracer)
+    dropped.end(end_time=SECOND)
+
+    # E.g. the terminal webhook, delivered after the prediction span ended.
+    tracer.start_span("late", context=kept_context).end()
+    tracer.start_span("late", context=dropped_context).end()
+
+    assert _exported(exporter) == sorted(["child", "late", PREDICTION_SPAN])
+
+
+def test_other_traces_are_always_kept(traced):
+    tracer, exporter = traced
+    root = tracer.start_span("cog.director.utilization")
+    context = trace.set_span_in_context(root)
+    tracer.start_span("child", context=context).end()
+    root.end()
+
+    assert _exported(exporter) == ["child", "cog.director.utilization"]
+
+
+def test_unfinished_traces_are_dropped_oldest_first(traced):
+    tracer, exporter = traced
+    roots = [_prediction(tracer)[0] for _ in range(MAX_PENDING_TRACES + 1)]
+    for root in roots:
+        root.set_status(StatusCode.ERROR)
+        root.end()
+
+    # The first trace's child was dropped while waiting for its root.
+    spans = exporter.get_finished_spans()
+    assert len(spans) == 2 * len(roots) - 1
+    assert spans[0].name == PREDICTION_SPAN
+
+
+def test_traces_whose_root_never_ends_are_dropped(traced, processor):
+    tracer, exporter = traced
+    _prediction(tracer)
+    for pending in processor._pending.values():
+        pending.since -= PENDING_TIMEOUT
+
+    root, _ = _prediction(tracer)
+    assert len(processor._pending) == 1
+    root.set_status(StatusCode.ERROR)
+    root.end()
+
+    assert _exported(exporter) == ["child", PREDICTION_SPAN]
+
+
+@pytest.mark.parametrize("ratio, sampled", [(0.0, False), (1.0, True)])
+def test_head_sampler_only_samples_predictions(ratio, sampled):
+    sampler = PredictionSampler(ratio)
+    prediction = sampler.should_sample(None, 1234, PREDICTION_SPAN)
+    other = sampler.should_sample(None, 1234, "cog.director.utilization")
+
+    assert prediction.decision.is_sampled() == sampled
+    assert other.decision.is_sampled()
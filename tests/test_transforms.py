@@ -0,0 +1,69 @@
+import gzip
+import io
+import pytest
+
+from PIL import Image, features
+
+from director.transforms import Blob, TransformParams, pipeline
+
+
+def png(width: int, height: int) -> Blob:
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 10, 10)).save(out, format="PNG")
+    return Blob(content_type="image/png", data=out.getvalue())
+
+
+def run(blob: Blob, *specs: TransformParams) -> Blob:
+    return pipeline(list(specs))(blob)
+
+
+def test_unknown_transforms_are_rejected_up_front():
+    with pytest.raises(ValueError):
+        pipeline([TransformParams(name="sharpen")])
+
+
+def test_gzip_text():
+    text = b'{"a": 1}' * 100
+    blob = run(
+        Blob(content_type="application/json", data=text), TransformParams(name="gzip")
+    )
+    assert blob.content_type == "application/json"
+    assert blob.content_encoding == "gzip"
+    assert gzip.decompress(blob.data) == text
+
+
+def test_gzip_leaves_binary_and_incompressible_outputs_alone():
+    binary = Blob(content_type="application/octet-stream", data=b"x" * 1000)
+    tiny = Blob(content_type="text/plain", data=b"x")
+    assert run(binary, TransformParams(name="gzip")) is binary
+    assert run(tiny, TransformParams(name="gzip")) is tiny
+
+
+@pytest.mark.skipif(not features.check("webp"), reason="Pillow lacks WebP support")
+def test_webp_then_downscale():
+    blob = run(
+        png(1024, 256),
+        TransformParams(name="webp"),
+        TransformParams(name="downscale", options={"max_size": 128}),
+    )
+
+    image = Image.open(io.BytesIO(blob.data))
+    assert blob.content_type == "image/webp"
+    assert image.format == "WEBP"
+    assert image.size == (128, 32)
+
+
+def test_small_images_are_not_downscaled():
+    blob = png(64, 64)
+    assert run(blob, TransformParams(name="downscale")) is blob
+
+
+def test_undecodable_images_pass_through():
+    blob = Blob(content_type="image/png", data=b"not a png")
+    assert run(blob, TransformParams(name="webp")) is blob
+
+
+def test_failing_stage_does_not_fail_the_pipeline():
+    blob = png(64, 64)
+    bad = TransformParams(name="downscale", options={"max_size": "big"})
+    assert run(blob, bad, TransformParams(name="gzip")) is blob
@@ -0,0 +1,169 @@
+import pytest
+import threading
+import redis
+
+from typing import Iterator
+
+from benchmarks.standins import FakeControlPlane, serve_control_plane
+from director import worker as worker_module
+from director.background_tasks import BackgroundTasks
+from director.retry import RetryScheduler
+from director.worker import Worker
+
+from .conftest import serve_redis, stop_server, wait_for
+
+
+@pytest.fixture(autouse=True)
+def fast_intervals(monkeypatch: pytest.MonkeyPatch) -> None:
+    # Held requests have to return soon for the worker to stop promptly.
+    monkeypatch.setattr(worker_module, "NEXT_QUEUE_INTERVAL", 0.1)
+    monkeypatch.setattr(worker_module, "NEXT_QUEUE_WAIT", 1.0)
+    monkeypatch.setattr(worker_module, "MIN_LONG_POLL", 0.1)
+    monkeypatch.setattr(worker_module, "REPORT_DEBOUNCE", 0.05)
+
+
+@pytest.fixture
+def control_plane_server(control_plane: FakeControlPlane) -> Iterator:
+    server = serve_control_plane(control_plane)
+    yield server
+    stop_server(server)
+
+
+def _base_url(server) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+def _start_worker(report_url: str, mode: str, redis_url: str = None) -> Worker:
+    worker = Worker(
+        None,
+        BackgroundTasks(),
+        id="w1",
+        report_url=report_url,
+        next_queue_mode=mode,
+        redis_url=redis_url,
+    )
+    worker.start()
+    return worker
+
+
+def _stop_worker(worker: Worker) -> None:
+    worker.stop()
+    worker.join()
+
+
+def test_long_poll_follows_assignment(control_plane, control_plane_server):
+    worker = _start_worker(_base_url(control_plane_server), "long-poll")
+    try:
+        assert wait_for(lambda: worker.queue == "q1")
+        assert worker.switched
+
+        # Picked up while the request is held, not after a poll interval.
+        control_plane.assign("q2")
+        assert wait_for(lambda: worker.queue == "q2", timeout=0.5)
+
+        control_plane.assign(None)
+        assert wait_for(lambda: worker.expired and worker.queue is None)
+    finally:
+        _stop_worker(worker)
+
+
+def test_long_poll_reconnects(control_plane, control_plane_server):
+    address = control_plane_server.server_address
+    worker = _start_worker(_base_url(control_plane_server), "long-poll")
+    try:
+        assert wait_for(lambda: worker.queue == "q1")
+
+        stop_server(control_plane_server)
+        control_plane.assign("q2")
+        restarted = serve_control_plane(control_plane, address)
+        try:
+            assert wait_for(lambda: worker.queue == "q2")
+        finally:
+            stop_server(restarted)
+    finally:
+        _stop_worker(worker)
+
+
+def test_pubsub_follows_assignment(control_plane, control_plane_server, redis_url):
+    worker = _start_worker(_base_url(control_plane_server), "pubsub", redis_url)
+    client = redis.Redis.from_url(redis_url)
+    try:
+        # The current assignment is fetched once subscribed.
+        assert wait_for(lambda: worker.queue == "q1")
+        assert wait_for(lambda: client.pubsub_numsub(worker.queue_channel)[0][1])
+
+        client.publish(worker.queue_channel, "q2")
+        assert wait_for(lambda: worker.queue == "q2")
+
+        # An empty message means there's no assignment anymore.
+        client.publish(worker.queue_channel, "")
+        assert wait_for(lambda: worker.expired and worker.queue is None)
+    finally:
+        client.close()
+        _stop_worker(worker)
+
+
+def test_pubsub_resubscribes(control_plane, control_plane_server, redis_server):
+    address = redis_server.server_address
+    redis_url = f"redis://{address[0]}:{address[1]}/0"
+    worker = _start_worker(_base_url(control_plane_server), "pubsub", redis_url)
+    try:
+        assert wait_for(lambda: worker.queue == "q1")
+
+        # Changes made while the subscription is down are caught up with once
+        # it's back.
+        stop_server(redis_server)
+        control_plane.assign("q2")
+        restarted = serve_redis(address)
+        client = redis.Redis.from_url(redis_url)
+        try:
+            assert wait_for(lambda: worker.queue == "q2")
+            assert wait_for(lambda: client.pubsub_numsub(worker.queue_channel)[0][1])
+
+            client.publish(worker.queue_channel, "q3")
+            assert wait_for(lambda: worker.queue == "q3")
+        finally:
+            client.close()
+            stop_server(restarted)
+    finally:
+        _stop_worker(worker)
+
+
+def test_nothing_is_reported_after_shutdown(control_plane, control_plane_server):
+    scheduler = RetryScheduler(backoff_base=0.2)
+    scheduler.start()
+    worker = Worker(
+        "q1",
+        BackgroundTasks(),
+        id="w1",
+        report_url=_base_url(control_plane_server),
+        retry_scheduler=scheduler,
+    )
+    # Only the reporter: queue assignments don't matter here.
+    worker._reporter = threading.Thread(target=worker._report_loop)
+    worker._reporter.start()
+    try:
+        # Make the first report fail, so that it's waiting for a retry when
+        # the worker shuts down.
+        stop_server(control_plane_server)
+        worker.busy()
+        assert wait_for(lambda: worker._last_status == "busy")
+        restarted = serve_control_plane(
+            control_plane, control_plane_server.server_address
+        )
+        try:
+            worker.shutdown()
+            worker.idle()
+            worker.stop()
+            worker.join()
+            scheduler.stop()
+            scheduler.join()
+        finally:
+            stop_server(restarted)
+    finally:
+        worker.stop()
+        scheduler.stop()
+
+    assert control_plane.statuses[-1] == ("w1", "shutdown")
+    assert ("w1", "idle") not in control_plane.statuses